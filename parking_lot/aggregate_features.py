@@ -0,0 +1,96 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+
+from kfp.v2 import dsl
+from kfp.v2.dsl import Output, Input, Dataset
+
+
+_COMPONENTS_IMAGE = os.getenv('COMPONENTS_IMAGE', 'gcr.io/jk-mlops-dev/alphafold-components')
+
+
+@dsl.component(
+    base_image=_COMPONENTS_IMAGE,
+    output_component_file='component_aggregate_features.yaml'
+)
+def aggregate_features(
+    sequence: Input[Dataset],
+    uniref90_msa: Input[Dataset],
+    mgnify_msa: Input[Dataset],
+    bfd_msa: Input[Dataset],
+    template_features: Input[Dataset],
+    features: Output[Dataset],
+    uniref_max_hits: int=10000,
+    mgnify_max_hits: int=501,
+    ):
+    """Assembles the model input features from the search results.
+
+    Runs the featurization of run_data_pipeline.DataPipeline on the MSAs and
+    template features produced by the msa_search and template_search steps.
+    The components image must include alphafold and the pipelines modules.
+    """
+
+    import logging
+    import pickle
+    import sys
+
+    from alphafold.data import parsers
+
+    import artifact_io
+    import encoded_msa
+    from run_data_pipeline import make_msa_features, make_sequence_features
+
+    logging.basicConfig(format='%(asctime)s - %(message)s',
+                      level=logging.INFO,
+                      datefmt='%d-%m-%y %H:%M:%S',
+                      stream=sys.stdout)
+
+    def _read_msa(msa, max_sequences=None):
+        # The MSA may be compressed, which is detected from its content.
+        msa_str = artifact_io.read_text(msa.path)
+        data_format = msa.metadata['data_format']
+        if data_format == 'sto':
+            return encoded_msa.EncodedMsa.from_stockholm(
+                msa_str, max_sequences=max_sequences)
+        elif data_format == 'a3m':
+            return encoded_msa.EncodedMsa.from_a3m(msa_str)
+        else:
+            raise ValueError(f'Unsupported MSA format: {data_format}')
+
+    with open(sequence.path) as f:
+        input_seqs, input_descs = parsers.parse_fasta(f.read())
+    if len(input_seqs) != 1:
+        raise ValueError(
+            f'More than one input sequence found in {sequence.uri}.')
+
+    uniref90 = _read_msa(uniref90_msa, uniref_max_hits)
+    bfd = _read_msa(bfd_msa)
+    mgnify = _read_msa(mgnify_msa, mgnify_max_hits)
+    with open(template_features.path, 'rb') as f:
+        templates_features = pickle.load(f)
+
+    sequence_features = make_sequence_features(
+        sequence=input_seqs[0],
+        description=input_descs[0],
+        num_res=len(input_seqs[0]))
+    msa_features = make_msa_features((uniref90, bfd, mgnify))
+    logging.info(f'Final (deduplicated) MSA size: '
+                 f'{msa_features["num_alignments"][0]} sequences.')
+
+    features.metadata['data_format'] = 'pkl'
+    with open(features.path, 'wb') as f:
+        pickle.dump({**sequence_features, **msa_features, **templates_features},
+                    f, protocol=4)
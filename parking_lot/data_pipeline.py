@@ -0,0 +1,181 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The AlphaFold data stage as a Vertex AI pipeline.
+
+The MSA searches have no dependencies on each other, so one msa_search task
+is fanned out per database group and they all run at the same time. Template
+search only depends on the UniRef90 MSA and starts as soon as that search
+finishes, while the MGnify and BFD searches are still running. The
+featurization step joins all branches, so the wall time of the data stage is
+that of the slowest branch rather than the sum of all searches.
+"""
+
+from absl import flags
+from absl import app
+
+from kfp.v2 import dsl
+from kfp.v2 import compiler
+from kfp.v2.dsl import Output, Dataset
+
+from aggregate_features import aggregate_features
+from msa_search import msa_search
+from template_search import template_search
+
+FLAGS = flags.FLAGS
+
+_PIPELINE_NAME = 'alphafold-data-pipeline'
+_PIPELINE_DESCRIPTION = 'AlphaFold data stage with parallel MSA searches'
+
+flags.DEFINE_string('pipeline_spec', f'{_PIPELINE_NAME}.json',
+                    'Path to the compiled pipeline spec')
+
+_REFERENCE_DATASETS_IMAGE = "https://www.googleapis.com/compute/v1/projects/jk-mlops-dev/global/images/jk-alphafold-datasets 3000"
+_UNIREF_PATH = 'uniref90/uniref90.fasta'
+_MGNIFY_PATH = 'mgnify/mgy_clusters_2018_12.fa'
+_BFD_PATH = 'bfd/bfd_metaclust_clu_complete_id30_c90_final_seq.sorted_opt'
+_UNICLUST_PATH = 'uniclust30/uniclust30_2018_08/uniclust30_2018_08'
+_PDB70_PATH = 'pdb70/pdb70'
+_PDB_SEQRES_PATH = 'pdb_seqres/pdb_seqres.txt'
+_PDB_MMCIF_PATH = 'pdb_mmcif/mmcif_files'
+_PDB_OBSOLETE_PATH = 'pdb_mmcif/obsolete.dat'
+
+# Database groups searched in parallel. Each group must map to a single tool.
+_MSA_DB_GROUPS = {
+    'uniref90': ['uniref90'],
+    'mgnify': ['mgnify'],
+    'bfd': ['bfd', 'uniclust30'],
+}
+# Template search tools whose runner writes the template features read by
+# aggregate_features. The hhsearch runner only writes the .hhr hits, so it
+# cannot be used until it featurizes them.
+_TEMPLATE_DBS = {
+    'hmmsearch': ['pdb_seqres'],
+}
+
+flags.DEFINE_enum('template_tool', 'hmmsearch', list(_TEMPLATE_DBS),
+                  'Template search tool')
+
+
+@dsl.component
+def reference_databases_op(
+    disk_image: str,
+    uniref90: str,
+    mgnify: str,
+    bfd: str,
+    uniclust30: str,
+    pdb70: str,
+    pdb_seqres: str,
+    pdb_mmcif: str,
+    pdb_obsolete: str,
+    reference_databases: Output[Dataset],
+):
+    """Records the disk image and database paths as artifact metadata."""
+    reference_databases.metadata['disk_image'] = disk_image
+    reference_databases.metadata['uniref90'] = uniref90
+    reference_databases.metadata['mgnify'] = mgnify
+    reference_databases.metadata['bfd'] = bfd
+    reference_databases.metadata['uniclust30'] = uniclust30
+    reference_databases.metadata['pdb70'] = pdb70
+    reference_databases.metadata['pdb_seqres'] = pdb_seqres
+    reference_databases.metadata['pdb_mmcif'] = pdb_mmcif
+    reference_databases.metadata['pdb_obsolete'] = pdb_obsolete
+    with open(reference_databases.path, 'w') as f:
+        f.write(disk_image)
+
+
+def build_pipeline(template_tool: str='hmmsearch'):
+    """Returns the data stage pipeline using the given template search tool."""
+
+    if template_tool not in _TEMPLATE_DBS:
+        raise ValueError(f'The template search tool {template_tool} not supported')
+
+    @dsl.pipeline(name=_PIPELINE_NAME, description=_PIPELINE_DESCRIPTION)
+    def pipeline(
+        fasta_path: str,
+        project: str,
+        region: str,
+        max_template_date: str,
+        datasets_disk_image: str=_REFERENCE_DATASETS_IMAGE,
+        cache_root: str='',
+        compression: str='none',
+        profile: bool=False):
+        """Runs the AlphaFold data stage."""
+
+        sequence = dsl.importer(
+            artifact_uri=fasta_path,
+            artifact_class=dsl.Dataset,
+            reimport=False,
+        )
+
+        reference_databases = reference_databases_op(
+            disk_image=datasets_disk_image,
+            uniref90=_UNIREF_PATH,
+            mgnify=_MGNIFY_PATH,
+            bfd=_BFD_PATH,
+            uniclust30=_UNICLUST_PATH,
+            pdb70=_PDB70_PATH,
+            pdb_seqres=_PDB_SEQRES_PATH,
+            pdb_mmcif=_PDB_MMCIF_PATH,
+            pdb_obsolete=_PDB_OBSOLETE_PATH,
+        )
+
+        msa_tasks = {}
+        for group, msa_dbs in _MSA_DB_GROUPS.items():
+            msa_tasks[group] = msa_search(
+                project=project,
+                region=region,
+                msa_dbs=msa_dbs,
+                reference_databases=reference_databases.outputs['reference_databases'],
+                sequence=sequence.output,
+                cache_root=cache_root,
+                compression=compression,
+                profile=profile,
+            ).set_display_name(f'search-{group}')
+
+        # Only waits for the UniRef90 search.
+        template_task = template_search(
+            project=project,
+            region=region,
+            template_dbs=_TEMPLATE_DBS[template_tool],
+            mmcif_db='pdb_mmcif',
+            obsolete_db='pdb_obsolete',
+            max_template_date=max_template_date,
+            reference_databases=reference_databases.outputs['reference_databases'],
+            sequence=sequence.output,
+            msa=msa_tasks['uniref90'].outputs['msa'],
+            template_tool=template_tool,
+            cache_root=cache_root,
+            compression=compression,
+            profile=profile,
+        ).set_display_name('search-templates')
+
+        aggregate_features(
+            sequence=sequence.output,
+            uniref90_msa=msa_tasks['uniref90'].outputs['msa'],
+            mgnify_msa=msa_tasks['mgnify'].outputs['msa'],
+            bfd_msa=msa_tasks['bfd'].outputs['msa'],
+            template_features=template_task.outputs['template_features'],
+        ).set_display_name('aggregate-features')
+
+    return pipeline
+
+
+def _main(argv):
+    compiler.Compiler().compile(
+        pipeline_func=build_pipeline(FLAGS.template_tool),
+        package_path=FLAGS.pipeline_spec)
+
+
+if __name__ == "__main__":
+    app.run(_main)
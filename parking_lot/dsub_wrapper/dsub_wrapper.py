@@ -14,14 +14,77 @@
 """A Python wrapper around dsub."""
 
 
+import csv
+import dataclasses
+import json
 import logging
 import os
 import subprocess 
 import shutil
+import time
 
-from typing import List
+from typing import Dict, List, Optional, Sequence
+
+import speculation
 
 _DSUB_BINARY_PATH = shutil.which('dsub')
+_DSTAT_BINARY_PATH = shutil.which('dstat')
+_DDEL_BINARY_PATH = shutil.which('ddel')
+
+# dstat statuses of jobs that are no longer running.
+_DSTAT_TO_SPECULATION_STATUS = {
+    'SUCCESS': speculation.SUCCESS,
+    'FAILURE': speculation.FAILURE,
+    'CANCELED': speculation.FAILURE,
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class DsubTask:
+    """The parameters of one task of a batch job.
+
+    All tasks of a batch must have the same input, output and environment
+    variable names.
+    """
+    inputs: Dict[str, str]
+    outputs: Dict[str, str]
+    env_vars: Dict[str, str] = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass
+class TaskResult:
+    """The outcome of a task of a batch job, after all of its attempts."""
+    status: str
+    outputs: Dict[str, str]
+    job_ids: List[str]
+
+
+def write_tasks_file(tasks: Sequence[DsubTask], path: str):
+    """Writes the tasks TSV file read by `dsub --tasks`.
+
+    The header names a `--env`, `--input` or `--output` parameter in every
+    column and every row has the values of one task.
+    """
+    if not tasks:
+        raise ValueError('A batch needs at least one task.')
+
+    def parameters(task: DsubTask) -> Dict[str, Dict[str, str]]:
+        return {'--env': task.env_vars, '--input': task.inputs,
+                '--output': task.outputs}
+
+    columns = [(flag, name) for flag, values in parameters(tasks[0]).items()
+               for name in values]
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow([f'{flag} {name}' for flag, name in columns])
+        for task in tasks:
+            values = parameters(task)
+            if sorted(columns) != sorted(
+                    (flag, name) for flag in values for name in values[flag]):
+                raise ValueError(f'The parameters of {task} differ from '
+                                 'those of the first task.')
+            writer.writerow([values[flag][name] for flag, name in columns])
 
 class DsubJob(object):
 
@@ -95,8 +158,201 @@ class DsubJob(object):
   
         return result
 
-    def check_job_status(self, job_id: str):
-        pass
+    def _provider_args(self) -> List[str]:
+        return [
+            '--provider', self.provider,
+            '--project', self.project,
+            '--location', self.region,
+        ]
+
+    def submit_job(self,
+                   script: str,
+                   inputs: dict,
+                   outputs: dict,
+                   env_vars: dict,
+                   disk_mounts: dict) -> str:
+        """Submits a job without waiting for it and returns its job id."""
+        result = self.run_job(script, inputs, outputs, env_vars, disk_mounts,
+                              wait=False)
+        if result.returncode:
+            raise RuntimeError(
+                f'dsub failed: {result.stdout.decode(errors="replace")}')
+        # dsub prints the job id on the last line of its output.
+        return result.stdout.decode().strip().splitlines()[-1].strip()
+
+    def _task_statuses(self, job_id: str) -> Dict[Optional[str], str]:
+        """Returns RUNNING, SUCCESS or FAILURE for every task of a job.
+
+        Tasks are keyed by their dstat task id, None for a job submitted
+        without --tasks. Only the latest attempt of a task is considered.
+        """
+        # The status is only listed in the full dstat output.
+        result = subprocess.run(
+            [_DSTAT_BINARY_PATH] + self._provider_args() + [
+                '--jobs', job_id, '--status', '*', '--format', 'json',
+                '--full'],
+            stdout=subprocess.PIPE,
+            check=True
+        )
+        statuses = {}
+        attempts = {}
+        for task in json.loads(result.stdout):
+            task_id = task.get('task-id')
+            attempt = int(task.get('task-attempt') or 1)
+            if attempt >= attempts.get(task_id, 0):
+                attempts[task_id] = attempt
+                statuses[task_id] = _DSTAT_TO_SPECULATION_STATUS.get(
+                    task.get('status'), speculation.RUNNING)
+        return statuses
+
+    def check_job_status(self, job_id: str) -> str:
+        """Returns RUNNING, SUCCESS or FAILURE for a job."""
+        statuses = list(self._task_statuses(job_id).values())
+        if not statuses or speculation.RUNNING in statuses:
+            return speculation.RUNNING
+        if speculation.FAILURE in statuses:
+            return speculation.FAILURE
+        return speculation.SUCCESS
+
+    def cancel_job(self, job_id: str):
+        logging.info(f'Cancelling job {job_id}')
+        subprocess.run(
+            [_DDEL_BINARY_PATH] + self._provider_args() + ['--jobs', job_id],
+            stderr=subprocess.STDOUT,
+            stdout=subprocess.PIPE
+        )
+
+    def run_speculative_job(self,
+                            script: str,
+                            inputs: dict,
+                            outputs: dict,
+                            env_vars: dict,
+                            disk_mounts: dict,
+                            runtime_class: str,
+                            policy: speculation.SpeculationPolicy,
+                            history: Optional[speculation.RuntimeHistory]=None,
+                            decision_log_path: Optional[str]=None
+                            ) -> speculation.SpeculationResult:
+        """Runs a job, submitting duplicates if it straggles.
+
+        Duplicates run the same script with the same inputs and outputs,
+        plus a SPECULATIVE_ATTEMPT environment variable with the index of the
+        attempt. dsub uploads the outputs when a job ends, and the first
+        attempt to succeed cancels the others.
+        """
+
+        def submit(attempt: int) -> str:
+            return self.submit_job(
+                script, inputs, outputs,
+                {**env_vars, 'SPECULATIVE_ATTEMPT': attempt}, disk_mounts)
+
+        executor = speculation.SpeculativeExecutor(
+            submit=submit,
+            status=self.check_job_status,
+            cancel=self.cancel_job,
+            policy=policy,
+            history=history,
+            decision_log_path=decision_log_path)
+        return executor.run(runtime_class)
+
+    def submit_tasks(self,
+                     script: str,
+                     tasks: Sequence[DsubTask],
+                     tasks_path: str,
+                     env_vars: dict,
+                     disk_mounts: dict) -> str:
+        """Submits a batch of tasks as one job and returns its job id.
+
+        The per-task parameters are written to `tasks_path`, and the
+        parameters shared by all tasks are passed on the command line. Task
+        ids of the job are 1-based positions in `tasks`.
+        """
+        write_tasks_file(tasks, tasks_path)
+        env_vars = self._convert_to_parameter_list(env_vars, '--env')
+        disk_mounts = self._convert_to_parameter_list(disk_mounts, '--mount')
+        dsub_cmd = (self.base_cmd + ['--script', script, '--tasks', tasks_path]
+                    + env_vars + disk_mounts)
+
+        logging.info(f'Executing: {dsub_cmd}')
+        result = subprocess.run(
+            dsub_cmd,
+            stderr=subprocess.STDOUT,
+            stdout=subprocess.PIPE
+        )
+        if result.returncode:
+            raise RuntimeError(
+                f'dsub failed: {result.stdout.decode(errors="replace")}')
+        return result.stdout.decode().strip().splitlines()[-1].strip()
+
+    def check_task_statuses(self, job_id: str) -> Dict[int, str]:
+        """Returns RUNNING, SUCCESS or FAILURE for every task id of a job.
+
+        Tasks not listed yet are still being created.
+        """
+        return {int(task_id): status for task_id, status
+                in self._task_statuses(job_id).items() if task_id is not None}
+
+    def wait_for_tasks(self,
+                       job_id: str,
+                       num_tasks: int,
+                       poll_interval_seconds: float=30) -> Dict[int, str]:
+        """Waits for all tasks of a job to end and returns their statuses."""
+        while True:
+            statuses = self.check_task_statuses(job_id)
+            num_running = num_tasks - sum(
+                status != speculation.RUNNING for status in statuses.values())
+            if not num_running:
+                return statuses
+            logging.info(f'Job {job_id}: {num_running} of {num_tasks} tasks '
+                         'running')
+            time.sleep(poll_interval_seconds)
+
+    def run_tasks(self,
+                  script: str,
+                  tasks: Sequence[DsubTask],
+                  tasks_path: str,
+                  env_vars: dict,
+                  disk_mounts: dict,
+                  max_retries: int=0,
+                  poll_interval_seconds: float=30) -> List[TaskResult]:
+        """Runs a batch of tasks as one job, retrying the failed tasks.
+
+        Submitting one job with many tasks replaces a dsub process, a
+        submission and a status stream per target. Failed tasks are retried
+        up to `max_retries` times, each time as one job of all the tasks
+        that failed, with its tasks file next to `tasks_path`.
+
+        Returns:
+          The result of every task, in the order of `tasks`. The outputs of
+          a task are only listed if it succeeded.
+        """
+        results = [TaskResult(speculation.FAILURE, {}, []) for _ in tasks]
+        pending = list(range(len(tasks)))
+        for attempt in range(max_retries + 1):
+            attempt_path = (tasks_path if not attempt
+                            else f'{tasks_path}.retry{attempt}')
+            job_id = self.submit_tasks(
+                script, [tasks[i] for i in pending], attempt_path, env_vars,
+                disk_mounts)
+            statuses = self.wait_for_tasks(job_id, len(pending),
+                                           poll_interval_seconds)
+            failed = []
+            for task_id, index in enumerate(pending, start=1):
+                results[index].job_ids.append(job_id)
+                if statuses.get(task_id) == speculation.SUCCESS:
+                    results[index].status = speculation.SUCCESS
+                    results[index].outputs = dict(tasks[index].outputs)
+                else:
+                    failed.append(index)
+            logging.info(f'Job {job_id}: {len(pending) - len(failed)} of '
+                         f'{len(pending)} tasks succeeded')
+            pending = failed
+            if not pending:
+                break
+        if pending:
+            logging.warning(f'{len(pending)} of {len(tasks)} tasks failed: '
+                            f'{pending}')
+        return results
 
     def retrieve_logs(self, job_id: str):
         pass
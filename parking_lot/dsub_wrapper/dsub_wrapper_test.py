@@ -0,0 +1,219 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the batch and status methods of DsubJob.
+
+The batch API is run against stub dsub and dstat binaries that read the
+tasks file and report task statuses the way dstat does: the status is only
+listed with --full, and tasks are listed once they have been created. If
+dsub and docker are installed, a batch is also run with dsub's local
+provider.
+"""
+
+
+import os
+import shutil
+import stat
+import sys
+import textwrap
+
+from unittest import mock
+
+from absl.testing import absltest
+
+import dsub_wrapper
+import speculation
+
+_STUB_DSUB = '''
+import csv, json, os, sys
+
+args = sys.argv[1:]
+state_path = os.environ['STUB_STATE']
+state = {'jobs': {}, 'attempts': {}}
+if os.path.exists(state_path):
+    with open(state_path) as f:
+        state = json.load(f)
+if '--tasks' in args:
+    with open(args[args.index('--tasks') + 1]) as f:
+        rows = list(csv.DictReader(f, delimiter='\\t'))
+    tasks = {str(i): row for i, row in enumerate(rows, start=1)}
+else:
+    envs = dict(args[i + 1].split('=', 1)
+                for i, arg in enumerate(args) if arg == '--env')
+    tasks = {None: {'--env ' + k: v for k, v in envs.items()}}
+statuses = {}
+for task_id, row in tasks.items():
+    target = row['--env TARGET']
+    attempt = state['attempts'].get(target, 0)
+    state['attempts'][target] = attempt + 1
+    failed = attempt < int(row['--env FAILURES'])
+    statuses[str(task_id)] = 'FAILURE' if failed else 'SUCCESS'
+job_id = 'job-%d' % len(state['jobs'])
+state['jobs'][job_id] = {'statuses': statuses, 'polls': 0}
+with open(state_path, 'w') as f:
+    json.dump(state, f)
+print('Launched job-id: ' + job_id)
+print(job_id)
+'''
+
+_STUB_DSTAT = '''
+import json, os, sys
+
+args = sys.argv[1:]
+state_path = os.environ['STUB_STATE']
+with open(state_path) as f:
+    state = json.load(f)
+job_id = args[args.index('--jobs') + 1]
+job = state['jobs'][job_id]
+job['polls'] += 1
+with open(state_path, 'w') as f:
+    json.dump(state, f)
+rows = []
+# The first poll lists only the first task, still running.
+for task_id, status in list(job['statuses'].items())[:1 if job['polls'] == 1
+                                                       else None]:
+    row = {'job-name': 'stub', 'last-update': '', 'status-message': ''}
+    if task_id != 'None':
+        row['task-id'] = task_id
+    if '--full' in args:
+        row.update({'job-id': job_id,
+                    'status': 'RUNNING' if job['polls'] == 1 else status})
+    rows.append(row)
+print(json.dumps(rows))
+'''
+
+
+def _write_stub(path: str, source: str) -> str:
+    with open(path, 'w') as f:
+        f.write(f'#!{sys.executable}\n{textwrap.dedent(source)}')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def _make_tasks(failures):
+    return [dsub_wrapper.DsubTask(
+                inputs={'INPUT_PATH': f'gs://bucket/inputs/t{i}.fasta'},
+                outputs={'OUTPUT_PATH': f'gs://bucket/outputs/t{i}.a3m'},
+                env_vars={'TARGET': f't{i}', 'FAILURES': str(n)})
+            for i, n in enumerate(failures)]
+
+
+class DsubJobStubTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = self.create_tempdir().full_path
+        dsub = _write_stub(os.path.join(self.tmp_dir, 'dsub'), _STUB_DSUB)
+        dstat = _write_stub(os.path.join(self.tmp_dir, 'dstat'), _STUB_DSTAT)
+        self.enter_context(mock.patch.dict(
+            os.environ, {'STUB_STATE': os.path.join(self.tmp_dir,
+                                                    'state.json')}))
+        self.enter_context(mock.patch.object(
+            dsub_wrapper, '_DSTAT_BINARY_PATH', dstat))
+        self.job = dsub_wrapper.DsubJob(
+            project='project', region='us-central1', image='image',
+            logging='gs://bucket/logs', machine_type='n1-standard-4',
+            binary_path=dsub)
+        self.tasks_path = os.path.join(self.tmp_dir, 'tasks.tsv')
+
+    def test_write_tasks_file(self):
+        tasks = _make_tasks([0, 1])
+        dsub_wrapper.write_tasks_file(tasks, self.tasks_path)
+        with open(self.tasks_path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, [
+            '--env TARGET\t--env FAILURES\t--input INPUT_PATH\t'
+            '--output OUTPUT_PATH',
+            't0\t0\tgs://bucket/inputs/t0.fasta\tgs://bucket/outputs/t0.a3m',
+            't1\t1\tgs://bucket/inputs/t1.fasta\tgs://bucket/outputs/t1.a3m',
+        ])
+
+        mismatched = dsub_wrapper.DsubTask(
+            inputs={'OTHER': 'a'}, outputs=tasks[0].outputs,
+            env_vars=tasks[0].env_vars)
+        with self.assertRaises(ValueError):
+            dsub_wrapper.write_tasks_file([tasks[0], mismatched],
+                                          self.tasks_path)
+
+    def test_check_task_statuses(self):
+        job_id = self.job.submit_tasks('run.sh', _make_tasks([0, 1, 0]),
+                                       self.tasks_path, {}, {})
+        self.assertEqual(self.job.check_task_statuses(job_id),
+                         {1: speculation.RUNNING})
+        self.assertEqual(self.job.check_task_statuses(job_id), {
+            1: speculation.SUCCESS,
+            2: speculation.FAILURE,
+            3: speculation.SUCCESS,
+        })
+
+    def test_check_job_status_without_tasks(self):
+        job_id = self.job.submit_job('run.sh', {}, {},
+                                     {'TARGET': 't0', 'FAILURES': 0}, {})
+        self.assertEqual(self.job.check_job_status(job_id),
+                         speculation.RUNNING)
+        self.assertEqual(self.job.check_job_status(job_id),
+                         speculation.SUCCESS)
+
+    def test_run_tasks_retries_failed_tasks(self):
+        tasks = _make_tasks([0, 1, 0, 2, 5])
+        results = self.job.run_tasks('run.sh', tasks, self.tasks_path, {}, {},
+                                     max_retries=2, poll_interval_seconds=0)
+
+        self.assertEqual([r.status for r in results], [speculation.SUCCESS] * 4
+                         + [speculation.FAILURE])
+        self.assertEqual([r.job_ids for r in results], [
+            ['job-0'],
+            ['job-0', 'job-1'],
+            ['job-0'],
+            ['job-0', 'job-1', 'job-2'],
+            ['job-0', 'job-1', 'job-2'],
+        ])
+        self.assertEqual(results[1].outputs, tasks[1].outputs)
+        self.assertEqual(results[4].outputs, {})
+        # Retries only run the tasks that failed.
+        with open(f'{self.tasks_path}.retry2') as f:
+            self.assertLen(f.read().splitlines(), 3)
+
+
+@absltest.skipUnless(shutil.which('dsub') and shutil.which('docker'),
+                     'Requires dsub and docker.')
+class DsubJobLocalProviderTest(absltest.TestCase):
+
+    def test_run_tasks(self):
+        tmp_dir = self.create_tempdir().full_path
+        script = os.path.join(tmp_dir, 'run.sh')
+        with open(script, 'w') as f:
+            f.write('#!/bin/bash\necho "${TARGET}" > "${OUTPUT_PATH}"\n')
+        tasks = [dsub_wrapper.DsubTask(
+                     inputs={},
+                     outputs={'OUTPUT_PATH': os.path.join(tmp_dir, f't{i}')},
+                     env_vars={'TARGET': f't{i}'})
+                 for i in range(3)]
+        job = dsub_wrapper.DsubJob(
+            project='project', region='us-central1', image='ubuntu:22.04',
+            logging=os.path.join(tmp_dir, 'logs') + '/',
+            machine_type='n1-standard-1', provider='local')
+
+        results = job.run_tasks(script, tasks,
+                                os.path.join(tmp_dir, 'tasks.tsv'), {}, {},
+                                poll_interval_seconds=1)
+
+        self.assertEqual([r.status for r in results],
+                         [speculation.SUCCESS] * 3)
+        for i, result in enumerate(results):
+            with open(result.outputs['OUTPUT_PATH']) as f:
+                self.assertEqual(f.read(), f't{i}\n')
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,97 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Reports the metrics of a dsub job in KFP components.
+
+Runners write their metrics (see `runner_metrics` in the pipelines
+directory) to a JSON file uploaded next to their output. The component that
+submitted the job adds the time the job waited for a VM and reports the
+metrics both as a KFP `Metrics` artifact, which the Vertex AI UI shows and
+compares across runs, and as metadata of the output artifacts.
+"""
+
+
+import json
+import logging
+import os
+
+from typing import Any, Dict, Optional, Sequence
+
+from step_cache import to_local_path
+
+# Metrics reported by the components, in the order shown in the UI.
+REPORTED_METRICS = (
+    'queue_seconds',
+    'boot_to_start_seconds',
+    'job_seconds',
+    'wall_seconds',
+    'staging_seconds',
+    'warmup_seconds',
+    'tool_seconds',
+    'featurize_seconds',
+    'write_seconds',
+    'cpu_seconds',
+    'tool_cpu_seconds',
+    'peak_rss_bytes',
+    'tool_peak_rss_bytes',
+    'num_cpus',
+    'memory_bytes',
+    'output_num_sequences',
+    'output_bytes',
+)
+
+
+def metrics_path(output_uri: str) -> str:
+    """The path the runner writing `output_uri` writes its metrics to."""
+    return f'{output_uri}.metrics.json'
+
+
+def read_job_metrics(output_uri: str,
+                     submit_time: float,
+                     end_time: float) -> Dict[str, Any]:
+    """Reads the metrics of a runner and adds the queue and job times.
+
+    Args:
+      output_uri: URI of the output of the runner.
+      submit_time: Time the job was submitted, in seconds since the epoch.
+      end_time: Time the job finished, in seconds since the epoch.
+
+    Returns:
+      The metrics. Only the job time is known if the runner did not write
+      its metrics.
+    """
+    metrics = {'job_seconds': end_time - submit_time}
+    path = to_local_path(metrics_path(output_uri))
+    if not os.path.exists(path):
+        logging.warning(f'No runner metrics at {path}.')
+        return metrics
+    with open(path) as f:
+        metrics.update(json.load(f))
+    # The VM boots after the job leaves the queue.
+    metrics['queue_seconds'] = max(0.0, metrics['boot_time'] - submit_time)
+    return metrics
+
+
+def log_job_metrics(kfp_metrics,
+                    job_metrics: Dict[str, Any],
+                    artifacts: Sequence[Any] = (),
+                    extra_metadata: Optional[Dict[str, Any]] = None):
+    """Logs metrics to a KFP Metrics artifact and the metadata of artifacts."""
+    reported = {name: job_metrics[name] for name in REPORTED_METRICS
+                if name in job_metrics}
+    for name, value in reported.items():
+        kfp_metrics.log_metric(name, float(value))
+    for artifact in artifacts:
+        artifact.metadata.update(reported)
+        artifact.metadata.update(extra_metadata or {})
+    logging.info(f'Job metrics: {reported}')
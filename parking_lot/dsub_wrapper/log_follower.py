@@ -0,0 +1,184 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Follows a growing log file and forwards new lines as they appear.
+
+dsub uploads the whole log of a job every `--log-interval`, so a log object
+keeps growing while the job runs. The follower remembers how many bytes it
+has forwarded and the version of the object it last saw (the generation of
+a Cloud Storage object, or the modification time of a local file), reads
+only the bytes past that offset when the version changes, and writes the
+complete new lines to stdout. It polls at least every `max_interval`
+seconds, so new lines are forwarded with bounded latency, and drains the log
+one last time when it is stopped.
+"""
+
+
+import logging
+import os
+import sys
+import threading
+
+from typing import IO, Optional, Tuple
+
+_GCS_PREFIX = 'gs://'
+
+
+class FileSource(object):
+    """A local file, or a Cloud Storage object read through a FUSE mount."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def stat(self) -> Optional[Tuple[int, int]]:
+        """Returns the (version, size) of the log, or None if it is missing."""
+        try:
+            with open(self.path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def read(self, version: int, start: int, end: int) -> bytes:
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+class GcsSource(object):
+    """A Cloud Storage object, read with ranged downloads."""
+
+    def __init__(self, uri: str, client=None):
+        from google.cloud import storage
+
+        bucket_name, _, self.blob_name = uri[len(_GCS_PREFIX):].partition('/')
+        self.bucket = (client or storage.Client()).bucket(bucket_name)
+
+    def stat(self) -> Optional[Tuple[int, int]]:
+        blob = self.bucket.get_blob(self.blob_name)
+        if blob is None:
+            return None
+        return blob.generation, blob.size
+
+    def read(self, version: int, start: int, end: int) -> bytes:
+        # Pinning the generation keeps the range consistent with the size
+        # even if the object is rewritten in the meantime.
+        blob = self.bucket.blob(self.blob_name, generation=version)
+        return blob.download_as_bytes(start=start, end=end - 1)
+
+
+def make_source(uri: str):
+    """Returns the source of a gs:// URI or a local path."""
+    if uri.startswith(_GCS_PREFIX):
+        return GcsSource(uri)
+    return FileSource(uri)
+
+
+class LogFollower(object):
+    """Forwards the new lines of a log in a background thread."""
+
+    def __init__(self,
+                 source,
+                 out: IO[str] = sys.stdout,
+                 min_interval: float = 1.0,
+                 max_interval: float = 30.0,
+                 prefix: str = ''):
+        """Initializes the follower.
+
+        Args:
+          source: The log, a `FileSource` or a `GcsSource`.
+          out: Stream the new lines are written to.
+          min_interval: Seconds between polls while the log is growing.
+          max_interval: Maximum seconds between polls. The interval doubles
+            from `min_interval` while the log does not change.
+          prefix: Prepended to every forwarded line.
+        """
+        self.source = source
+        self.out = out
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.prefix = prefix
+        self.offset = 0
+        self._version = None
+        self._partial_line = b''
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _write(self, data: bytes):
+        for line in data.decode(errors='replace').splitlines(keepends=True):
+            self.out.write(self.prefix + line)
+        self.out.flush()
+
+    def poll(self) -> int:
+        """Forwards the complete lines written since the last poll.
+
+        Returns:
+          The number of new bytes read.
+        """
+        stat = self.source.stat()
+        if stat is None:
+            return 0
+        version, size = stat
+        if version == self._version and size == self.offset:
+            return 0
+        if size < self.offset:
+            logging.warning(
+                f'The log shrank from {self.offset} to {size} bytes, '
+                'following it from the start.')
+            self.offset = 0
+            self._partial_line = b''
+        self._version = version
+        if size == self.offset:
+            return 0
+        new_data = self.source.read(version, self.offset, size)
+        self.offset += len(new_data)
+        data = self._partial_line + new_data
+        end = data.rfind(b'\n') + 1
+        self._partial_line = data[end:]
+        if end:
+            self._write(data[:end])
+        return len(new_data)
+
+    def _run(self):
+        interval = self.min_interval
+        while not self._stop.wait(interval):
+            try:
+                new_bytes = self.poll()
+            except Exception as e:  # pylint: disable=broad-except
+                # A transient error must not stop the job from being waited
+                # for, the next poll retries.
+                logging.warning(f'Failed to read the log: {e}')
+                new_bytes = 0
+            if new_bytes:
+                interval = self.min_interval
+            else:
+                interval = min(2 * interval, self.max_interval)
+
+    def start(self) -> 'LogFollower':
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, drain: bool = True):
+        """Stops following, after forwarding what is left in the log."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if drain:
+            try:
+                self.poll()
+            except Exception as e:  # pylint: disable=broad-except
+                logging.warning(f'Failed to read the log: {e}')
+        if self._partial_line:
+            self._write(self._partial_line + b'\n')
+            self._partial_line = b''
@@ -0,0 +1,102 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for LogFollower, following a local file that is appended to."""
+
+
+import io
+import os
+import time
+
+from absl.testing import absltest
+
+import log_follower
+
+
+class LogFollowerTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.create_tempdir().full_path, 'job.log')
+        self.out = io.StringIO()
+        self.follower = log_follower.LogFollower(
+            log_follower.FileSource(self.path), out=self.out,
+            min_interval=0.01, max_interval=0.05)
+
+    def _append(self, data: str):
+        with open(self.path, 'a') as f:
+            f.write(data)
+
+    def test_missing_log(self):
+        self.assertEqual(self.follower.poll(), 0)
+        self.assertEqual(self.follower.offset, 0)
+        self.assertEqual(self.out.getvalue(), '')
+
+    def test_forwards_complete_lines(self):
+        self._append('first\nsec')
+        self.assertEqual(self.follower.poll(), 9)
+        self.assertEqual(self.follower.offset, 9)
+        self.assertEqual(self.out.getvalue(), 'first\n')
+
+        # Nothing new.
+        self.assertEqual(self.follower.poll(), 0)
+        self.assertEqual(self.follower.offset, 9)
+
+        self._append('ond\nthird\n')
+        self.assertEqual(self.follower.poll(), 10)
+        self.assertEqual(self.follower.offset, 19)
+        self.assertEqual(self.out.getvalue(), 'first\nsecond\nthird\n')
+
+    def test_stop_forwards_partial_last_line(self):
+        self._append('done\nno newline')
+        self.follower.poll()
+        self.assertEqual(self.out.getvalue(), 'done\n')
+        self._append(' yet')
+        self.follower.stop()
+        self.assertEqual(self.follower.offset, 19)
+        self.assertEqual(self.out.getvalue(), 'done\nno newline yet\n')
+
+    def test_restarts_when_log_shrinks(self):
+        self._append('old line one\nold partial')
+        self.follower.poll()
+        with open(self.path, 'w') as f:
+            f.write('new\n')
+        self.assertEqual(self.follower.poll(), 4)
+        self.assertEqual(self.follower.offset, 4)
+        # The partial line of the old log is dropped.
+        self.assertEqual(self.out.getvalue(), 'old line one\nnew\n')
+
+        self._append('more\n')
+        self.follower.poll()
+        self.assertEqual(self.follower.offset, 9)
+        self.assertEqual(self.out.getvalue(), 'old line one\nnew\nmore\n')
+
+    def test_follows_in_background(self):
+        self.follower.prefix = '[job] '
+        self.follower.start()
+        expected = ''
+        for i in range(3):
+            self._append(f'line {i}\n')
+            expected += f'[job] line {i}\n'
+            deadline = time.time() + 5
+            while self.out.getvalue() != expected and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.out.getvalue(), expected)
+        self._append('last')
+        self.follower.stop()
+        self.assertEqual(self.follower.offset, 25)
+        self.assertEqual(self.out.getvalue(), expected + '[job] last\n')
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,235 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Speculative execution of straggling jobs.
+
+In a fan-out of many searches a few jobs land on slow or degraded VMs and
+take several times longer than their peers. The executor compares the
+elapsed time of a job with a percentile of the runtimes of earlier jobs of
+the same class, a tool and a bucket of sequence lengths, and once a job is
+slower than that by a configurable factor it submits a duplicate. The first
+attempt to succeed wins and the others are cancelled. The searches are
+deterministic, so all attempts write the same outputs.
+
+Runtimes are kept in a JSON history file, so thresholds improve across runs,
+and every decision is logged and can be appended to a JSON lines file.
+"""
+
+
+import dataclasses
+import json
+import logging
+import os
+import time
+
+from typing import Any, Callable, Dict, List, Optional
+
+from step_cache import to_local_path
+
+RUNNING = 'RUNNING'
+SUCCESS = 'SUCCESS'
+FAILURE = 'FAILURE'
+
+
+class JobFailedError(RuntimeError):
+    """Raised when all attempts of a job failed."""
+
+
+@dataclasses.dataclass(frozen=True)
+class SpeculationPolicy:
+    """When to submit duplicates of a job.
+
+    Attributes:
+      percentile: Percentile of the runtimes of the class of a job that is
+        its expected runtime.
+      slowdown: A duplicate is submitted once the latest attempt has run for
+        `slowdown` times the expected runtime.
+      min_history: Number of runtimes of a class needed before its
+        percentile is used.
+      default_threshold_seconds: Runtime after which a duplicate is submitted
+        while the history of the class is too short. None disables
+        speculation for such classes.
+      max_duplicates: Maximum number of duplicates of a job.
+      poll_interval_seconds: Seconds between polls of the job status.
+    """
+    percentile: float = 90.0
+    slowdown: float = 1.5
+    min_history: int = 10
+    default_threshold_seconds: Optional[float] = None
+    max_duplicates: int = 1
+    poll_interval_seconds: float = 30.0
+
+
+def runtime_class(tool: str, sequence_length: int,
+                  bucket_size: int = 200) -> str:
+    """The class of a job whose runtimes are compared, e.g. `hhblits/400`."""
+    return f'{tool}/{sequence_length // bucket_size * bucket_size}'
+
+
+class RuntimeHistory(object):
+    """Runtimes of successful jobs per class, stored in a JSON file."""
+
+    def __init__(self, path: Optional[str] = None, max_samples: int = 500):
+        """Initializes the history.
+
+        Args:
+          path: JSON file the runtimes are loaded from and saved to, a local
+            path or a gs:// URI. None keeps the history in memory.
+          max_samples: Number of most recent runtimes kept per class.
+        """
+        self.path = to_local_path(path) if path else None
+        self.max_samples = max_samples
+        self.runtimes: Dict[str, List[float]] = {}
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                self.runtimes = json.load(f)
+
+    def add(self, key: str, seconds: float):
+        samples = self.runtimes.setdefault(key, [])
+        samples.append(seconds)
+        del samples[:-self.max_samples]
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.runtimes, f)
+            os.replace(tmp_path, self.path)
+
+    def threshold(self, key: str, policy: SpeculationPolicy) -> Optional[float]:
+        """Seconds after which an attempt of class `key` is a straggler."""
+        samples = sorted(self.runtimes.get(key, []))
+        if len(samples) < policy.min_history:
+            return policy.default_threshold_seconds
+        # Nearest-rank percentile.
+        rank = max(0, -(-len(samples) * policy.percentile // 100) - 1)
+        return policy.slowdown * samples[int(rank)]
+
+
+@dataclasses.dataclass
+class _Attempt:
+    index: int
+    handle: Any
+    submit_time: float
+
+
+@dataclasses.dataclass
+class SpeculationResult:
+    """The winning attempt of a job and the decisions taken."""
+    attempt: int
+    handle: Any
+    seconds: float
+    decisions: List[Dict[str, Any]]
+
+
+class SpeculativeExecutor(object):
+    """Runs jobs, submitting duplicates of stragglers."""
+
+    def __init__(self,
+                 submit: Callable[[int], Any],
+                 status: Callable[[Any], str],
+                 cancel: Callable[[Any], None],
+                 policy: SpeculationPolicy = SpeculationPolicy(),
+                 history: Optional[RuntimeHistory] = None,
+                 decision_log_path: Optional[str] = None,
+                 clock: Callable[[], float] = time.time,
+                 sleep: Callable[[float], None] = time.sleep):
+        """Initializes the executor.
+
+        Args:
+          submit: Submits an attempt of the job, given its index, and returns
+            a handle of it. Attempt 0 is the original job.
+          status: Returns RUNNING, SUCCESS or FAILURE for a handle.
+          cancel: Cancels an attempt given its handle.
+          policy: When to submit duplicates.
+          history: Runtimes of earlier jobs. Defaults to an empty history.
+          decision_log_path: JSON lines file every decision is appended to,
+            a local path or a gs:// URI.
+          clock: Returns the current time in seconds.
+          sleep: Waits for some seconds.
+        """
+        self.submit = submit
+        self.status = status
+        self.cancel = cancel
+        self.policy = policy
+        self.history = history or RuntimeHistory()
+        self.decision_log_path = (
+            to_local_path(decision_log_path) if decision_log_path else None)
+        self.clock = clock
+        self.sleep = sleep
+
+    def _decide(self, decisions: List[Dict[str, Any]], key: str,
+                decision: str, attempt: _Attempt, **details):
+        record = {
+            'time': self.clock(),
+            'runtime_class': key,
+            'decision': decision,
+            'attempt': attempt.index,
+            'handle': str(attempt.handle),
+            **details,
+        }
+        decisions.append(record)
+        logging.info(f'Speculation: {record}')
+        if self.decision_log_path:
+            with open(self.decision_log_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def _submit(self, index: int) -> _Attempt:
+        return _Attempt(index, self.submit(index), self.clock())
+
+    def run(self, key: str) -> SpeculationResult:
+        """Runs a job of class `key` until an attempt succeeds.
+
+        Raises:
+          JobFailedError: If all attempts failed.
+        """
+        decisions = []
+        threshold = self.history.threshold(key, self.policy)
+        running = [self._submit(0)]
+        self._decide(decisions, key, 'submitted', running[0],
+                     threshold_seconds=threshold)
+        num_attempts = 1
+        while True:
+            for attempt in list(running):
+                status = self.status(attempt.handle)
+                if status == SUCCESS:
+                    seconds = self.clock() - attempt.submit_time
+                    self._decide(decisions, key, 'won', attempt,
+                                 seconds=seconds)
+                    for loser in running:
+                        if loser is not attempt:
+                            self.cancel(loser.handle)
+                            self._decide(decisions, key, 'cancelled', loser,
+                                         seconds=self.clock() - loser.submit_time)
+                    self.history.add(key, seconds)
+                    return SpeculationResult(attempt.index, attempt.handle,
+                                             seconds, decisions)
+                if status == FAILURE:
+                    running.remove(attempt)
+                    self._decide(decisions, key, 'failed', attempt)
+            if not running:
+                raise JobFailedError(
+                    f'All {num_attempts} attempts of the {key} job failed.')
+
+            # Only the latest attempt is compared with the threshold, so
+            # duplicates are spaced by at least the threshold.
+            elapsed = self.clock() - running[-1].submit_time
+            if (threshold is not None and
+                    num_attempts <= self.policy.max_duplicates and
+                    elapsed > threshold):
+                duplicate = self._submit(num_attempts)
+                running.append(duplicate)
+                num_attempts += 1
+                self._decide(decisions, key, 'speculated', duplicate,
+                             elapsed_seconds=elapsed,
+                             threshold_seconds=threshold)
+            self.sleep(self.policy.poll_interval_seconds)
@@ -0,0 +1,168 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A content-addressed cache of pipeline step outputs.
+
+Cache keys are computed from what a step actually depends on (the sequence
+residues, the databases, the tool and its settings) rather than from the
+URIs of the input artifacts, so resubmitting the same sequence from another
+bucket path reuses the results of a previous run.
+
+Entries are stored under `<cache_root>/<step>/<key>/`, one file per output
+plus a `metadata.json` file that marks the entry as complete. An entry is
+written to a temporary sibling directory and renamed into place, so a
+concurrent lookup never reads a file that is still being written, and the
+first of several concurrent writers of a key wins. The cache root is a
+local directory or a `gs://` prefix, which is accessed through the Cloud
+Storage FUSE mount at `/gcs/` available to Vertex AI Pipelines components.
+"""
+
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+
+from typing import Dict, Optional
+
+_GCS_PREFIX = 'gs://'
+_GCS_FUSE_ROOT = '/gcs/'
+_METADATA_FILE = 'metadata.json'
+_CHUNK_SIZE = 1 << 20
+
+
+def to_local_path(path: str) -> str:
+    """Maps a gs:// URI to its Cloud Storage FUSE path."""
+    if path.startswith(_GCS_PREFIX):
+        return _GCS_FUSE_ROOT + path[len(_GCS_PREFIX):]
+    return path
+
+
+def file_digest(path: str) -> str:
+    """Returns the SHA-256 digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(to_local_path(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sequence_digest(fasta_path: str) -> str:
+    """Returns the SHA-256 digest of the residues in a FASTA file.
+
+    Descriptions, line breaks and case are ignored, so the same sequence
+    gets the same digest whatever file it comes from.
+    """
+    digest = hashlib.sha256()
+    with open(to_local_path(fasta_path)) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                digest.update(b'>')
+            else:
+                digest.update(line.upper().encode())
+    return digest.hexdigest()
+
+
+def make_cache_key(**fields) -> str:
+    """Returns a key for the given JSON-serializable fields."""
+    canonical = json.dumps(fields, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class StepCache(object):
+
+    def __init__(self, cache_root: str):
+        self.cache_root = to_local_path(cache_root)
+
+    def _entry_dir(self, step: str, key: str) -> str:
+        return os.path.join(self.cache_root, step, key)
+
+    def lookup(self,
+               step: str,
+               key: str,
+               outputs: Dict[str, str]) -> Optional[dict]:
+        """Copies the cached outputs of a step if present.
+
+        Args:
+            step: Name of the step.
+            key: Cache key of the step.
+            outputs: Maps output names to the paths to copy them to.
+
+        Returns:
+            The metadata of every output on a hit, None on a miss.
+        """
+        entry_dir = self._entry_dir(step, key)
+        metadata_path = os.path.join(entry_dir, _METADATA_FILE)
+        if not os.path.exists(metadata_path):
+            logging.info(f'Cache miss for {step} {key}')
+            return None
+
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        for name, path in outputs.items():
+            path = to_local_path(path)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            shutil.copyfile(os.path.join(entry_dir, name), path)
+        logging.info(f'Cache hit for {step} {key}')
+        return metadata
+
+    def store(self,
+              step: str,
+              key: str,
+              outputs: Dict[str, str],
+              metadata: Dict[str, dict]):
+        """Stores the outputs of a step.
+
+        Args:
+            step: Name of the step.
+            key: Cache key of the step.
+            outputs: Maps output names to the paths of the produced files.
+            metadata: Maps output names to their artifact metadata.
+        """
+        entry_dir = self._entry_dir(step, key)
+        missing = [path for path in outputs.values()
+                   if not os.path.exists(to_local_path(path))]
+        if missing:
+            logging.warning(f'Not caching {step} {key}, missing outputs: {missing}')
+            return
+
+        if os.path.exists(os.path.join(entry_dir, _METADATA_FILE)):
+            logging.info(f'{step} {key} is already cached')
+            return
+
+        tmp_dir = f'{entry_dir}.tmp-{uuid.uuid4().hex}'
+        try:
+            os.makedirs(tmp_dir)
+            for name, path in outputs.items():
+                shutil.copyfile(to_local_path(path),
+                                os.path.join(tmp_dir, name))
+            with open(os.path.join(tmp_dir, _METADATA_FILE), 'w') as f:
+                json.dump(metadata, f)
+            if os.path.isdir(entry_dir) and not os.path.exists(
+                    os.path.join(entry_dir, _METADATA_FILE)):
+                # An incomplete entry, written in place by an older version.
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            try:
+                os.replace(tmp_dir, entry_dir)
+            except OSError:
+                # Another writer stored the entry first.
+                if not os.path.exists(os.path.join(entry_dir, _METADATA_FILE)):
+                    raise
+                logging.info(f'{step} {key} was cached concurrently')
+                return
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logging.info(f'Cached {step} {key}')
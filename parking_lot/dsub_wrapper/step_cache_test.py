@@ -0,0 +1,155 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for StepCache, with a local directory as the cache root."""
+
+
+import concurrent.futures
+import os
+import shutil
+
+from unittest import mock
+
+from absl.testing import absltest
+
+import step_cache
+
+
+class CacheKeyTest(absltest.TestCase):
+
+    def _write(self, content: str) -> str:
+        return self.create_tempfile(content=content).full_path
+
+    def test_sequence_digest_ignores_descriptions_and_wrapping(self):
+        digest = step_cache.sequence_digest(self._write('>query\nMKVLA\n'))
+        for fasta in ('>other description\nMKVLA\n',
+                      '>query\nMKV\nLA\n',
+                      '>query\r\nmkvla\r\n',
+                      '>query\nMKVLA'):
+            self.assertEqual(step_cache.sequence_digest(self._write(fasta)),
+                             digest, fasta)
+        self.assertNotEqual(
+            step_cache.sequence_digest(self._write('>query\nMKVLG\n')), digest)
+
+    def test_make_cache_key(self):
+        key = step_cache.make_cache_key(step='msa_search', tool='jackhmmer',
+                                        databases=['uniref90'])
+        self.assertEqual(
+            step_cache.make_cache_key(databases=['uniref90'],
+                                      tool='jackhmmer', step='msa_search'),
+            key)
+        self.assertNotEqual(
+            step_cache.make_cache_key(step='msa_search', tool='hhblits',
+                                      databases=['uniref90']),
+            key)
+
+
+class StepCacheTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = self.create_tempdir().full_path
+        self.cache = step_cache.StepCache(os.path.join(self.tmp_dir, 'cache'))
+        self.output_path = os.path.join(self.tmp_dir, 'outputs', 'msa')
+        os.makedirs(os.path.dirname(self.output_path))
+        with open(self.output_path, 'w') as f:
+            f.write('>query\nMKV\n')
+
+    def _lookup(self, key='key'):
+        restored = os.path.join(self.tmp_dir, 'restored', key, 'msa')
+        metadata = self.cache.lookup('msa_search', key, {'msa': restored})
+        return metadata, restored
+
+    def test_miss_then_hit(self):
+        metadata, restored = self._lookup()
+        self.assertIsNone(metadata)
+        self.assertFalse(os.path.exists(restored))
+
+        self.cache.store('msa_search', 'key', {'msa': self.output_path},
+                         {'msa': {'data_format': 'sto'}})
+        metadata, restored = self._lookup()
+        self.assertEqual(metadata, {'msa': {'data_format': 'sto'}})
+        with open(restored) as f:
+            self.assertEqual(f.read(), '>query\nMKV\n')
+        # Only the entry is left in the step directory.
+        self.assertEqual(
+            os.listdir(os.path.join(self.tmp_dir, 'cache', 'msa_search')),
+            ['key'])
+
+    def test_missing_outputs_are_not_cached(self):
+        self.cache.store('msa_search', 'key',
+                         {'msa': os.path.join(self.tmp_dir, 'missing')}, {})
+        self.assertIsNone(self._lookup()[0])
+
+    def test_first_writer_wins(self):
+        self.cache.store('msa_search', 'key', {'msa': self.output_path},
+                         {'msa': {'writer': 1}})
+        self.cache.store('msa_search', 'key', {'msa': self.output_path},
+                         {'msa': {'writer': 2}})
+        self.assertEqual(self._lookup()[0], {'msa': {'writer': 1}})
+
+    def test_incomplete_entry_is_replaced(self):
+        entry_dir = os.path.join(self.tmp_dir, 'cache', 'msa_search', 'key')
+        os.makedirs(entry_dir)
+        with open(os.path.join(entry_dir, 'msa'), 'w') as f:
+            f.write('partial')
+        self.assertIsNone(self._lookup()[0])
+
+        self.cache.store('msa_search', 'key', {'msa': self.output_path}, {})
+        metadata, restored = self._lookup()
+        self.assertEqual(metadata, {})
+        with open(restored) as f:
+            self.assertEqual(f.read(), '>query\nMKV\n')
+
+    def test_entry_appears_complete(self):
+        # Lookups while an entry is being copied see a miss, not a partial
+        # entry.
+        lookups = []
+        copyfile = shutil.copyfile
+
+        def copy_and_look_up(source, target):
+            lookups.append(self._lookup()[0])
+            return copyfile(source, target)
+
+        with mock.patch.object(shutil, 'copyfile', copy_and_look_up):
+            self.cache.store('msa_search', 'key', {'msa': self.output_path},
+                             {'msa': {}})
+        self.assertEqual(lookups, [None])
+        self.assertEqual(self._lookup()[0], {'msa': {}})
+
+    def test_concurrent_stores(self):
+        outputs = []
+        for i in range(8):
+            path = os.path.join(self.tmp_dir, 'outputs', f'msa{i}')
+            with open(path, 'w') as f:
+                f.write(f'>query\nMKV{i}\n')
+            outputs.append(path)
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(
+                lambda i: self.cache.store('msa_search', 'key',
+                                           {'msa': outputs[i]},
+                                           {'msa': {'writer': i}}),
+                range(8)))
+
+        metadata, restored = self._lookup()
+        with open(restored) as f:
+            self.assertEqual(f.read(),
+                             f'>query\nMKV{metadata["msa"]["writer"]}\n')
+        self.assertEqual(
+            os.listdir(os.path.join(self.tmp_dir, 'cache', 'msa_search')),
+            ['key'])
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -15,7 +15,7 @@
 
 import os
 from kfp.v2 import dsl
-from kfp.v2.dsl import Output, Input, Artifact, Dataset
+from kfp.v2.dsl import Output, Input, Artifact, Dataset, Metrics
 
 
 _COMPONENTS_IMAGE = os.getenv('COMPONENTS_IMAGE', 'gcr.io/jk-mlops-dev/alphafold-components')
@@ -32,7 +32,11 @@ def msa_search(
     reference_databases: Input[Dataset],
     sequence: Input[Dataset],
     msa: Output[Dataset],
-    cls_logging: Output[Artifact] 
+    cls_logging: Output[Artifact],
+    metrics: Output[Metrics],
+    cache_root: str='',
+    compression: str='none',
+    profile: bool=False,
     ):
     """Searches sequence databases using the specified tool.
 
@@ -43,13 +47,34 @@ def msa_search(
     The prototype also lacks job control. If a pipeline step fails, the CLS job can get 
     orphaned
 
+    If cache_root (a local directory or a gs:// prefix) is set, the search
+    result is looked up by a hash of the sequence, databases, tool and tool
+    settings before submitting the job, and stored there after a successful run.
+
+    The MSA is written with the given compression (none, gzip or zstd), which
+    is recorded in the `compression` metadata of the artifact. Readers detect
+    the compression from the content, so it is informational.
+
+    If profile is set, the runner runs under cProfile and tracemalloc and
+    samples its memory use. The profiles are uploaded next to the MSA as
+    files named after it with the suffixes .prof, .prof.txt, .tracemalloc,
+    .tracemalloc.txt, .rss.tsv and .profile.json.
+
+    The queue time, VM boot time, tool time, CPU time, peak memory and size
+    of the MSA are logged to the metrics output and added to the metadata
+    of the MSA.
+
     """
     
     import logging
     import os
     import sys
+    import time
 
     from dsub_wrapper import run_dsub_job
+    from job_metrics import log_job_metrics, metrics_path, read_job_metrics
+    from log_follower import LogFollower, make_source
+    from step_cache import StepCache, make_cache_key, sequence_digest
 
     _UNIREF90 = 'uniref90'
     _MGNIFY = 'mgnify'
@@ -59,7 +84,10 @@ def msa_search(
 
     _DSUB_PROVIDER = 'google-cls-v2'
     _LOG_INTERVAL = '30s'
-    _ALPHAFOLD_RUNNER_IMAGE = 'gcr.io/jk-mlops-dev/alphafold'
+    _LOG_NAME = 'job'
+    # Built from pipelines/Dockerfile.runners, with the pipeline modules
+    # the runner scripts import under /app/alphafold_runners.
+    _ALPHAFOLD_RUNNER_IMAGE = 'gcr.io/jk-mlops-dev/alphafold-runners'
 
     _DEFAULT_FILE_PREFIX = 'datafile'
 
@@ -80,7 +108,7 @@ def msa_search(
            'OUTPUT_DATA_FORMAT': 'sto',
            'N_CPU': '8',
            'MAXSEQ': '10_000',
-           'SCRIPT': '/scripts/alphafold_runners/jackhmmer_runner.py' 
+           'SCRIPT': '/scripts/alphafold_runners/msa_runner.py' 
        },
        'hhblits': {
            'MACHINE_TYPE': 'c2-standard-8',
@@ -88,7 +116,7 @@ def msa_search(
            'OUTPUT_DATA_FORMAT': 'a3m',
            'N_CPU': '8',
            'MAXSEQ': '1_000_000',
-           'SCRIPT': '/scripts/alphafold_runners/hhblits_runner.py' 
+           'SCRIPT': '/scripts/alphafold_runners/msa_runner.py' 
        },
     }
      
@@ -118,38 +146,77 @@ def msa_search(
 
     output_data_format = _TOOL_TO_SETTINGS_MAPPING[db_tool]['OUTPUT_DATA_FORMAT']
     msa.metadata['data_format'] = output_data_format
+    msa.metadata['compression'] = compression
     output_path = msa.uri
     input_path = sequence.uri
+
+    cache = StepCache(cache_root) if cache_root else None
+    if cache:
+        cache_key = make_cache_key(
+            step='msa_search',
+            sequence=sequence_digest(sequence.path),
+            disk_image=disk_image,
+            databases=database_paths,
+            tool=db_tool,
+            maxseq=_TOOL_TO_SETTINGS_MAPPING[db_tool]['MAXSEQ'],
+            script=_TOOL_TO_SETTINGS_MAPPING[db_tool]['SCRIPT'],
+            compression=compression,
+        )
+        cached_metadata = cache.lookup('msa_search', cache_key, {'msa': msa.path})
+        if cached_metadata is not None:
+            msa.metadata.update(cached_metadata['msa'])
+            metrics.log_metric('cache_hit', 1.0)
+            return
     
     job_params = [
         '--machine-type', _TOOL_TO_SETTINGS_MAPPING[db_tool]['MACHINE_TYPE'],
         '--boot-disk-size', _TOOL_TO_SETTINGS_MAPPING[db_tool]['BOOT_DISK_SIZE'],
-        '--logging', cls_logging.uri,
+        '--logging', f'{cls_logging.uri}/{_LOG_NAME}.log',
         '--log-interval', _LOG_INTERVAL, 
         '--image', _ALPHAFOLD_RUNNER_IMAGE,
-        '--env', f'PYTHONPATH=/app/alphafold',
-        '--mount', f'DB_ROOT={disk_image}',
+        '--env', 'PYTHONPATH=/app/alphafold:/app/alphafold_runners',
+        '--mount', f'DATABASES_ROOT={disk_image}',
         '--input', f'INPUT_PATH={input_path}',
         '--output', f'OUTPUT_PATH={output_path}',
-        '--env', f'DB_TOOL={db_tool}',
-        '--env', f'DB_PATHS={database_paths}',
+        '--output', f'METRICS_PATH={metrics_path(output_path)}',
+        '--env', f'MSA_TOOL={db_tool}',
+        '--env', f'MSA_FORMAT={output_data_format}',
+        '--env', f'DATABASE_PATHS={database_paths}',
         '--env', f'N_CPU={_TOOL_TO_SETTINGS_MAPPING[db_tool]["N_CPU"]}',
-        '--env', f'MAXSEQ={_TOOL_TO_SETTINGS_MAPPING[db_tool]["MAXSEQ"]}', 
+        '--env', f'MAX_STO_SEQUENCES={_TOOL_TO_SETTINGS_MAPPING[db_tool]["MAXSEQ"]}',
+        '--env', f'OUTPUT_COMPRESSION={compression}',
         '--script', _TOOL_TO_SETTINGS_MAPPING[db_tool]['SCRIPT'] 
     ]
-
-    result = run_dsub_job(
-        provider=_DSUB_PROVIDER,
-        project=project,
-        regions=region,
-        params=job_params,
-    ) 
-
-    
-
-    
-    
-
-
-
-    
+    if profile:
+        job_params += [
+            '--env', 'PROFILE_RUNNER=1',
+            '--output', f'PROFILE_FILES={output_path}.*',
+        ]
+
+    # Forwards the output of the runner while the job runs, reading only
+    # what was appended since the last upload of the log.
+    follower = LogFollower(
+        make_source(f'{cls_logging.uri}/{_LOG_NAME}-stdout.log'),
+        prefix=f'[{db_tool}] ').start()
+    submit_time = time.time()
+    try:
+        result = run_dsub_job(
+            provider=_DSUB_PROVIDER,
+            project=project,
+            regions=region,
+            params=job_params,
+        )
+    finally:
+        follower.stop()
+
+    metrics.log_metric('cache_hit', 0.0)
+    log_job_metrics(
+        metrics,
+        read_job_metrics(output_path, submit_time, time.time()),
+        artifacts=[msa],
+        extra_metadata={
+            'machine_type': _TOOL_TO_SETTINGS_MAPPING[db_tool]['MACHINE_TYPE']})
+
+    if cache:
+        cache.store('msa_search', cache_key, {'msa': msa.path},
+                    {'msa': dict(msa.metadata)})
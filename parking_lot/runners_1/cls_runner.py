@@ -30,6 +30,9 @@ from google.cloud.lifesciences_v2beta.types import Pipeline
 
 from typing import Any, Callable, Mapping, Optional, Sequence, Union
 
+import speculation
+from log_follower import LogFollower, make_source
+
 
 _POLLING_INTERVAL_IN_SECONDS = 11
 _LRO_ERROR_RETRY_DELAY_IN_SECONDS = 1
@@ -58,9 +61,30 @@ class PipelineRunner():
         #TBD
         return labels
 
-    def run_pipeline(self, pipeline: Union[Pipeline, dict], labels: dict=None, pub_sub_topic: str=None) -> Operation:
-        """Creates a pipeline run."""
+    def run_pipeline(self, pipeline: Union[Pipeline, dict], labels: dict=None, pub_sub_topic: str=None,
+                     log_uri: str=None) -> Operation:
+        """Creates a pipeline run.
+
+        If log_uri (a gs:// URI or a local path) is set, the new lines of the
+        log written there by the pipeline are forwarded to stdout while the
+        run is waited for.
+        """
         
+        lro = self.submit_pipeline(pipeline, labels, pub_sub_topic)
+
+        follower = LogFollower(make_source(log_uri)).start() if log_uri else None
+        try:
+            self._wait_for_pipeline_run(lro)
+        finally:
+            if follower:
+                follower.stop()
+
+        return lro.metadata
+
+
+    def submit_pipeline(self, pipeline: Union[Pipeline, dict], labels: dict=None, pub_sub_topic: str=None) -> Operation:
+        """Creates a pipeline run without waiting for it."""
+
         request = RunPipelineRequest() 
         request.parent = self.parent
         request.pipeline = pipeline
@@ -69,26 +93,63 @@ class PipelineRunner():
         if labels:
             request.labels =  self._validate_labels(labels)
 
-        lro = self.client.run_pipeline(request)
-
-        self._wait_for_pipeline_run(lro)
-
-        return lro.metadata
-
+        return self.client.run_pipeline(request)
+
+    def pipeline_status(self, lro: Operation) -> str:
+        """Returns RUNNING, SUCCESS or FAILURE for a pipeline run."""
+        try:
+            if not lro.done():
+                return speculation.RUNNING
+        except TypeError:
+            # Raised while the operation transitions states.
+            return speculation.RUNNING
+        return speculation.FAILURE if lro.exception() else speculation.SUCCESS
+
+    def cancel_pipeline(self, lro: Operation):
+        logging.info(f'Cancelling pipeline run {lro.operation.name}')
+        lro.cancel()
+
+    def run_speculative_pipeline(self,
+                                 pipeline: Union[Pipeline, dict],
+                                 runtime_class: str,
+                                 policy: speculation.SpeculationPolicy,
+                                 history: Optional[speculation.RuntimeHistory]=None,
+                                 decision_log_path: Optional[str]=None,
+                                 labels: dict=None) -> Operation:
+        """Runs a pipeline, submitting duplicates if it straggles.
+
+        Returns the operation of the first run to succeed. The other runs
+        are cancelled.
+        """
+
+        def submit(attempt: int) -> Operation:
+            return self.submit_pipeline(
+                pipeline, {**(labels or {}), 'speculative-attempt': str(attempt)})
+
+        executor = speculation.SpeculativeExecutor(
+            submit=submit,
+            status=self.pipeline_status,
+            cancel=self.cancel_pipeline,
+            policy=policy,
+            history=history,
+            decision_log_path=decision_log_path)
+        return executor.run(runtime_class).handle
 
     def _wait_for_pipeline_run(self, lro: Operation):
         """Poll the pipeline run status and waits for completion."""
         
-        event_count = 0
         while True:
             
             # lro can throw a TypeError exception when transitioning states
             try: 
                 status = lro.done()
-                newest_event_index = len(lro.metadata.events)
-                for i in range(newest_event_index - self.last_logged_event_index):
-                    print(lro.metadata.events[i].description)
-                self.last_logged_event_index = newest_event_index 
+                # Events are listed newest first, only the new ones are printed,
+                # oldest first.
+                events = lro.metadata.events
+                new_event_count = len(events) - self.last_logged_event_index
+                for i in reversed(range(new_event_count)):
+                    print(events[i].description)
+                self.last_logged_event_index = len(events)
                 if status:
                     break
             except TypeError:
@@ -12,98 +12,148 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""A script for searching sequence databases."""
+"""A script for searching pdb_seqres for templates using hmmsearch."""
 
+import logging
 import os
-from re import I
-import numpy as np
+import pickle
 import shutil
+import sys
 
-
-from absl import logging
-from absl import flags
-from absl import app
-from typing import Any, Mapping, MutableMapping, Optional, Sequence, Union
-
-
-from alphafold.common import residue_constants
-from alphafold.data import msa_identifiers
 from alphafold.data import parsers
 from alphafold.data import templates
-from alphafold.data.tools import hmmsearch 
-
-from runner_utils import run_msa_tool
-
-
-_OUTPUT_FILE_NAME = 'output.a3m'
-_DEFAULT_MSA_FORMAT = 'a3m'
-FLAGS = flags.FLAGS
-
-logging.set_verbosity(logging.INFO)
-
-flags.DEFINE_string(
-    'fasta_path', None, 'A path to FASTA file')
-
-flags.DEFINE_list(
-    'database_paths', None, 'Paths to a list of sequence databases to search')
-flags.DEFINE_string('output_dir', None, 'Path to a directory that will '
-                    'store the results.')
-flags.DEFINE_integer(
-    'n_cpu', 4, 'The number of CPUs to give Jackhmmer'
-)
-flags.DEFINE_integer(
-    'max_sto_sequences', 501, 'A maximum number of sequences to use for template search'
-)
-flags.DEFINE_string('hmmsearch_binary_path', shutil.which('hmmsearch'),
-                    'Path to the hmmsearch  executable.')
-flags.DEFINE_string('hmmbuild_binary_path', shutil.which('hmmbuild'),
-                    'Path to the hmmbuild executable.')
-
-def run_hhblits(
-    input_fasta_path: str,
-    database_paths: Sequence[str],
-    output_dir: str): 
-    """Runs hhblits and saves results to a file."""
-
-    runner = hmmsearch.Hmmsearch(
-        binary_path=FLAGS.hhblits_binary_path,
-        hmmbuild_binary_path=FLAGS.hmmbuild_binary_path
-        databases=database_paths,
-    )
 
-    with open(input_fasta_path) as f:
-        input_fasta_str = f.read()
-    input_seqs, input_descs = parsers.parse_fasta(input_fasta_str)
+import artifact_io
+import runner_metrics
+import sharded_hmmsearch
+
+
+INPUT_SEQUENCE_PATH = os.environ['INPUT_SEQUENCE_PATH']
+INPUT_MSA_PATH = os.environ['INPUT_MSA_PATH']
+MSA_DATA_FORMAT = os.environ['MSA_DATA_FORMAT']
+OUTPUT_TEMPLATE_HITS_PATH = os.environ['OUTPUT_TEMPLATE_HITS_PATH']
+OUTPUT_TEMPLATE_FEATURES_PATH = os.environ['OUTPUT_TEMPLATE_FEATURES_PATH']
+DB_ROOT = os.environ['DB_ROOT']
+DB_PATHS = os.environ['DB_PATHS']
+MMCIF_PATH = os.environ['MMCIF_PATH']
+OBSOLETE_PATH = os.environ['OBSOLETE_PATH']
+MAX_TEMPLATE_DATE = os.environ['MAX_TEMPLATE_DATE']
+MAX_TEMPLATE_HITS = int(os.getenv('MAX_TEMPLATE_HITS', '20'))
+N_CPU = int(os.getenv('N_CPU', '8'))
+NUM_SHARDS = int(os.getenv('NUM_SHARDS', '8'))
+OUTPUT_COMPRESSION = os.getenv('OUTPUT_COMPRESSION', artifact_io.NONE)
+HMMSEARCH_BINARY_PATH = shutil.which('hmmsearch')
+HMMBUILD_BINARY_PATH = shutil.which('hmmbuild')
+KALIGN_BINARY_PATH = shutil.which('kalign')
+METRICS_PATH = os.getenv('METRICS_PATH')
+PROFILE_RUNNER = os.getenv('PROFILE_RUNNER', '').lower() in ('1', 'true')
+PROFILE_TOP_N = int(os.getenv('PROFILE_TOP_N', '30'))
+PROFILE_RSS_INTERVAL = float(os.getenv('PROFILE_RSS_INTERVAL', '1'))
+
+METRICS = runner_metrics.RunnerMetrics()
+
+
+def run_hmmsearch(
+    input_sequence_path: str,
+    input_msa_path: str,
+    msa_format: str,
+    database_path: str,
+    mmcif_dir: str,
+    obsolete_pdbs_path: str,
+    max_template_date: str,
+    max_template_hits: int,
+    n_cpu: int,
+    num_shards: int,
+    output_hits_path: str,
+    output_features_path: str):
+    """Runs sharded hmmsearch and saves the hits and template features."""
+
+    with open(input_sequence_path) as f:
+        input_seqs, input_descs = parsers.parse_fasta(f.read())
     if len(input_seqs) != 1:
-      raise ValueError(
-          f'More than one input sequence found in {input_fasta_path}.')
-
-    msa_out_path = os.path.join(output_dir, _OUTPUT_FILE_NAME)
-    result = run_msa_tool(
-        msa_runner=runner,
-        input_fasta_path=input_fasta_path,
-        msa_out_path=msa_out_path,
-        msa_format=_DEFAULT_MSA_FORMAT,
-        use_precomputed_msas=False
+        raise ValueError(
+            f'More than one input sequence found in {input_sequence_path}.')
+    logging.info(f'Searching templates for input sequence: {input_descs[0]}')
+
+    runner = sharded_hmmsearch.ShardedHmmsearch(
+        binary_path=HMMSEARCH_BINARY_PATH,
+        hmmbuild_binary_path=HMMBUILD_BINARY_PATH,
+        database_path=database_path,
+        num_shards=num_shards,
+        n_cpu=n_cpu,
     )
 
-    return result
-
-
-def _main(argv):
+    input_msa_str = artifact_io.read_text(input_msa_path)
+
+    with METRICS.timed('tool_seconds'):
+        if msa_format == 'sto':
+            msa_for_templates = parsers.deduplicate_stockholm_msa(input_msa_str)
+            msa_for_templates = parsers.remove_empty_columns_from_stockholm_msa(
+                msa_for_templates)
+            template_hits = runner.query(msa_for_templates)
+        elif msa_format == 'a3m':
+            hmm = runner.hmmbuild_runner.build_profile_from_a3m(input_msa_str)
+            template_hits = runner.query_with_hmm(hmm)
+        else:
+            raise ValueError(
+              f'File format not supported by hmmsearch: {msa_format}.')
+
+    with METRICS.timed('write_seconds'):
+        artifact_io.write_text(
+            output_hits_path, template_hits, OUTPUT_COMPRESSION)
+    logging.info(f'Saved template hits to {output_hits_path}')
+
+    template_featurizer = templates.HmmsearchHitFeaturizer(
+        mmcif_dir=mmcif_dir,
+        max_template_date=max_template_date,
+        max_hits=max_template_hits,
+        kalign_binary_path=KALIGN_BINARY_PATH,
+        release_dates_path=None,
+        obsolete_pdbs_path=obsolete_pdbs_path)
+    with METRICS.timed('featurize_seconds'):
+        templates_result = template_featurizer.get_templates(
+            query_sequence=input_seqs[0],
+            hits=runner.get_template_hits(template_hits, input_seqs[0]))
+
+    with open(output_features_path, 'wb') as f:
+        pickle.dump(templates_result.features, f, protocol=4)
+    logging.info(f'Saved template features to {output_features_path}')
+
+
+def main():
+    run_hmmsearch(
+        input_sequence_path=INPUT_SEQUENCE_PATH,
+        input_msa_path=INPUT_MSA_PATH,
+        msa_format=MSA_DATA_FORMAT,
+        database_path=os.path.join(DB_ROOT, DB_PATHS.split(',')[0]),
+        mmcif_dir=os.path.join(DB_ROOT, MMCIF_PATH),
+        obsolete_pdbs_path=os.path.join(DB_ROOT, OBSOLETE_PATH),
+        max_template_date=MAX_TEMPLATE_DATE,
+        max_template_hits=MAX_TEMPLATE_HITS,
+        n_cpu=N_CPU,
+        num_shards=NUM_SHARDS,
+        output_hits_path=OUTPUT_TEMPLATE_HITS_PATH,
+        output_features_path=OUTPUT_TEMPLATE_FEATURES_PATH
+    )
 
-    result = run_hhblits(
-        input_fasta_path=FLAGS.fasta_path,
-        database_paths=FLAGS.database_paths,
-        n_cpu=FLAGS.n_cpu,
-        output_dir=FLAGS.output_dir
-    ) 
+    if METRICS_PATH:
+        METRICS.record_output(OUTPUT_TEMPLATE_HITS_PATH, 'a3m')
+        METRICS.write(METRICS_PATH)
 
 
 if __name__=='__main__':
-    flags.mark_flags_as_required([
-        'fasta_path',
-        'database_paths',
-        'output_dir'
-    ])
-    app.run(_main)
\ No newline at end of file
+    logging.basicConfig(format='%(asctime)s - %(message)s',
+                        level=logging.INFO,
+                        datefmt='%d-%m-%y %H:%M:%S',
+                        stream=sys.stdout)
+
+    if PROFILE_RUNNER:
+        # Imported here so that runs without profiling do not pay for it.
+        import runner_profiling
+        with runner_profiling.profiled(
+                OUTPUT_TEMPLATE_HITS_PATH,
+                top_n=PROFILE_TOP_N,
+                rss_interval=PROFILE_RSS_INTERVAL):
+            main()
+    else:
+        main()
@@ -0,0 +1,126 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checks the import time of the runners against a budget.
+
+For every runner and tool, imports the runner and the modules it needs for
+the tool in a fresh interpreter started with `-X importtime`, and sums the
+cumulative time of the top-level imports that an empty interpreter does not
+make. The median over several runs is compared with the budget of the case,
+and the script exits with an error if any case is over budget, listing its
+heaviest imports.
+
+Run it in the runner image, from any directory:
+
+  python import_time_benchmark.py --repeats=5 --budget_scale=1.2
+"""
+
+
+import logging
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+from typing import Dict, List, Set, Tuple
+
+from absl import app
+from absl import flags
+
+FLAGS = flags.FLAGS
+
+_RUNNERS_DIR = os.path.dirname(os.path.abspath(__file__))
+_PIPELINES_DIR = os.path.join(_RUNNERS_DIR, '..', '..', 'pipelines')
+
+# (runner module, tool) -> import time budget in milliseconds. The parsers
+# module is imported by every search to read the input.
+_BUDGETS_MS = {
+    ('msa_runner', 'jackhmmer'): 250,
+    ('msa_runner', 'hhblits'): 250,
+    ('template_runner', 'hhsearch'): 250,
+}
+
+_IMPORT_TIME_RE = re.compile(
+    r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+flags.DEFINE_integer('repeats', 5, 'Number of measurements of each case.')
+flags.DEFINE_float('budget_scale', 1.0, 'Multiplies all budgets, e.g. for '
+                   'slower machines.')
+flags.DEFINE_integer('top_n', 10, 'Number of the heaviest imports listed for '
+                     'cases over budget.')
+
+
+def _top_level_imports(stderr: str) -> List[Tuple[str, int]]:
+    """Parses -X importtime output into (module, cumulative us) pairs."""
+    imports = []
+    for line in stderr.splitlines():
+        match = _IMPORT_TIME_RE.match(line)
+        # Nested imports are indented by two more spaces per level.
+        if match and len(match.group(3)) == 1:
+            imports.append((match.group(4), int(match.group(2))))
+    return imports
+
+
+def _measure(code: str) -> List[Tuple[str, int]]:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [_RUNNERS_DIR, _PIPELINES_DIR, env.get('PYTHONPATH', '')])
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+        check=True,
+        universal_newlines=True
+    )
+    return _top_level_imports(result.stderr)
+
+
+def measure_case(runner: str, tool: str, baseline: Set[str],
+                 repeats: int) -> Tuple[float, List[Tuple[str, int]]]:
+    """Returns the median import time in ms and the imports of the last run."""
+    code = (f'import {runner}; {runner}.import_tool({tool!r}); '
+            'from alphafold.data import parsers')
+    totals = []
+    for _ in range(repeats):
+        imports = [(module, us) for module, us in _measure(code)
+                   if module not in baseline]
+        totals.append(sum(us for _, us in imports) / 1000)
+    return statistics.median(totals), imports
+
+
+def _main(argv):
+    logging.basicConfig(format='%(asctime)s - %(message)s',
+                        level=logging.INFO,
+                        datefmt='%d-%m-%y %H:%M:%S',
+                        stream=sys.stdout)
+
+    baseline = {module for module, _ in _measure('pass')}
+    over_budget = []
+    for (runner, tool), budget_ms in _BUDGETS_MS.items():
+        budget_ms *= FLAGS.budget_scale
+        median_ms, imports = measure_case(runner, tool, baseline, FLAGS.repeats)
+        logging.info(f'{runner} {tool}: {median_ms:.1f} ms '
+                     f'(budget {budget_ms:.0f} ms)')
+        if median_ms > budget_ms:
+            over_budget.append((runner, tool))
+            for module, us in sorted(imports, key=lambda x: -x[1])[:FLAGS.top_n]:
+                logging.info(f'    {us / 1000:8.1f} ms  {module}')
+
+    if over_budget:
+        sys.exit(f'Import time over budget for {over_budget}.')
+
+
+if __name__=='__main__':
+    app.run(_main)
@@ -13,64 +13,140 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""A script for searching sequence databases using hhblits."""
+"""A script for searching sequence databases using hhblits or jackhmmer.
 
+The script is started once per search, so it keeps its startup short: only
+the wrapper of the selected tool is imported, the staging and warm-up
+modules are imported only when enabled, and the configuration is read from
+the environment when the search starts rather than when the module is
+imported. `import_time_benchmark.py` checks the import time against a
+budget.
+
+If SEED_INDEX_DIR names a seed index of the database (see
+`build_kmer_index.py`), jackhmmer only searches the database sequences the
+index shortlists for the query.
+"""
+
+import dataclasses
+import importlib
 import logging
 import os
 import pathlib
-import numpy as np
 import shutil
 import sys
-import time
 
-from typing import Any, Mapping, MutableMapping, Optional, Sequence, Union
+from typing import Any, Mapping, Optional, Sequence
+
+import artifact_io
+import runner_metrics
+
+# Module of the wrapper of each tool, imported only when the tool is used.
+_TOOL_MODULES = {
+    'jackhmmer': 'alphafold.data.tools.jackhmmer',
+    'hhblits': 'alphafold.data.tools.hhblits',
+}
+
 
-from alphafold.common import residue_constants
-from alphafold.data import msa_identifiers
-from alphafold.data import parsers
-from alphafold.data import templates
-from alphafold.data.tools import hhblits
-from alphafold.data.tools import jackhmmer
+@dataclasses.dataclass(frozen=True)
+class RunnerConfig:
+    """Settings of the runner, read from environment variables."""
+    msa_tool: str
+    input_path: str
+    output_path: str
+    databases_root: str
+    database_paths: Sequence[str]
+    n_cpu: int = 2
+    max_sto_sequences: int = 10000
+    output_compression: str = artifact_io.NONE
+    staging_dir: Optional[str] = None
+    staging_max_gb: float = 500
+    staging_num_workers: int = 16
+    warmup_method: Optional[str] = None
+    warmup_data_gb: float = 0
+    profile: bool = False
+    profile_top_n: int = 30
+    profile_rss_interval: float = 1
+    metrics_path: Optional[str] = None
+    seed_index_dir: Optional[str] = None
+    seed_index_min_shared_seeds: int = 2
+    msa_format: Optional[str] = None
 
+    @classmethod
+    def from_environ(cls, environ: Mapping[str, str] = os.environ
+                     ) -> 'RunnerConfig':
+        return cls(
+            msa_tool=environ['MSA_TOOL'],
+            input_path=environ['INPUT_PATH'],
+            output_path=environ['OUTPUT_PATH'],
+            databases_root=environ['DATABASES_ROOT'],
+            database_paths=environ['DATABASE_PATHS'].split(','),
+            n_cpu=int(environ.get('N_CPU', '2')),
+            max_sto_sequences=int(environ.get('MAX_STO_SEQUENCES', 10000)),
+            output_compression=environ.get(
+                'OUTPUT_COMPRESSION', artifact_io.NONE),
+            staging_dir=environ.get('STAGING_DIR'),
+            staging_max_gb=float(environ.get('STAGING_MAX_GB', '500')),
+            staging_num_workers=int(environ.get('STAGING_NUM_WORKERS', '16')),
+            warmup_method=environ.get('WARMUP_METHOD'),
+            warmup_data_gb=float(environ.get('WARMUP_DATA_GB', '0')),
+            profile=environ.get('PROFILE_RUNNER', '').lower() in ('1', 'true'),
+            profile_top_n=int(environ.get('PROFILE_TOP_N', '30')),
+            profile_rss_interval=float(
+                environ.get('PROFILE_RSS_INTERVAL', '1')),
+            metrics_path=environ.get('METRICS_PATH'),
+            seed_index_dir=environ.get('SEED_INDEX_DIR'),
+            seed_index_min_shared_seeds=int(
+                environ.get('SEED_INDEX_MIN_SHARED_SEEDS', '2')),
+            msa_format=environ.get('MSA_FORMAT'),
+        )
+
+    @property
+    def output_format(self) -> str:
+        """The format of the MSA, by default the suffix of the output path.
+
+        Paths of KFP artifacts have no suffix, so components set MSA_FORMAT.
+        """
+        return self.msa_format or pathlib.Path(self.output_path).suffix[1:]
 
 
-MSA_TOOL = os.environ['MSA_TOOL']
-INPUT_PATH = os.environ['INPUT_PATH']
-OUTPUT_PATH = os.environ['OUTPUT_PATH']
-DATABASES_ROOT = os.environ['DATABASES_ROOT']
-DATABASE_PATHS = os.environ['DATABASE_PATHS']
-N_CPU = int(os.getenv('N_CPU', '2'))
-MAX_STO_SEQEUNCES = int(os.getenv('MAX_STO_SEQUENCES', 10000))
-HHBLITS_BINARY_PATH = shutil.which('hhblits')
-JACKHMMER_BINARY_PATH = shutil.which('jackhmmer')
+def import_tool(msa_tool: str):
+    """Imports the wrapper module of a tool, and not those of other tools."""
+    if msa_tool not in _TOOL_MODULES:
+        raise ValueError(f'Unsupported tool {msa_tool}.')
+    return importlib.import_module(_TOOL_MODULES[msa_tool])
 
 
 def _run_msa_tool(msa_runner, input_fasta_path: str, msa_out_path: str,
-                 msa_format: str, use_precomputed_msas: bool=False,
+                 msa_format: str, metrics: runner_metrics.RunnerMetrics,
+                 compression: str = artifact_io.NONE,
+                 use_precomputed_msas: bool=False,
                  max_sto_sequences: Optional[int] = None
                  ) -> Mapping[str, Any]:
     """Runs an MSA tool, checking if output already exists first."""
     if not use_precomputed_msas or not os.path.exists(msa_out_path):
-        if msa_format == 'sto' and max_sto_sequences is not None:
-            result = msa_runner.query(input_fasta_path, max_sto_sequences)[0]  # pytype: disable=wrong-arg-count
-        else:
-            result = msa_runner.query(input_fasta_path)[0]
+        with metrics.timed('tool_seconds'):
+            if msa_format == 'sto' and max_sto_sequences is not None:
+                result = msa_runner.query(input_fasta_path, max_sto_sequences)[0]  # pytype: disable=wrong-arg-count
+            else:
+                result = msa_runner.query(input_fasta_path)[0]
         logging.info(f"Saving results to {msa_out_path}")
-        with open(msa_out_path, 'w') as f:
-            f.write(result[msa_format])
+        with metrics.timed('write_seconds'):
+            artifact_io.write_text(
+                msa_out_path, result[msa_format], compression)
     else:
         logging.warning('Reading MSA from file %s', msa_out_path)
         if msa_format == 'sto' and max_sto_sequences is not None:
-            precomputed_msa = parsers.truncate_stockholm_msa(
+            precomputed_msa = artifact_io.truncate_stockholm_msa(
                     msa_out_path, max_sto_sequences)
             result = {'sto': precomputed_msa}
         else:
-            with open(msa_out_path, 'r') as f:
-                result = {msa_format: f.read()}
+            result = {msa_format: artifact_io.read_text(msa_out_path)}
     return result
 
 
 def _read_and_check_fasta(fasta_path):
+    from alphafold.data import parsers
+
     with open(fasta_path) as f:
         input_fasta_str = f.read()
     input_seqs, input_descs = parsers.parse_fasta(input_fasta_str)
@@ -85,15 +161,18 @@ def run_hhblits(
     input_path: str,
     database_paths: Sequence[str],
     n_cpu: int,
-    output_path: str): 
+    output_path: str,
+    metrics: runner_metrics.RunnerMetrics,
+    compression: str = artifact_io.NONE,
+    msa_format: Optional[str] = None): 
     """Runs hhblits and saves results to a file."""
 
-    msa_format = pathlib.Path(output_path).suffix[1:]
+    msa_format = msa_format or pathlib.Path(output_path).suffix[1:]
     if msa_format != 'a3m':
         raise ValueError(f'hhblits does not support generating files in {msa_format} format') 
 
-    runner = hhblits.HHBlits(
-        binary_path=HHBLITS_BINARY_PATH,
+    runner = import_tool('hhblits').HHBlits(
+        binary_path=shutil.which('hhblits'),
         databases=database_paths,
         n_cpu=n_cpu
     )
@@ -105,7 +184,9 @@ def run_hhblits(
         msa_runner=runner,
         input_fasta_path=input_path,
         msa_out_path=output_path,
-        msa_format=msa_format
+        msa_format=msa_format,
+        metrics=metrics,
+        compression=compression
     )
 
 
@@ -114,18 +195,39 @@ def run_jackhmmer(
     database_path: str,
     n_cpu: int,
     max_sto_sequences: int,
-    output_path: str): 
-    """Runs jackhmeer and saves results to a file."""
+    output_path: str,
+    metrics: runner_metrics.RunnerMetrics,
+    compression: str = artifact_io.NONE,
+    seed_index_dir: Optional[str] = None,
+    seed_index_min_shared_seeds: int = 2,
+    msa_format: Optional[str] = None): 
+    """Runs jackhmeer and saves results to a file.
+
+    If a seed index of the database is given, only the database sequences
+    it shortlists for the query are searched.
+    """
 
-    msa_format = pathlib.Path(output_path).suffix[1:]
+    msa_format = msa_format or pathlib.Path(output_path).suffix[1:]
     if msa_format != 'sto':
         raise ValueError(f'jackhmmer does not support generating files in {msa_format} format') 
 
-    runner = jackhmmer.Jackhmmer(
-        binary_path=JACKHMMER_BINARY_PATH,
-        database_path=database_path,
-        n_cpu=n_cpu,
-    )
+    if seed_index_dir:
+        import kmer_prefilter
+
+        logging.info(f'Using seed index {seed_index_dir} for {database_path}')
+        runner = kmer_prefilter.PrefilteredJackhmmer(
+            binary_path=shutil.which('jackhmmer'),
+            database_path=database_path,
+            index_dir=seed_index_dir,
+            min_shared_seeds=seed_index_min_shared_seeds,
+            n_cpu=n_cpu,
+        )
+    else:
+        runner = import_tool('jackhmmer').Jackhmmer(
+            binary_path=shutil.which('jackhmmer'),
+            database_path=database_path,
+            n_cpu=n_cpu,
+        )
 
     _, input_desc = _read_and_check_fasta(input_path)
     logging.info(f'Searching using input sequence: {input_desc}')
@@ -135,40 +237,102 @@ def run_jackhmmer(
         input_fasta_path=input_path,
         msa_out_path=output_path,
         msa_format=msa_format,
+        metrics=metrics,
+        compression=compression,
         max_sto_sequences=max_sto_sequences
     )
 
 
-if __name__=='__main__':
-    logging.basicConfig(format='%(asctime)s - %(message)s',
-                        level=logging.INFO, 
-                        datefmt='%d-%m-%y %H:%M:%S',
-                        stream=sys.stdout)
-    
-    database_paths = [
-            os.path.join(DATABASES_ROOT, database_path) 
-            for database_path in DATABASE_PATHS.split(',')]
+def main(config: RunnerConfig):
+    metrics = runner_metrics.RunnerMetrics()
+    # Fails before staging the databases if the tool is not supported.
+    import_tool(config.msa_tool)
+
+    if config.staging_dir:
+        import db_staging
+
+        staging_cache = db_staging.StagingCache(
+            remote_root=config.databases_root,
+            staging_dir=config.staging_dir,
+            max_bytes=int(config.staging_max_gb * 1e9),
+            num_workers=config.staging_num_workers)
+        with metrics.timed('staging_seconds'):
+            database_paths = [
+                    staging_cache.stage(database_path)
+                    for database_path in config.database_paths]
+    else:
+        database_paths = [
+                os.path.join(config.databases_root, database_path) 
+                for database_path in config.database_paths]
+
+    # Prefetches the databases while the input is checked.
+    if config.warmup_method:
+        import page_cache
+
+        warmer = page_cache.PageCacheWarmer(
+            database_paths,
+            page_cache.WarmupConfig(
+                method=config.warmup_method,
+                data_bytes=int(config.warmup_data_gb * 1e9))).start()
+        _read_and_check_fasta(config.input_path)
+        with metrics.timed('warmup_seconds'):
+            warmer.wait()
+
+    # A relative index directory is on the databases disk, like the
+    # databases. The index is built for the unstaged database, which has
+    # the same records.
+    seed_index_dir = None
+    if config.seed_index_dir:
+        seed_index_dir = os.path.join(config.databases_root,
+                                      config.seed_index_dir)
 
     print('***** In msa_runner****')
-    print(OUTPUT_PATH)
+    print(config.output_path)
 
-    if MSA_TOOL == 'jackhmmer':
+    if config.msa_tool == 'jackhmmer':
         run_jackhmmer(
-            input_path=INPUT_PATH,
+            input_path=config.input_path,
             database_path=database_paths[0],
-            n_cpu=N_CPU,
-            max_sto_sequences=MAX_STO_SEQEUNCES,
-            output_path=OUTPUT_PATH
+            n_cpu=config.n_cpu,
+            max_sto_sequences=config.max_sto_sequences,
+            output_path=config.output_path,
+            metrics=metrics,
+            compression=config.output_compression,
+            seed_index_dir=seed_index_dir,
+            seed_index_min_shared_seeds=config.seed_index_min_shared_seeds,
+            msa_format=config.output_format
         )
-    elif MSA_TOOL == 'hhblits':
+    else:
         run_hhblits(
-            input_path=INPUT_PATH,
+            input_path=config.input_path,
             database_paths=database_paths,
-            n_cpu=N_CPU,
-            output_path=OUTPUT_PATH
+            n_cpu=config.n_cpu,
+            output_path=config.output_path,
+            metrics=metrics,
+            compression=config.output_compression,
+            msa_format=config.output_format
         )
-    else:
-      raise ValueError(
-          f'Unsupported tool {MSA_TOOL}.')
 
+    if config.metrics_path:
+        metrics.record_output(
+            config.output_path, config.output_format)
+        metrics.write(config.metrics_path)
+
+
+if __name__=='__main__':
+    logging.basicConfig(format='%(asctime)s - %(message)s',
+                        level=logging.INFO, 
+                        datefmt='%d-%m-%y %H:%M:%S',
+                        stream=sys.stdout)
 
+    config = RunnerConfig.from_environ()
+    if config.profile:
+        # Imported here so that runs without profiling do not pay for it.
+        import runner_profiling
+        with runner_profiling.profiled(
+                config.output_path,
+                top_n=config.profile_top_n,
+                rss_interval=config.profile_rss_interval):
+            main(config)
+    else:
+        main(config)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A script for searching a database with many queries in one pass.
+
+Runs the queries of a batch of targets against one sequence database with
+`shared_scan_search`, which reads the database once and searches every
+chunk of it with all queries in parallel, instead of reading the database
+once per target. The queries are FASTA sequences searched with phmmer, or
+Stockholm MSAs searched with hmmsearch using a profile built from each MSA.
+The hits of every query are written to `<OUTPUT_DIR>/<input name>.a3m`.
+
+The phmmer outputs are MSAs with the query sequence as the first row, in the
+form read by `aggregate_features` for the `a3m` data format. The hmmsearch
+outputs have no query row: like the `pdb_hits.sto` of the hmmsearch template
+search, they are hit lists for `parsers.parse_hmmsearch_a3m` and
+`templates.HmmsearchHitFeaturizer`, given the sequence of the target.
+"""
+
+import dataclasses
+import logging
+import os
+import pathlib
+import shutil
+import sys
+
+from typing import Dict, Mapping, Optional, Sequence
+
+import artifact_io
+import runner_metrics
+
+
+@dataclasses.dataclass(frozen=True)
+class RunnerConfig:
+    """Settings of the runner, read from environment variables."""
+    search_tool: str
+    input_paths: Sequence[str]
+    output_dir: str
+    databases_root: str
+    database_path: str
+    n_cpu: int = 8
+    num_workers: int = 8
+    chunk_mb: float = 256
+    max_hits: Optional[int] = None
+    output_compression: str = artifact_io.NONE
+    metrics_path: Optional[str] = None
+
+    @classmethod
+    def from_environ(cls, environ: Mapping[str, str] = os.environ
+                     ) -> 'RunnerConfig':
+        max_hits = environ.get('MAX_HITS')
+        return cls(
+            search_tool=environ['SEARCH_TOOL'],
+            input_paths=environ['INPUT_PATHS'].split(','),
+            output_dir=environ['OUTPUT_DIR'],
+            databases_root=environ['DATABASES_ROOT'],
+            database_path=environ['DATABASE_PATH'],
+            n_cpu=int(environ.get('N_CPU', '8')),
+            num_workers=int(environ.get('NUM_WORKERS', '8')),
+            chunk_mb=float(environ.get('CHUNK_MB', '256')),
+            max_hits=int(max_hits) if max_hits else None,
+            output_compression=environ.get(
+                'OUTPUT_COMPRESSION', artifact_io.NONE),
+            metrics_path=environ.get('METRICS_PATH'),
+        )
+
+
+def _query_name(input_path: str) -> str:
+    return pathlib.Path(input_path).stem
+
+
+def read_queries(search_tool: str,
+                 input_paths: Sequence[str]) -> Dict[str, str]:
+    """Reads the queries, building the profiles of MSAs for hmmsearch."""
+    import shared_scan_search
+
+    queries = {}
+    if search_tool == shared_scan_search.HMMSEARCH:
+        from alphafold.data.tools import hmmbuild
+
+        hmmbuild_runner = hmmbuild.Hmmbuild(
+            binary_path=shutil.which('hmmbuild'))
+    for input_path in input_paths:
+        name = _query_name(input_path)
+        if name in queries:
+            raise ValueError(f'More than one input named {name}.')
+        query = artifact_io.read_text(input_path)
+        if search_tool == shared_scan_search.HMMSEARCH:
+            query = hmmbuild_runner.build_profile_from_sto(
+                query, model_construction='hand')
+        queries[name] = query
+    return queries
+
+
+def main(config: RunnerConfig):
+    import shared_scan_search
+
+    metrics = runner_metrics.RunnerMetrics()
+    searcher = shared_scan_search.SharedScanSearch(
+        binary_path=shutil.which(config.search_tool),
+        database_path=os.path.join(config.databases_root,
+                                   config.database_path),
+        tool=config.search_tool,
+        num_workers=config.num_workers,
+        n_cpu=config.n_cpu,
+        chunk_bytes=int(config.chunk_mb * 2**20),
+        max_hits=config.max_hits)
+
+    queries = read_queries(config.search_tool, config.input_paths)
+    logging.info(f'Searching {len(queries)} queries with '
+                 f'{config.search_tool}: {list(queries)}')
+    with metrics.timed('tool_seconds'):
+        results = searcher.search(queries)
+
+    os.makedirs(config.output_dir, exist_ok=True)
+    output_bytes = 0
+    output_num_sequences = 0
+    with metrics.timed('write_seconds'):
+        for name, a3m in results.items():
+            output_path = os.path.join(config.output_dir, f'{name}.a3m')
+            logging.info(f'Saving results to {output_path}')
+            artifact_io.write_text(output_path, a3m,
+                                   config.output_compression)
+            output_bytes += os.path.getsize(output_path)
+            output_num_sequences += a3m.count('>')
+
+    if config.metrics_path:
+        metrics.metrics.update({
+            'num_queries': len(queries),
+            'output_bytes': output_bytes,
+            'output_num_sequences': output_num_sequences,
+        })
+        metrics.write(config.metrics_path)
+
+
+if __name__=='__main__':
+    logging.basicConfig(format='%(asctime)s - %(message)s',
+                        level=logging.INFO,
+                        datefmt='%d-%m-%y %H:%M:%S',
+                        stream=sys.stdout)
+
+    main(RunnerConfig.from_environ())
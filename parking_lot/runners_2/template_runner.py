@@ -13,53 +13,100 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""A script for searching sequence databases."""
+"""A script for searching template databases.
 
+As in `msa_runner.py`, only the wrapper of the selected tool is imported and
+the configuration is read from the environment when the search starts.
+"""
+
+import dataclasses
+import importlib
 import logging
 import os
-import numpy as np
 import pathlib
 import shutil
 import sys
-import time
-
-from typing import Any, Mapping, MutableMapping, Optional, Sequence, Union
 
-from alphafold.common import residue_constants
-from alphafold.data import msa_identifiers
-from alphafold.data import parsers
-from alphafold.data import templates
-from alphafold.data.tools import hhsearch 
+from typing import Mapping, Optional, Sequence
+
+import artifact_io
+import runner_metrics
+
+# Module of the wrapper of each tool, imported only when the tool is used.
+_TOOL_MODULES = {
+    'hhsearch': 'alphafold.data.tools.hhsearch',
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class RunnerConfig:
+    """Settings of the runner, read from environment variables."""
+    template_tool: str
+    input_path: str
+    output_path: str
+    databases_root: str
+    database_paths: Sequence[str]
+    maxseq: int = 1_000_000
+    output_compression: str = artifact_io.NONE
+    staging_dir: Optional[str] = None
+    staging_max_gb: float = 500
+    staging_num_workers: int = 16
+    profile: bool = False
+    profile_top_n: int = 30
+    profile_rss_interval: float = 1
+    metrics_path: Optional[str] = None
+
+    @classmethod
+    def from_environ(cls, environ: Mapping[str, str] = os.environ
+                     ) -> 'RunnerConfig':
+        return cls(
+            template_tool=environ['TEMPLATE_TOOL'],
+            input_path=environ['INPUT_PATH'],
+            output_path=environ['OUTPUT_PATH'],
+            databases_root=environ['DATABASES_ROOT'],
+            database_paths=environ['DATABASE_PATHS'].split(','),
+            maxseq=int(environ.get('MAXSEQ', '1_000_000')),
+            output_compression=environ.get(
+                'OUTPUT_COMPRESSION', artifact_io.NONE),
+            staging_dir=environ.get('STAGING_DIR'),
+            staging_max_gb=float(environ.get('STAGING_MAX_GB', '500')),
+            staging_num_workers=int(environ.get('STAGING_NUM_WORKERS', '16')),
+            profile=environ.get('PROFILE_RUNNER', '').lower() in ('1', 'true'),
+            profile_top_n=int(environ.get('PROFILE_TOP_N', '30')),
+            profile_rss_interval=float(
+                environ.get('PROFILE_RSS_INTERVAL', '1')),
+            metrics_path=environ.get('METRICS_PATH'),
+        )
 
 
-INPUT_PATH = os.environ['INPUT_PATH']
-OUTPUT_PATH = os.environ['OUTPUT_PATH']
-DATABASES_ROOT = os.environ['DATABASES_ROOT']
-DATABASE_PATHS = os.environ['DATABASE_PATHS']
-HHBLITS_BINARY_PATH = shutil.which('hhsearch')
-MAXSEQ = int(os.getenv('MAXSEQ', '1_000_000'))
-TEMPLATE_TOOL = os.environ['TEMPLATE_TOOL']
+def import_tool(template_tool: str):
+    """Imports the wrapper module of a tool, and not those of other tools."""
+    if template_tool not in _TOOL_MODULES:
+        raise ValueError(f'Unsupported tool {template_tool}.')
+    return importlib.import_module(_TOOL_MODULES[template_tool])
 
 
 def run_hhsearch(
     input_path: str,
     database_paths: Sequence[str],
     maxseq: int,
-    output_path: str): 
-    """Runs hhblits and saves results to a file."""
+    output_path: str,
+    metrics: runner_metrics.RunnerMetrics,
+    compression: str = artifact_io.NONE): 
+    """Runs hhsearch and saves results to a file."""
+    from alphafold.data import parsers
 
-    template_format = pathlib.Path(input_path).suffix[1:]
+    template_format = pathlib.Path(output_path).suffix[1:]
     if template_format != 'hhr':
-        raise ValueError('hhsearch does not support generating files in {output_file_type} format') 
+        raise ValueError(f'hhsearch does not support generating files in {template_format} format') 
 
-    runner = hhsearch.HHSearch(
-        binary_path=HHBLITS_BINARY_PATH,
+    runner = import_tool('hhsearch').HHSearch(
+        binary_path=shutil.which('hhsearch'),
         databases=database_paths,
         maxseq=maxseq,
     )
 
-    with open(input_path) as f:
-        input_msa_str = f.read()
+    input_msa_str = artifact_io.read_text(input_path)
 
     msa_format = pathlib.Path(input_path).suffix[1:]
     if  msa_format == 'sto':
@@ -69,36 +116,70 @@ def run_hhsearch(
         print('sto')
     elif msa_format == 'a3m':
         # TBD - research what kind of preprocessing required for a3m - if any 
+        msa_for_templates = input_msa_str
         print('a3m')
     else:
         raise ValueError(
           f'File format not supported by HHSearch: {msa_format}.')
 
-    template_hits = runner.query(msa_for_templates)
+    with metrics.timed('tool_seconds'):
+        template_hits = runner.query(msa_for_templates)
 
-    with open(output_path, 'w') as f:
-        f.write(template_hits)
+    with metrics.timed('write_seconds'):
+        artifact_io.write_text(output_path, template_hits, compression)
     logging.info(f"Saved results to {output_path}")
 
 
+def main(config: RunnerConfig):
+    metrics = runner_metrics.RunnerMetrics()
+    # Fails before staging the databases if the tool is not supported.
+    import_tool(config.template_tool)
+
+    if config.staging_dir:
+        import db_staging
+
+        staging_cache = db_staging.StagingCache(
+            remote_root=config.databases_root,
+            staging_dir=config.staging_dir,
+            max_bytes=int(config.staging_max_gb * 1e9),
+            num_workers=config.staging_num_workers)
+        with metrics.timed('staging_seconds'):
+            database_paths = [
+                    staging_cache.stage(database_path)
+                    for database_path in config.database_paths]
+    else:
+        database_paths = [
+                os.path.join(config.databases_root, database_path) 
+                for database_path in config.database_paths]
+
+    run_hhsearch(
+        input_path=config.input_path,
+        database_paths=database_paths,
+        maxseq=config.maxseq,
+        output_path=config.output_path,
+        metrics=metrics,
+        compression=config.output_compression
+    )
+
+    if config.metrics_path:
+        metrics.record_output(config.output_path, 'hhr')
+        metrics.write(config.metrics_path)
+
+
 if __name__=='__main__':
     logging.basicConfig(format='%(asctime)s - %(message)s',
                         level=logging.INFO, 
                         datefmt='%d-%m-%y %H:%M:%S',
                         stream=sys.stdout)
 
-    database_paths = [
-            os.path.join(DATABASES_ROOT, database_path) 
-            for database_path in DATABASE_PATHS.split(',')]
-
-    if TEMPLATE_TOOL == 'hhsearch':
-        database_path = DATABASE_PATHS.split(',')[0]
-        run_hhsearch(
-            input_msa_path=MSA_PATH,
-            database_paths=database_paths,
-            maxseq=MAXSEQ,
-            output_dir=OUTPUT_DIR
-        )
+    config = RunnerConfig.from_environ()
+    if config.profile:
+        # Imported here so that runs without profiling do not pay for it.
+        import runner_profiling
+        with runner_profiling.profiled(
+                config.output_path,
+                top_n=config.profile_top_n,
+                rss_interval=config.profile_rss_interval):
+            main(config)
     else:
-      raise ValueError(
-          f'Unsupported tool {TEMPLATE_TOOL}.') 
\ No newline at end of file
+        main(config)
@@ -17,7 +17,7 @@ import os
 from re import I
 
 from kfp.v2 import dsl
-from kfp.v2.dsl import Output, Input, Artifact, Dataset
+from kfp.v2.dsl import Output, Input, Artifact, Dataset, Metrics
 
 
 _COMPONENTS_IMAGE = os.getenv('COMPONENTS_IMAGE', 'gcr.io/jk-mlops-dev/alphafold-components')
@@ -40,11 +40,17 @@ def template_search(
     template_hits: Output[Dataset],
     template_features: Output[Dataset],
     cls_logging: Output[Artifact],
+    metrics: Output[Metrics],
     machine_type:str='c2-standard-8',
     n_cpu:int=8,
     boot_disk_size:int=200,
     maxseq:int=1_000_000,
     max_template_hits:int=20, 
+    template_tool:str='hhsearch',
+    num_shards:int=8,
+    cache_root:str='',
+    compression:str='none',
+    profile:bool=False,
     ):
     """Searches for protein templates 
 
@@ -55,18 +61,52 @@ def template_search(
     he prototype also lacks job control. If a pipeline step fails, the CLS job can get 
     orphaned
 
+    If cache_root (a local directory or a gs:// prefix) is set, the results are
+    looked up by a hash of the sequence, MSA, databases, tool and tool settings
+    before submitting the job, and stored there after a successful run.
+
+    If profile is set, the hmmsearch runner runs under cProfile and
+    tracemalloc and samples its memory use; the hhsearch runner is not
+    profiled. The profiles are uploaded next to the template hits as files
+    named after them with the suffixes .prof, .prof.txt, .tracemalloc,
+    .tracemalloc.txt, .rss.tsv and .profile.json.
+
+    The queue time, VM boot time, tool time, CPU time, peak memory and number
+    of hits are logged to the metrics output and added to the metadata of the
+    template hits.
+
     """
     
     import logging
     import os
     import sys
+    import time
 
     from dsub_wrapper import run_dsub_job
+    from job_metrics import log_job_metrics, metrics_path, read_job_metrics
+    from log_follower import LogFollower, make_source
+    from step_cache import StepCache, file_digest, make_cache_key, sequence_digest
 
     _DSUB_PROVIDER = 'google-cls-v2'
     _LOG_INTERVAL = '30s'
-    _ALPHAFOLD_RUNNER_IMAGE = 'gcr.io/jk-mlops-dev/alphafold'
-    _SCRIPT = '/scripts/alphafold_runners/hhsearch_runner.py'
+    _LOG_NAME = 'job'
+    # Built from pipelines/Dockerfile.runners, with the pipeline modules
+    # the runner scripts import under /app/alphafold_runners.
+    _ALPHAFOLD_RUNNER_IMAGE = 'gcr.io/jk-mlops-dev/alphafold-runners'
+
+    _TOOL_TO_SETTINGS_MAPPING = {
+       'hhsearch': {
+           'OUTPUT_DATA_FORMAT': 'hhr',
+           'SCRIPT': '/scripts/alphafold_runners/hhsearch_runner.py'
+       },
+       'hmmsearch': {
+           'OUTPUT_DATA_FORMAT': 'a3m',
+           'SCRIPT': '/scripts/alphafold_runners/hmmsearch_runner.py'
+       },
+    }
+
+    if template_tool not in _TOOL_TO_SETTINGS_MAPPING:
+        raise RuntimeError(f'The template search tool {template_tool} not supported')
    
     # For a prototype we are hardcoding some values. Whe productionizing
     # we can make them compile time or runtime parameters
@@ -91,44 +131,101 @@ def template_search(
     sequence_path = sequence.uri
     msa_path = msa.uri
     msa_data_format = msa.metadata['data_format']
-    template_hits.metadata['data_format'] = 'hhr'
+    template_hits.metadata['data_format'] = _TOOL_TO_SETTINGS_MAPPING[template_tool]['OUTPUT_DATA_FORMAT']
+    template_hits.metadata['compression'] = compression
     template_features.metadata['data_format'] = 'pkl'
 
+    cache_outputs = {
+        'template_hits': template_hits.path,
+        'template_features': template_features.path,
+    }
+    cache = StepCache(cache_root) if cache_root else None
+    if cache:
+        # The number of shards does not change the hits, so it is not part of the key.
+        cache_key = make_cache_key(
+            step='template_search',
+            sequence=sequence_digest(sequence.path),
+            msa=file_digest(msa.path),
+            msa_data_format=msa_data_format,
+            disk_image=disk_image,
+            databases=database_paths,
+            mmcif_path=mmcif_path,
+            obsolete_path=obsolete_path,
+            max_template_date=max_template_date,
+            maxseq=maxseq,
+            max_template_hits=max_template_hits,
+            tool=template_tool,
+            script=_TOOL_TO_SETTINGS_MAPPING[template_tool]['SCRIPT'],
+            compression=compression,
+        )
+        cached_metadata = cache.lookup('template_search', cache_key, cache_outputs)
+        if cached_metadata is not None:
+            template_hits.metadata.update(cached_metadata['template_hits'])
+            template_features.metadata.update(cached_metadata['template_features'])
+            metrics.log_metric('cache_hit', 1.0)
+            return
+
     job_params = [
         '--machine-type', machine_type,
         '--boot-disk-size', str(boot_disk_size),
-        '--logging', cls_logging.uri,
+        '--logging', f'{cls_logging.uri}/{_LOG_NAME}.log',
         '--log-interval', _LOG_INTERVAL, 
         '--image', _ALPHAFOLD_RUNNER_IMAGE,
-        '--env', f'PYTHONPATH=/app/alphafold',
+        '--env', 'PYTHONPATH=/app/alphafold:/app/alphafold_runners',
         '--mount', f'DB_ROOT={disk_image}',
         '--input', f'INPUT_SEQUENCE_PATH={sequence_path}',
         '--input', f'INPUT_MSA_PATH={msa_path}',
         '--output', f'OUTPUT_TEMPLATE_HITS_PATH={template_hits.uri}',
         '--output', f'OUTPUT_TEMPLATE_FEATURES_PATH={template_features.uri}',
+        '--output', f'METRICS_PATH={metrics_path(template_hits.uri)}',
         '--env', f'MSA_DATA_FORMAT={msa_data_format}',
+        '--env', f'TEMPLATE_TOOL={template_tool}',
+        '--env', f'NUM_SHARDS={num_shards}',
         '--env', f'DB_PATHS={database_paths}',
         '--env', f'MMCIF_PATH={mmcif_path}',
         '--env', f'OBSOLETE_PATH={obsolete_path}',
         '--env', f'N_CPU={n_cpu}',
         '--env', f'MAXSEQ={maxseq}', 
         '--env', f'MAX_TEMPLATE_HITS={max_template_hits}',
-        '--evn', f'MAX_TEMPLATE_DATE={max_template_date}', 
-        '--script', _SCRIPT, 
+        '--env', f'OUTPUT_COMPRESSION={compression}',
+        '--env', f'MAX_TEMPLATE_DATE={max_template_date}',
+        '--script', _TOOL_TO_SETTINGS_MAPPING[template_tool]['SCRIPT'], 
     ]
-
-    result = run_dsub_job(
-        provider=_DSUB_PROVIDER,
-        project=project,
-        regions=region,
-        params=job_params,
-    ) 
-
-    
-
-    
-    
-
-
-
-    
+    if profile and template_tool != 'hmmsearch':
+        logging.warning(f'The {template_tool} runner does not support '
+                        'profiling, running it without.')
+        profile = False
+    if profile:
+        job_params += [
+            '--env', 'PROFILE_RUNNER=1',
+            '--output', f'PROFILE_FILES={template_hits.uri}.*',
+        ]
+
+    # Forwards the output of the runner while the job runs, reading only
+    # what was appended since the last upload of the log.
+    follower = LogFollower(
+        make_source(f'{cls_logging.uri}/{_LOG_NAME}-stdout.log'),
+        prefix=f'[{template_tool}] ').start()
+    submit_time = time.time()
+    try:
+        result = run_dsub_job(
+            provider=_DSUB_PROVIDER,
+            project=project,
+            regions=region,
+            params=job_params,
+        )
+    finally:
+        follower.stop()
+
+    metrics.log_metric('cache_hit', 0.0)
+    log_job_metrics(
+        metrics,
+        read_job_metrics(template_hits.uri, submit_time, time.time()),
+        artifacts=[template_hits],
+        extra_metadata={'machine_type': machine_type})
+
+    if cache:
+        cache.store('template_search', cache_key, cache_outputs, {
+            'template_hits': dict(template_hits.metadata),
+            'template_features': dict(template_features.metadata),
+        })
@@ -0,0 +1,124 @@
+"""Reads and writes MSA and search result artifacts with compression.
+
+Stockholm, A3M and HHR outputs are very redundant text and can be hundreds of
+MB, so compressing them cuts the upload and download time between pipeline
+steps. Writers choose the compression explicitly. Readers detect it from the
+first bytes of the file, so compressed and uncompressed artifacts can be
+read by the same code whatever their file name.
+
+gzip output is compressed in independent chunks by a thread pool and written
+as a multi-member gzip stream, which any gzip reader decompresses. zstd
+output uses the multi-threaded compressor of the `zstandard` package, which
+is only needed if zstd artifacts are written or read.
+"""
+
+import concurrent.futures
+import gzip
+import io
+import os
+from typing import IO, Optional
+
+from alphafold.data import parsers
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+NONE = 'none'
+GZIP = 'gzip'
+ZSTD = 'zstd'
+COMPRESSIONS = (NONE, GZIP, ZSTD)
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_GZIP_CHUNK_SIZE = 8 << 20
+
+
+def _check_zstandard():
+  if zstandard is None:
+    raise ImportError('The zstandard package is required for zstd artifacts.')
+
+
+def sniff_compression(path: str) -> str:
+  """Detects the compression of a file from its magic number."""
+  with open(path, 'rb') as f:
+    magic = f.read(len(_ZSTD_MAGIC))
+  if magic.startswith(_GZIP_MAGIC):
+    return GZIP
+  if magic.startswith(_ZSTD_MAGIC):
+    return ZSTD
+  return NONE
+
+
+def compress(data: bytes,
+             compression: str,
+             level: Optional[int] = None,
+             num_threads: int = 0) -> bytes:
+  """Compresses bytes, using up to `num_threads` threads (0 for all CPUs)."""
+  num_threads = num_threads or os.cpu_count()
+  if compression == NONE:
+    return data
+  if compression == GZIP:
+    level = 6 if level is None else level
+    chunks = [data[i:i + _GZIP_CHUNK_SIZE]
+              for i in range(0, len(data), _GZIP_CHUNK_SIZE)] or [b'']
+    # zlib releases the GIL, so the chunks are compressed in parallel.
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+      return b''.join(executor.map(
+          lambda chunk: gzip.compress(chunk, compresslevel=level, mtime=0),
+          chunks))
+  if compression == ZSTD:
+    _check_zstandard()
+    level = 3 if level is None else level
+    return zstandard.ZstdCompressor(
+        level=level, threads=num_threads).compress(data)
+  raise ValueError(f'Unsupported compression: {compression}')
+
+
+def write_text(path: str,
+               text: str,
+               compression: str = NONE,
+               level: Optional[int] = None,
+               num_threads: int = 0):
+  """Writes text to a file with the given compression."""
+  data = compress(text.encode(), compression, level, num_threads)
+  with open(path, 'wb') as f:
+    f.write(data)
+
+
+def open_text(path: str) -> IO[str]:
+  """Opens a possibly compressed text file for streaming reads."""
+  compression = sniff_compression(path)
+  if compression == GZIP:
+    return gzip.open(path, 'rt')
+  if compression == ZSTD:
+    _check_zstandard()
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        open(path, 'rb'), closefd=True)
+    return io.TextIOWrapper(io.BufferedReader(reader))
+  return open(path)
+
+
+def read_text(path: str) -> str:
+  """Reads a possibly compressed text file."""
+  with open_text(path) as f:
+    return f.read()
+
+
+def truncate_stockholm_msa(stockholm_msa_path: str,
+                           max_sequences: int) -> str:
+  """`parsers.truncate_stockholm_msa` for possibly compressed files."""
+  seqnames = set()
+  with open_text(stockholm_msa_path) as f:
+    for line in f:
+      if line.strip() and not line.startswith(('#', '//')):
+        seqnames.add(line.partition(' ')[0])
+        if len(seqnames) >= max_sequences:
+          break
+
+  # Compressed streams cannot seek back, so the file is read again.
+  with open_text(stockholm_msa_path) as f:
+    return ''.join(
+        line for line in f
+        if parsers._keep_line(line, seqnames))  # pylint: disable=protected-access
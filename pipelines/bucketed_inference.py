@@ -0,0 +1,263 @@
+"""Runs AlphaFold models on features padded to a few length buckets.
+
+XLA compiles the model for every new input shape, and with one shape per
+target length a new target pays a compilation per model that can take as
+long as the prediction itself. Here the processed features are padded to the
+smallest of a few configured lengths (buckets), the way the input pipeline
+pads MSAs to a fixed depth, and compiled models are cached per (model
+config, data config, bucket). Models with the same config, such as the
+model parameters sets of one preset, share a compiled function, and models
+with the same data config share their processed features. Padded residues
+are masked out by the model and cropped from the outputs, and the confidence
+metrics are computed on the cropped outputs.
+
+Compile and execute times are reported separately.
+"""
+
+import collections
+import dataclasses
+import json
+import time
+from typing import Any, Callable, Dict, Mapping, Optional, Sequence, Tuple
+
+from absl import logging
+from alphafold.common import confidence
+from alphafold.model import config
+from alphafold.model import data
+from alphafold.model import features
+from alphafold.model import modules
+from alphafold.model.tf import shape_placeholders
+import haiku as hk
+import jax
+import numpy as np
+import tree
+
+FeatureDict = Dict[str, np.ndarray]
+PredictionCallback = Callable[[str, Dict[str, Any], FeatureDict], None]
+
+DEFAULT_BUCKETS = (64, 128, 256, 384, 512, 768, 1024, 1280, 1536, 2048,
+                   2560, 3072, 4096)
+
+# Outputs whose first axis is the MSA depth rather than residues.
+_MSA_OUTPUTS = ('masked_msa/logits', 'representations/msa')
+
+
+def select_bucket(num_res: int, buckets: Sequence[int]) -> int:
+  """Returns the smallest bucket that fits, or `num_res` if none does."""
+  for bucket in sorted(buckets):
+    if bucket >= num_res:
+      return bucket
+  logging.warning('No bucket fits %d residues, compiling for this length.',
+                  num_res)
+  return num_res
+
+
+def pad_features(feat: FeatureDict, schema: Mapping[str, Sequence[Any]],
+                 num_res: int, bucket: int) -> FeatureDict:
+  """Pads the residue axes of processed features to `bucket` with zeros.
+
+  Args:
+    feat: Processed features, with leading ensemble/recycling axes.
+    schema: Shape schema of the features, `config.data.eval.feat`.
+    num_res: Number of residues of the target.
+    bucket: Padded number of residues.
+
+  Returns:
+    The padded features.
+  """
+  if bucket == num_res:
+    return feat
+  padded = {}
+  for name, value in feat.items():
+    shape_schema = schema.get(name, ())
+    offset = value.ndim - len(shape_schema)
+    padding = [(0, 0)] * value.ndim
+    for axis, dim in enumerate(shape_schema):
+      if (dim == shape_placeholders.NUM_RES and
+          value.shape[offset + axis] == num_res):
+        padding[offset + axis] = (0, bucket - num_res)
+    if any(after for _, after in padding):
+      value = np.pad(value, padding)
+    padded[name] = value
+  return padded
+
+
+def crop_prediction(prediction: Mapping[str, Any], num_res: int,
+                    bucket: int) -> Dict[str, Any]:
+  """Crops the padded residues from the model outputs."""
+  if bucket == num_res:
+    return dict(prediction)
+
+  def crop(path, value):
+    value = np.asarray(value)
+    path = '/'.join(str(p) for p in path)
+    if path in _MSA_OUTPUTS:
+      axes = (1,)
+    else:
+      axes = (0, 1)
+    index = tuple(
+        slice(0, num_res) if axis in axes and value.shape[axis] == bucket
+        else slice(None) for axis in range(min(value.ndim, 2)))
+    return value[index]
+
+  return tree.map_structure_with_path(crop, dict(prediction))
+
+
+def confidence_metrics(prediction: Mapping[str, Any]) -> Dict[str, Any]:
+  """Computes pLDDT and, for pTM models, PAE and pTM."""
+  metrics = {'plddt': confidence.compute_plddt(
+      prediction['predicted_lddt']['logits'])}
+  if 'predicted_aligned_error' in prediction:
+    metrics.update(confidence.compute_predicted_aligned_error(
+        prediction['predicted_aligned_error']['logits'],
+        prediction['predicted_aligned_error']['breaks']))
+    metrics['ptm'] = confidence.predicted_tm_score(
+        prediction['predicted_aligned_error']['logits'],
+        prediction['predicted_aligned_error']['breaks'])
+  return metrics
+
+
+def _config_key(config_dict) -> str:
+  return json.dumps(json.loads(config_dict.to_json_best_effort()),
+                    sort_keys=True)
+
+
+@dataclasses.dataclass
+class Timings:
+  """Seconds spent in each step, summed over models and targets."""
+  process_seconds: float = 0.0
+  compile_seconds: float = 0.0
+  execute_seconds: float = 0.0
+  num_compilations: int = 0
+  num_processed: int = 0
+  num_predictions: int = 0
+
+  def to_dict(self) -> Dict[str, Any]:
+    return dataclasses.asdict(self)
+
+
+class BucketedModelRunner:
+  """Runs several models on targets, reusing compilations across targets."""
+
+  def __init__(self,
+               model_names: Sequence[str],
+               params_dir: str,
+               buckets: Sequence[int] = DEFAULT_BUCKETS,
+               num_ensemble: int = 1,
+               random_seed: int = 0):
+    """Initializes the runner.
+
+    Args:
+      model_names: Names of the models, e.g. `model_1` or `model_2_ptm`.
+      params_dir: Directory with the `params` subdirectory of model weights.
+      buckets: Lengths the residues are padded to.
+      num_ensemble: Number of ensembled evaluations of each model.
+      random_seed: Random seed of feature processing and of the models.
+    """
+    self.buckets = tuple(sorted(buckets))
+    self.random_seed = random_seed
+    self.timings = Timings()
+    self._configs = {}
+    self._params = {}
+    self._apply = {}
+    for model_name in model_names:
+      model_config = config.model_config(model_name)
+      model_config.data.eval.num_ensemble = num_ensemble
+      self._configs[model_name] = model_config
+      self._params[model_name] = data.get_model_haiku_params(
+          model_name=model_name, data_dir=params_dir)
+      model_key = _config_key(model_config.model)
+      if model_key not in self._apply:
+        self._apply[model_key] = self._make_apply(model_config)
+    self._compiled = {}
+
+    groups = collections.defaultdict(list)
+    for model_name, model_config in self._configs.items():
+      groups[_config_key(model_config.model)].append(model_name)
+    logging.info('%d models share %d model configs: %s', len(model_names),
+                 len(groups), list(groups.values()))
+
+  @staticmethod
+  def _make_apply(model_config):
+
+    def _forward_fn(batch):
+      model = modules.AlphaFold(model_config.model)
+      return model(
+          batch,
+          is_training=False,
+          compute_loss=False,
+          ensemble_representations=True)
+
+    return jax.jit(hk.transform(_forward_fn).apply)
+
+  def _compiled_apply(self, model_name: str, feat: FeatureDict,
+                      bucket: int):
+    """Returns the compiled model, compiling it on the first use."""
+    model_config = self._configs[model_name]
+    model_key = _config_key(model_config.model)
+    key = (model_key, _config_key(model_config.data), bucket)
+    if key not in self._compiled:
+      t_0 = time.time()
+      self._compiled[key] = self._apply[model_key].lower(
+          self._params[model_name], jax.random.PRNGKey(self.random_seed),
+          feat).compile()
+      elapsed = time.time() - t_0
+      self.timings.compile_seconds += elapsed
+      self.timings.num_compilations += 1
+      logging.info('Compiled %s for %d residues in %.1f s.', model_name,
+                   bucket, elapsed)
+    return self._compiled[key]
+
+  def predict(self,
+              raw_features: FeatureDict,
+              on_prediction: Optional[PredictionCallback] = None
+              ) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, FeatureDict]]:
+    """Runs all models on the raw features of a target.
+
+    Args:
+      raw_features: Features of the data pipeline.
+      on_prediction: Called with the model name, prediction and processed
+        features as soon as each model finishes.
+
+    Returns:
+      A tuple of (prediction of every model, processed features of every
+      model, unpadded).
+    """
+    num_res = int(raw_features['seq_length'][0])
+    bucket = select_bucket(num_res, self.buckets)
+    processed_by_data_config = {}
+    predictions = {}
+    processed = {}
+    for model_name, model_config in self._configs.items():
+      data_key = _config_key(model_config.data)
+      if data_key not in processed_by_data_config:
+        t_0 = time.time()
+        feat = features.np_example_to_features(
+            np_example=raw_features, config=model_config,
+            random_seed=self.random_seed)
+        processed_by_data_config[data_key] = (
+            feat, pad_features(feat, model_config.data.eval.feat, num_res,
+                               bucket))
+        self.timings.process_seconds += time.time() - t_0
+        self.timings.num_processed += 1
+      feat, padded_feat = processed_by_data_config[data_key]
+
+      compiled = self._compiled_apply(model_name, padded_feat, bucket)
+      t_0 = time.time()
+      prediction = compiled(self._params[model_name],
+                            jax.random.PRNGKey(self.random_seed), padded_feat)
+      prediction = jax.tree_map(np.asarray, prediction)
+      elapsed = time.time() - t_0
+      self.timings.execute_seconds += elapsed
+      self.timings.num_predictions += 1
+      logging.info('Ran %s on %d residues (bucket %d) in %.1f s.', model_name,
+                   num_res, bucket, elapsed)
+
+      prediction = crop_prediction(prediction, num_res, bucket)
+      prediction.update(confidence_metrics(prediction))
+      predictions[model_name] = prediction
+      processed[model_name] = feat
+      if on_prediction is not None:
+        on_prediction(model_name, prediction, feat)
+    return predictions, processed
+
@@ -0,0 +1,104 @@
+"""Builds a seed index for a FASTA database and validates its recall.
+
+In `build` mode the index for --database_path is written to --index_dir.
+In `validate` mode every sequence in --fasta_paths is searched with jackhmmer
+against both the full database and the shortlist of the index, and the
+fraction of the full search hits found by the prefiltered search is
+reported.
+"""
+
+import json
+import os
+import shutil
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from alphafold.data.tools import jackhmmer
+
+import kmer_prefilter
+
+FLAGS = flags.FLAGS
+
+logging.set_verbosity(logging.INFO)
+
+flags.DEFINE_enum('mode', 'build', ['build', 'validate'],
+                  'Build the index or validate it against full searches.')
+flags.DEFINE_string('database_path', None, 'Path to the FASTA database.')
+flags.DEFINE_string('index_dir', None, 'Path to the index directory.')
+flags.DEFINE_string('seed_pattern', kmer_prefilter.DEFAULT_SEED_PATTERN,
+                    'Spaced seed pattern of care (1) and don\'t care (0) '
+                    'positions.')
+flags.DEFINE_integer('batch_size', 100_000, 'Number of database sequences '
+                     'processed at once while building the index.')
+flags.DEFINE_list('fasta_paths', None, 'Query FASTA files for validation.')
+flags.DEFINE_integer('min_shared_seeds', 2, 'Minimum number of seeds a '
+                     'database sequence must share with the query.')
+flags.DEFINE_integer('n_cpu', 8, 'The number of CPUs to give jackhmmer.')
+flags.DEFINE_string('jackhmmer_binary_path', shutil.which('jackhmmer'),
+                    'Path to the JackHMMER executable.')
+flags.DEFINE_string('output_path', None, 'If set, validation results are '
+                    'written to this JSON file.')
+
+
+def validate(fasta_paths, database_path, index_dir, min_shared_seeds, n_cpu):
+  full_runner = jackhmmer.Jackhmmer(
+      binary_path=FLAGS.jackhmmer_binary_path,
+      database_path=database_path,
+      n_cpu=n_cpu)
+  prefiltered_runner = kmer_prefilter.PrefilteredJackhmmer(
+      binary_path=FLAGS.jackhmmer_binary_path,
+      database_path=database_path,
+      index_dir=index_dir,
+      min_shared_seeds=min_shared_seeds,
+      n_cpu=n_cpu)
+
+  results = []
+  for fasta_path in fasta_paths:
+    t_0 = time.time()
+    full_sto = full_runner.query(fasta_path)[0]['sto']
+    t_1 = time.time()
+    prefiltered_sto = prefiltered_runner.query(fasta_path)[0]['sto']
+    t_2 = time.time()
+    result = {
+        'fasta_path': fasta_path,
+        'recall': kmer_prefilter.recall(full_sto, prefiltered_sto),
+        'full_hits': len(kmer_prefilter.target_names(full_sto)),
+        'prefiltered_hits': len(kmer_prefilter.target_names(prefiltered_sto)),
+        'full_search_seconds': t_1 - t_0,
+        'prefiltered_search_seconds': t_2 - t_1,
+    }
+    logging.info('%s', result)
+    results.append(result)
+  return results
+
+
+def main(argv):
+  if FLAGS.mode == 'build':
+    kmer_prefilter.build_index(
+        fasta_path=FLAGS.database_path,
+        index_dir=FLAGS.index_dir,
+        seed_pattern=FLAGS.seed_pattern,
+        batch_size=FLAGS.batch_size)
+    return
+
+  results = validate(
+      fasta_paths=FLAGS.fasta_paths,
+      database_path=FLAGS.database_path,
+      index_dir=FLAGS.index_dir,
+      min_shared_seeds=FLAGS.min_shared_seeds,
+      n_cpu=FLAGS.n_cpu)
+  if FLAGS.output_path:
+    os.makedirs(os.path.dirname(FLAGS.output_path) or '.', exist_ok=True)
+    with open(FLAGS.output_path, 'w') as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__=='__main__':
+  flags.mark_flags_as_required([
+      'database_path',
+      'index_dir',
+  ])
+  app.run(main)
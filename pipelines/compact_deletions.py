@@ -0,0 +1,111 @@
+"""Compact storage for MSA deletion matrices.
+
+Most entries of a deletion matrix are zero and the non-zero ones are small,
+so the dense int32 form the model consumes is mostly wasted space. Deletion
+counts are kept in saturating narrow integer dtypes while the features are
+built, and can be further packed into a CSR-style sparse encoding for
+feature files. The int32 form is only restored when the features are handed
+to the model.
+"""
+
+import dataclasses
+from typing import MutableMapping
+
+import numpy as np
+
+FeatureDict = MutableMapping[str, np.ndarray]
+
+DELETION_MATRIX_KEY = 'deletion_matrix_int'
+_SPARSE_KEYS = ('indptr', 'indices', 'values', 'shape')
+
+
+def saturate(deletion_matrix: np.ndarray,
+             dtype: np.dtype = np.uint8) -> np.ndarray:
+  """Casts deletion counts to an unsigned dtype, clipping at its maximum."""
+  dtype = np.dtype(dtype)
+  if dtype.kind != 'u':
+    raise ValueError(f'Deletion matrix dtype must be unsigned, got {dtype}.')
+  deletion_matrix = np.asarray(deletion_matrix)
+  if deletion_matrix.dtype == dtype:
+    return deletion_matrix
+  return np.minimum(deletion_matrix, np.iinfo(dtype).max).astype(dtype)
+
+
+@dataclasses.dataclass(frozen=True)
+class SparseDeletionMatrix:
+  """A deletion matrix in compressed sparse row form.
+
+  Attributes:
+    shape: (num_alignments, num_res) of the dense matrix.
+    indptr: int64 array of shape (num_alignments + 1,). The non-zero entries
+      of row i are at positions indptr[i]:indptr[i + 1] of `indices` and
+      `values`.
+    indices: Column of every non-zero entry.
+    values: Deletion count of every non-zero entry.
+  """
+  shape: tuple
+  indptr: np.ndarray
+  indices: np.ndarray
+  values: np.ndarray
+
+  @classmethod
+  def from_dense(cls, deletion_matrix: np.ndarray) -> 'SparseDeletionMatrix':
+    deletion_matrix = np.asarray(deletion_matrix)
+    if deletion_matrix.ndim != 2:
+      raise ValueError(
+          f'Deletion matrix must be 2D, got shape {deletion_matrix.shape}.')
+    rows, columns = np.nonzero(deletion_matrix)
+    index_dtype = np.uint16 if deletion_matrix.shape[1] <= 2**16 else np.int32
+    indptr = np.zeros(deletion_matrix.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=deletion_matrix.shape[0]),
+              out=indptr[1:])
+    return cls(shape=tuple(deletion_matrix.shape),
+               indptr=indptr,
+               indices=columns.astype(index_dtype),
+               values=deletion_matrix[rows, columns])
+
+  @property
+  def nbytes(self) -> int:
+    return self.indptr.nbytes + self.indices.nbytes + self.values.nbytes
+
+  def to_dense(self, dtype: np.dtype = np.int32) -> np.ndarray:
+    dense = np.zeros(self.shape, dtype=dtype)
+    rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+    dense[rows, self.indices.astype(np.int64)] = self.values
+    return dense
+
+
+def pack_features(features: FeatureDict) -> FeatureDict:
+  """Replaces the dense deletion matrix with its sparse encoding.
+
+  The sparse arrays are stored under `deletion_matrix_int_<field>` keys so
+  that the feature dict stays a flat mapping of numpy arrays.
+  """
+  features = dict(features)
+  sparse = SparseDeletionMatrix.from_dense(features.pop(DELETION_MATRIX_KEY))
+  features[f'{DELETION_MATRIX_KEY}_indptr'] = sparse.indptr
+  features[f'{DELETION_MATRIX_KEY}_indices'] = sparse.indices
+  features[f'{DELETION_MATRIX_KEY}_values'] = sparse.values
+  features[f'{DELETION_MATRIX_KEY}_shape'] = np.array(sparse.shape,
+                                                      dtype=np.int64)
+  return features
+
+
+def unpack_features(features: FeatureDict,
+                    dtype: np.dtype = np.int32) -> FeatureDict:
+  """Restores the dense deletion matrix in the dtype expected by the model.
+
+  Accepts both packed feature dicts and dense ones in a narrow dtype. Feature
+  dicts without a deletion matrix are returned unchanged.
+  """
+  features = dict(features)
+  if DELETION_MATRIX_KEY in features:
+    features[DELETION_MATRIX_KEY] = features[DELETION_MATRIX_KEY].astype(dtype)
+    return features
+  if f'{DELETION_MATRIX_KEY}_indptr' not in features:
+    return features
+  fields = {key: features.pop(f'{DELETION_MATRIX_KEY}_{key}')
+            for key in _SPARSE_KEYS}
+  fields['shape'] = tuple(int(x) for x in fields['shape'])
+  features[DELETION_MATRIX_KEY] = SparseDeletionMatrix(**fields).to_dense(dtype)
+  return features
@@ -0,0 +1,97 @@
+"""Tests for compact_deletions."""
+
+import os
+import pickle
+
+from absl.testing import absltest
+from alphafold.common import residue_constants
+import numpy as np
+
+import compact_deletions
+
+try:
+  from alphafold.model import config as model_config
+  from alphafold.model import features as model_features
+except ImportError:  # TensorFlow is only installed in the inference image.
+  model_features = None
+
+
+def _make_features(num_alignments: int = 6, num_res: int = 12):
+  rng = np.random.default_rng(0)
+  sequence = 'ACDEFGHIKLMN'[:num_res]
+  deletion_matrix = rng.integers(0, 4, size=(num_alignments, num_res))
+  deletion_matrix[rng.random(deletion_matrix.shape) < 0.7] = 0
+  deletion_matrix[1, 3] = 300
+  return {
+      'aatype': residue_constants.sequence_to_onehot(
+          sequence, residue_constants.restype_order_with_x,
+          map_unknown_to_x=True),
+      'between_segment_residues': np.zeros((num_res,), dtype=np.int32),
+      'domain_name': np.array([b'query'], dtype=np.object_),
+      'residue_index': np.arange(num_res, dtype=np.int32),
+      'seq_length': np.full((num_res,), num_res, dtype=np.int32),
+      'sequence': np.array([sequence.encode()], dtype=np.object_),
+      'msa': rng.integers(0, 21, size=(num_alignments, num_res),
+                          dtype=np.int32),
+      'num_alignments': np.full((num_res,), num_alignments, dtype=np.int32),
+      'deletion_matrix_int': deletion_matrix.astype(np.int32),
+  }
+
+
+def _round_trip(features):
+  path = os.path.join(absltest.get_default_test_tmpdir(), 'features.pkl')
+  with open(path, 'wb') as f:
+    pickle.dump(compact_deletions.pack_features(features), f, protocol=4)
+  with open(path, 'rb') as f:
+    return compact_deletions.unpack_features(pickle.load(f))
+
+
+class CompactDeletionsTest(absltest.TestCase):
+
+  def test_saturate(self):
+    saturated = compact_deletions.saturate(np.array([[0, 7, 255, 1000]]))
+    self.assertEqual(saturated.dtype, np.uint8)
+    np.testing.assert_array_equal(saturated, [[0, 7, 255, 255]])
+    with self.assertRaises(ValueError):
+      compact_deletions.saturate(np.zeros((1, 1)), np.int16)
+
+  def test_pack_and_unpack_features(self):
+    features = _make_features()
+    packed = compact_deletions.pack_features(features)
+    self.assertNotIn(compact_deletions.DELETION_MATRIX_KEY, packed)
+
+    unpacked = _round_trip(features)
+    self.assertEqual(unpacked['deletion_matrix_int'].dtype, np.int32)
+    np.testing.assert_array_equal(unpacked['deletion_matrix_int'],
+                                  features['deletion_matrix_int'])
+    self.assertCountEqual(unpacked, features)
+
+  def test_unpack_dense_and_missing(self):
+    features = _make_features()
+    narrow = dict(features, deletion_matrix_int=compact_deletions.saturate(
+        features['deletion_matrix_int'], np.uint16))
+    unpacked = compact_deletions.unpack_features(narrow)
+    self.assertEqual(unpacked['deletion_matrix_int'].dtype, np.int32)
+    np.testing.assert_array_equal(unpacked['deletion_matrix_int'],
+                                  features['deletion_matrix_int'])
+
+    del features['deletion_matrix_int']
+    self.assertCountEqual(compact_deletions.unpack_features(features),
+                          features)
+
+  @absltest.skipIf(model_features is None, 'Requires TensorFlow.')
+  def test_unpacked_features_reach_the_model(self):
+    features = _make_features()
+    expected = features['deletion_matrix_int'].astype(np.float32)
+    np_example = _round_trip(features)
+    processed = model_features.np_example_to_features(
+        np_example=np_example,
+        config=model_config.model_config('model_3'),
+        random_seed=0)
+    # np_example_to_features converts the deletion matrix in place.
+    np.testing.assert_array_equal(np_example['deletion_matrix'], expected)
+    self.assertIn('msa_feat', processed)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,383 @@
+"""Stages reference database files from a slow mount onto local SSD.
+
+Jobs name the databases they need by path. Every file of a database (the
+path itself, or all files starting with the path for prefix databases such
+as the HHblits ffindex/ffdata files) is copied from the remote root, for
+example a Cloud Storage FUSE mount, to the same relative path under a local
+staging directory, and the local path is returned.
+
+Files are copied in fixed-size chunks by a pool of threads writing at their
+offset in a preallocated file. If a manifest is available, the SHA-256 of
+every chunk is checked as it is copied. Staged files are kept across jobs on
+the same host, with the total size capped and the least recently used files
+evicted first.
+
+A lock file serializes the updates of the staging state by jobs sharing the
+staging directory, but files are copied without holding it. Every staged
+file also has a pin file: a job copying the file holds an exclusive lock on
+it, and jobs using the file hold shared locks, until they release the
+database or exit. Files are only evicted if their pin file can be locked
+exclusively, and jobs that need a file being copied by another job wait for
+that copy.
+"""
+
+import concurrent.futures
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import time
+from typing import Dict, IO, Iterator, List, Mapping, Optional, Sequence
+
+from absl import logging
+
+DEFAULT_CHUNK_SIZE = 64 << 20
+MANIFEST_FILE = 'staging_manifest.json'
+_STATE_FILE = '.staging_state.json'
+_LOCK_FILE = '.staging.lock'
+_PARTIAL_SUFFIX = '.partial'
+_PIN_DIR = '.pins'
+
+# Status of the files in the staging state.
+_COPYING = 'copying'
+_STAGED = 'staged'
+
+# Open pin files of the files staged by this process, by path. They are
+# module level so that the pins outlive the StagingCache that took them.
+_pins: Dict[str, IO] = {}
+
+
+def database_files(root: str, database_path: str) -> List[str]:
+  """Relative paths of the files of a database under `root`."""
+  path = os.path.join(root, database_path)
+  if os.path.isfile(path):
+    return [database_path]
+  files = sorted(f for f in glob.glob(glob.escape(path) + '*')
+                 if os.path.isfile(f))
+  return [os.path.relpath(f, root) for f in files]
+
+
+def _chunk_digest(path: str, offset: int, size: int) -> str:
+  with open(path, 'rb') as f:
+    f.seek(offset)
+    return hashlib.sha256(f.read(size)).hexdigest()
+
+
+def build_manifest(remote_root: str,
+                   database_paths: Sequence[str],
+                   chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   num_workers: int = 8) -> Dict[str, Dict]:
+  """Computes the size and chunk checksums of the files of some databases."""
+  files = {}
+  with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+    for database_path in database_paths:
+      for relative_path in database_files(remote_root, database_path):
+        path = os.path.join(remote_root, relative_path)
+        size = os.path.getsize(path)
+        digests = executor.map(
+            lambda offset, path=path: _chunk_digest(path, offset, chunk_size),
+            range(0, size, chunk_size))
+        files[relative_path] = {'size': size, 'chunk_sha256': list(digests)}
+  return {'chunk_size': chunk_size, 'files': files}
+
+
+def write_manifest(manifest: Mapping[str, Dict], output_path: str):
+  with open(output_path, 'w') as f:
+    json.dump(manifest, f, indent=2)
+
+
+class StagingCache:
+  """Local copies of remote database files with LRU eviction."""
+
+  def __init__(self,
+               remote_root: str,
+               staging_dir: str,
+               max_bytes: int,
+               num_workers: int = 8,
+               chunk_size: int = DEFAULT_CHUNK_SIZE,
+               manifest_path: Optional[str] = None):
+    """Initializes the staging cache.
+
+    Args:
+      remote_root: Root of the remote database mount.
+      staging_dir: Local directory holding the staged files.
+      max_bytes: Maximum total size of the staged files.
+      num_workers: Number of threads copying chunks.
+      chunk_size: Size of the copied chunks. Ignored if there is a manifest,
+        whose chunk size is used instead.
+      manifest_path: Path of the manifest with chunk checksums. Defaults to
+        `staging_manifest.json` in the remote root, if it exists.
+    """
+    self.remote_root = remote_root
+    self.staging_dir = staging_dir
+    self.max_bytes = max_bytes
+    self.num_workers = num_workers
+    self.chunk_size = chunk_size
+    self.manifest = None
+    if manifest_path is None:
+      manifest_path = os.path.join(remote_root, MANIFEST_FILE)
+      if not os.path.exists(manifest_path):
+        manifest_path = None
+    if manifest_path is not None:
+      with open(manifest_path) as f:
+        self.manifest = json.load(f)
+      self.chunk_size = self.manifest['chunk_size']
+    os.makedirs(staging_dir, exist_ok=True)
+
+  @contextlib.contextmanager
+  def _locked_state(self) -> Iterator[Dict[str, Dict]]:
+    """Yields the staging state under an exclusive lock and saves it.
+
+    The state is saved even if the block raises, so that the files it
+    copied or removed before failing stay accounted for.
+    """
+    with open(os.path.join(self.staging_dir, _LOCK_FILE), 'w') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      state_path = os.path.join(self.staging_dir, _STATE_FILE)
+      state = {}
+      if os.path.exists(state_path):
+        with open(state_path) as f:
+          state = json.load(f)
+      try:
+        yield state
+      finally:
+        with open(state_path + '.tmp', 'w') as f:
+          json.dump(state, f)
+        os.replace(state_path + '.tmp', state_path)
+
+  def _open_pin(self, relative_path: str) -> IO:
+    path = os.path.join(self.staging_dir, _PIN_DIR, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return open(path, 'a')
+
+  def _try_lock(self, relative_path: str, operation: int) -> Optional[IO]:
+    """Locks the pin file of a file without blocking, or returns None."""
+    pin = self._open_pin(relative_path)
+    try:
+      fcntl.flock(pin, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+      pin.close()
+      return None
+    return pin
+
+  def _pin(self, relative_path: str, pin: Optional[IO] = None):
+    """Holds a shared lock on the pin file of a file until it is released.
+
+    Must be called with the state locked, so that no other job is trying to
+    lock it exclusively to evict the file.
+    """
+    path = os.path.join(self.staging_dir, _PIN_DIR, relative_path)
+    if path in _pins:
+      if pin is not None:
+        pin.close()
+      return
+    if pin is None:
+      pin = self._open_pin(relative_path)
+    fcntl.flock(pin, fcntl.LOCK_SH)
+    _pins[path] = pin
+
+  def release(self, database_path: str):
+    """Unpins the files of a database, allowing them to be evicted.
+
+    The files of the databases staged by a process are unpinned when it
+    exits.
+    """
+    if os.path.isabs(database_path):
+      database_path = os.path.relpath(database_path, self.remote_root)
+    for relative_path in database_files(self.remote_root, database_path):
+      pin = _pins.pop(
+          os.path.join(self.staging_dir, _PIN_DIR, relative_path), None)
+      if pin is not None:
+        pin.close()
+
+  def _expected(self, relative_path: str) -> Optional[Dict]:
+    if self.manifest is None:
+      return None
+    return self.manifest['files'].get(relative_path)
+
+  def _copy_chunk(self, source: str, fd: int, offset: int,
+                  expected_digest: Optional[str]):
+    with open(source, 'rb') as f:
+      f.seek(offset)
+      data = f.read(self.chunk_size)
+    if (expected_digest is not None and
+        hashlib.sha256(data).hexdigest() != expected_digest):
+      raise ValueError(
+          f'Checksum mismatch in {source} at offset {offset}.')
+    os.pwrite(fd, data, offset)
+
+  def _copy_file(self, relative_path: str):
+    source = os.path.join(self.remote_root, relative_path)
+    target = os.path.join(self.staging_dir, relative_path)
+    size = os.path.getsize(source)
+    expected = self._expected(relative_path)
+    if expected is not None and expected['size'] != size:
+      raise ValueError(f'{source} has size {size}, the manifest has '
+                       f'{expected["size"]}.')
+    digests = expected['chunk_sha256'] if expected else None
+    if expected is None:
+      logging.warning('No checksums for %s, only its size is checked.',
+                      relative_path)
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = target + _PARTIAL_SUFFIX
+    t_0 = time.time()
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+      os.ftruncate(fd, size)
+      offsets = range(0, size, self.chunk_size)
+      with concurrent.futures.ThreadPoolExecutor(self.num_workers) as executor:
+        list(executor.map(
+            lambda i: self._copy_chunk(source, fd, offsets[i],
+                                       digests[i] if digests else None),
+            range(len(offsets))))
+    except Exception:
+      os.close(fd)
+      os.remove(partial)
+      raise
+    os.close(fd)
+    if os.path.getsize(partial) != size:
+      os.remove(partial)
+      raise ValueError(f'Incomplete copy of {source}.')
+    os.replace(partial, target)
+    elapsed = time.time() - t_0
+    logging.info('Staged %s (%.1f MB) in %.1f s.', relative_path,
+                 size / 1e6, elapsed)
+
+  def _evict(self, state: Dict[str, Dict], needed_bytes: int,
+             keep: Sequence[str]) -> bool:
+    """Removes least recently used files until `needed_bytes` fit.
+
+    Files being copied or pinned by a job are kept. Nothing is removed if
+    `needed_bytes` would not fit even after evicting all other files.
+
+    Returns:
+      Whether `needed_bytes` fit.
+    """
+    used = sum(entry['size'] for entry in state.values())
+    evicted = []
+    try:
+      for relative_path in sorted(state,
+                                  key=lambda p: state[p]['last_used']):
+        if used + needed_bytes <= self.max_bytes:
+          break
+        if (relative_path in keep or
+            state[relative_path].get('status', _STAGED) != _STAGED):
+          continue
+        pin = self._try_lock(relative_path, fcntl.LOCK_EX)
+        if pin is None:
+          continue
+        evicted.append((relative_path, pin))
+        used -= state[relative_path]['size']
+      if used + needed_bytes > self.max_bytes:
+        return False
+      for relative_path, _ in evicted:
+        logging.info('Evicting %s from %s.', relative_path, self.staging_dir)
+        with contextlib.suppress(FileNotFoundError):
+          os.remove(os.path.join(self.staging_dir, relative_path))
+        del state[relative_path]
+      return True
+    finally:
+      for _, pin in evicted:
+        pin.close()
+
+  def stage(self, database_path: str) -> str:
+    """Stages the files of a database, pins them and returns its local path.
+
+    Args:
+      database_path: Path of the database, relative to the remote root or
+        absolute under it.
+
+    Returns:
+      The path of the database under the staging directory, or the remote
+      path if the database does not fit in the size cap.
+    """
+    if os.path.isabs(database_path):
+      database_path = os.path.relpath(database_path, self.remote_root)
+    remote_path = os.path.join(self.remote_root, database_path)
+    files = database_files(self.remote_root, database_path)
+    if not files:
+      raise ValueError(f'No files found for database {remote_path}.')
+
+    while True:
+      # Files this job copies, with their exclusively locked pin files, and
+      # files other jobs are copying.
+      claimed = {}
+      copying = []
+      with self._locked_state() as state:
+        for f in files:
+          entry = state.get(f)
+          if (entry is not None and entry.get('status', _STAGED) == _STAGED
+              and os.path.exists(os.path.join(self.staging_dir, f))):
+            continue
+          # A copy whose job has exited no longer holds its pin file.
+          pin = self._try_lock(f, fcntl.LOCK_EX)
+          if pin is None and entry is not None and entry.get(
+              'status') == _COPYING:
+            copying.append(f)
+            continue
+          if pin is None:
+            # The file went missing while other jobs have it pinned.
+            logging.warning('%s cannot be restaged while it is in use, '
+                            'reading %s from %s.', f, database_path,
+                            self.remote_root)
+            for pin in claimed.values():
+              pin.close()
+            return remote_path
+          state.pop(f, None)
+          claimed[f] = pin
+        sizes = {f: os.path.getsize(os.path.join(self.remote_root, f))
+                 for f in claimed}
+        needed_bytes = sum(sizes.values())
+        resident_bytes = sum(state[f]['size'] for f in files if f in state)
+        if (needed_bytes + resident_bytes > self.max_bytes or
+            not self._evict(state, needed_bytes, keep=files)):
+          for pin in claimed.values():
+            pin.close()
+          logging.warning('%s (%.1f GB) does not fit in the staging cache, '
+                          'reading it from %s.', database_path,
+                          (needed_bytes + resident_bytes) / 1e9,
+                          self.remote_root)
+          return remote_path
+        for f in claimed:
+          state[f] = {'size': sizes[f], 'last_used': time.time(),
+                      'status': _COPYING}
+        for f in files:
+          if f not in claimed and f not in copying:
+            self._pin(f)
+            state[f]['last_used'] = time.time()
+
+      self._copy_claimed(claimed)
+      if not copying:
+        return os.path.join(self.staging_dir, database_path)
+      logging.info('Waiting for other jobs to stage %s.', copying)
+      for f in copying:
+        with self._open_pin(f) as pin:
+          fcntl.flock(pin, fcntl.LOCK_SH)
+      # Pins the files the other jobs staged, or takes over the copies that
+      # failed.
+
+  def _copy_claimed(self, claimed: Dict[str, IO]):
+    """Copies files whose pin files are locked exclusively, then pins them.
+
+    Files whose copy fails are removed from the state.
+    """
+    copied = []
+    try:
+      for f in claimed:
+        self._copy_file(f)
+        copied.append(f)
+    finally:
+      with self._locked_state() as state:
+        for f, pin in claimed.items():
+          if f in copied:
+            state[f]['status'] = _STAGED
+            state[f]['last_used'] = time.time()
+            # Converting the lock is not atomic, but evictions are
+            # excluded by the state lock.
+            self._pin(f, pin)
+          else:
+            state.pop(f, None)
+            pin.close()
@@ -0,0 +1,207 @@
+"""Tests for db_staging, with a slow local directory as the remote root."""
+
+import filecmp
+import json
+import multiprocessing
+import os
+import time
+
+from unittest import mock
+
+from absl.testing import absltest
+
+import db_staging
+
+_FILE_SIZE = 100_000
+_CHUNK_SIZE = 32 << 10
+_DB_SIZE = 2 * _FILE_SIZE
+_COPY_LOG = 'copies.log'
+
+# Jobs sharing a staging directory run in separate processes, which inherit
+# the slow remote patched in by the test.
+_mp = multiprocessing.get_context('fork')
+
+
+def _slow_copy_chunk(copy_chunk):
+
+  def wrapper(self, *args):
+    time.sleep(0.1)
+    return copy_chunk(self, *args)
+
+  return wrapper
+
+
+def _logged_copy_file(copy_file, log_path):
+
+  def wrapper(self, relative_path):
+    with open(log_path, 'a') as f:
+      f.write(relative_path + '\n')
+    return copy_file(self, relative_path)
+
+  return wrapper
+
+
+def _stage(cache_args, database_path, results):
+  cache = db_staging.StagingCache(**cache_args)
+  results.put(cache.stage(database_path))
+
+
+def _stage_and_hold(cache_args, database_path, staged, done):
+  cache = db_staging.StagingCache(**cache_args)
+  cache.stage(database_path)
+  staged.set()
+  done.wait(30)
+
+
+class StagingCacheTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.remote_root = self.create_tempdir('remote').full_path
+    self.staging_dir = self.create_tempdir('staging').full_path
+    for db in ('a', 'b', 'c'):
+      os.makedirs(os.path.join(self.remote_root, db))
+      for i in range(2):
+        with open(os.path.join(self.remote_root, db, f'{db}_{i}'), 'wb') as f:
+          f.write(os.urandom(_FILE_SIZE))
+
+    self.copy_log = os.path.join(self.create_tempdir().full_path, _COPY_LOG)
+    StagingCache = db_staging.StagingCache
+    self.enter_context(mock.patch.object(
+        StagingCache, '_copy_chunk',
+        _slow_copy_chunk(StagingCache._copy_chunk)))
+    self.enter_context(mock.patch.object(
+        StagingCache, '_copy_file',
+        _logged_copy_file(StagingCache._copy_file, self.copy_log)))
+    self.addCleanup(self._release_all)
+
+  def _release_all(self):
+    for pin in db_staging._pins.values():
+      pin.close()
+    db_staging._pins.clear()
+
+  def _cache_args(self, **kwargs):
+    args = dict(remote_root=self.remote_root, staging_dir=self.staging_dir,
+                max_bytes=10 * _DB_SIZE, num_workers=2,
+                chunk_size=_CHUNK_SIZE)
+    args.update(kwargs)
+    return args
+
+  def _cache(self, **kwargs):
+    return db_staging.StagingCache(**self._cache_args(**kwargs))
+
+  def _state(self):
+    with open(os.path.join(self.staging_dir, '.staging_state.json')) as f:
+      return json.load(f)
+
+  def _copies(self):
+    if not os.path.exists(self.copy_log):
+      return []
+    with open(self.copy_log) as f:
+      return sorted(f.read().split())
+
+  def _staged(self, db):
+    return [f for f in (f'{db}/{db}_0', f'{db}/{db}_1')
+            if os.path.exists(os.path.join(self.staging_dir, f))]
+
+  def test_stage(self):
+    cache = self._cache()
+    path = cache.stage(os.path.join(self.remote_root, 'a', 'a'))
+    self.assertEqual(path, os.path.join(self.staging_dir, 'a', 'a'))
+    for i in range(2):
+      self.assertTrue(filecmp.cmp(
+          os.path.join(self.remote_root, 'a', f'a_{i}'), f'{path}_{i}',
+          shallow=False))
+    self.assertEqual(sorted(os.listdir(os.path.join(self.staging_dir, 'a'))),
+                     ['a_0', 'a_1'])
+    self.assertEqual(
+        {f: entry['status'] for f, entry in self._state().items()},
+        {'a/a_0': 'staged', 'a/a_1': 'staged'})
+
+    # Staged files are reused.
+    self.assertEqual(cache.stage('a/a'), path)
+    self.assertEqual(self._copies(), ['a/a_0', 'a/a_1'])
+
+  def test_checksum_mismatch(self):
+    db_staging.write_manifest(
+        db_staging.build_manifest(self.remote_root, ['a/a'], _CHUNK_SIZE),
+        os.path.join(self.remote_root, db_staging.MANIFEST_FILE))
+    with open(os.path.join(self.remote_root, 'a', 'a_1'), 'r+b') as f:
+      f.seek(_CHUNK_SIZE + 1)
+      f.write(b'\0' if f.read(1) != b'\0' else b'\1')
+
+    cache = self._cache()
+    with self.assertRaisesRegex(ValueError, 'Checksum mismatch'):
+      cache.stage('a/a')
+    self.assertEqual(os.listdir(os.path.join(self.staging_dir, 'a')),
+                     ['a_0'])
+    self.assertEqual(list(self._state()), ['a/a_0'])
+
+  def test_does_not_fit(self):
+    cache = self._cache(max_bytes=_DB_SIZE - 1)
+    self.assertEqual(cache.stage('a/a'),
+                     os.path.join(self.remote_root, 'a', 'a'))
+    self.assertEqual(self._staged('a'), [])
+    self.assertEqual(self._copies(), [])
+
+  def test_eviction_skips_pinned_files(self):
+    args = self._cache_args(max_bytes=2 * _DB_SIZE)
+    staged, done = _mp.Event(), _mp.Event()
+    job = _mp.Process(target=_stage_and_hold,
+                      args=(args, 'b/b', staged, done))
+    job.start()
+    self.addCleanup(job.join)
+    self.addCleanup(done.set)
+    self.assertTrue(staged.wait(30))
+
+    # `b` is the least recently used, but another job has it pinned.
+    cache = db_staging.StagingCache(**args)
+    cache.stage('a/a')
+    cache.release('a/a')
+    self.assertEqual(cache.stage('c/c'),
+                     os.path.join(self.staging_dir, 'c', 'c'))
+    self.assertEqual(self._staged('a'), [])
+    self.assertLen(self._staged('b'), 2)
+    self.assertLen(self._staged('c'), 2)
+
+    # Nothing can be evicted while both `b` and `c` are pinned.
+    self.assertEqual(cache.stage('a/a'),
+                     os.path.join(self.remote_root, 'a', 'a'))
+    self.assertEqual(self._staged('a'), [])
+
+  def test_release(self):
+    cache = self._cache(max_bytes=_DB_SIZE)
+    cache.stage('a/a')
+    self.assertEqual(cache.stage('b/b'),
+                     os.path.join(self.remote_root, 'b', 'b'))
+
+    cache.release('a/a')
+    self.assertEqual(db_staging._pins, {})
+    self.assertEqual(cache.stage('b/b'),
+                     os.path.join(self.staging_dir, 'b', 'b'))
+    self.assertEqual(self._staged('a'), [])
+    self.assertEqual(sorted(self._state()), ['b/b_0', 'b/b_1'])
+
+  def test_concurrent_stages_copy_once(self):
+    args = self._cache_args()
+    results = _mp.Queue()
+    jobs = [_mp.Process(target=_stage, args=(args, 'a/a', results))
+            for _ in range(2)]
+    for job in jobs:
+      job.start()
+    paths = [results.get(timeout=30) for _ in jobs]
+    for job in jobs:
+      job.join()
+
+    self.assertEqual(paths, [os.path.join(self.staging_dir, 'a', 'a')] * 2)
+    self.assertEqual(self._copies(), ['a/a_0', 'a/a_1'])
+    self.assertEqual(
+        {f: entry['status'] for f, entry in self._state().items()},
+        {'a/a_0': 'staged', 'a/a_1': 'staged'})
+    self.assertFalse(any(
+        f.endswith('.partial')
+        for f in os.listdir(os.path.join(self.staging_dir, 'a'))))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,336 @@
+"""Array-backed representation of multiple sequence alignments.
+
+Each tool output is parsed once into an `EncodedMsa`. Residues are kept as
+a 2D uint8 array of ASCII codes, descriptions live in a single bytes buffer
+indexed by offsets, and the deletion matrix is a 2D numpy array. Template
+preparation (deduplication, empty column removal, A3M/Stockholm
+serialization) and featurization operate on views of these arrays instead of
+re-parsing the alignment text.
+"""
+
+import dataclasses
+import functools
+from typing import List, Optional, Sequence
+
+from alphafold.common import residue_constants
+from alphafold.data import parsers
+import numpy as np
+
+import compact_deletions
+
+_GAP = ord('-')
+
+# Deletion counts are saturated at the maximum of this dtype, which is well
+# above the length of any protein sequence.
+_DELETION_DTYPE = np.uint16
+
+# Maps an ASCII code to the HHblits residue id used by the MSA features.
+# Unknown symbols are mapped to X.
+_ASCII_TO_HHBLITS_ID = np.full(
+    256, residue_constants.HHBLITS_AA_TO_ID['X'], dtype=np.int8)
+for _res, _res_id in residue_constants.HHBLITS_AA_TO_ID.items():
+  _ASCII_TO_HHBLITS_ID[ord(_res)] = _res_id
+
+# Maps an ASCII code to its lowercase equivalent.
+_ASCII_TO_LOWER = np.arange(256, dtype=np.uint8)
+_ASCII_TO_LOWER[ord('A'):ord('Z') + 1] += ord('a') - ord('A')
+
+
+def _pack_descriptions(descriptions: Sequence[str]):
+  """Packs descriptions into a single buffer and an offsets array."""
+  encoded = [d.encode('utf-8') for d in descriptions]
+  offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+  np.cumsum([len(d) for d in encoded], out=offsets[1:])
+  return b''.join(encoded), offsets
+
+
+@dataclasses.dataclass(frozen=True)
+class EncodedMsa:
+  """An MSA stored as residue, deletion and description arrays.
+
+  Attributes:
+    alignment: uint8 array of shape (num_sequences, num_columns) with the
+      ASCII codes of the aligned rows. For Stockholm input the columns that
+      are insertions relative to the query are kept. For A3M input only the
+      query columns are kept and insertions are recorded in the deletion
+      matrix.
+    query_mask: bool array of shape (num_columns,), True for the columns in
+      which the query (first row) has a residue.
+    deletion_matrix: uint16 array of shape (num_sequences, num_res). The
+      element at [i, j] is the number of residues deleted from sequence i
+      before query residue j.
+    description_buffer: The UTF-8 encoded descriptions of all rows.
+    description_offsets: int64 array of shape (num_sequences + 1,) with the
+      boundaries of each description in `description_buffer`.
+    reference: Optional uint8 array of shape (num_columns,) with the ASCII
+      codes of the `#=GC RF` annotation of a Stockholm alignment. jackhmmer
+      marks the match states of its profile there, which can differ from the
+      query columns, and hmmbuild uses it to build template profiles.
+  """
+  alignment: np.ndarray
+  query_mask: np.ndarray
+  deletion_matrix: np.ndarray
+  description_buffer: bytes
+  description_offsets: np.ndarray
+  reference: Optional[np.ndarray] = None
+
+  def __post_init__(self):
+    if not (self.alignment.shape[0] ==
+            self.deletion_matrix.shape[0] ==
+            self.description_offsets.shape[0] - 1):
+      raise ValueError(
+          'All fields for an MSA must have the same length. '
+          f'Got {self.alignment.shape[0]} sequences, '
+          f'{self.deletion_matrix.shape[0]} rows in the deletion matrix and '
+          f'{self.description_offsets.shape[0] - 1} descriptions.')
+    if (self.reference is not None and
+        self.reference.shape != self.query_mask.shape):
+      raise ValueError(
+          f'Reference annotation has {self.reference.shape[0]} columns, '
+          f'the alignment has {self.query_mask.shape[0]}.')
+
+  def __len__(self):
+    return self.alignment.shape[0]
+
+  @property
+  def num_res(self) -> int:
+    return int(np.count_nonzero(self.query_mask))
+
+  @functools.cached_property
+  def residues(self) -> np.ndarray:
+    """ASCII codes of the residues aligned to the query, (num_seqs, num_res)."""
+    if self.query_mask.all():
+      return self.alignment
+    return np.ascontiguousarray(self.alignment[:, self.query_mask])
+
+  @property
+  def encoded(self) -> np.ndarray:
+    """HHblits residue ids of the residues aligned to the query."""
+    return _ASCII_TO_HHBLITS_ID[self.residues]
+
+  @property
+  def sequences(self) -> List[str]:
+    return [row.tobytes().decode('ascii') for row in self.residues]
+
+  def description(self, index: int) -> str:
+    start, end = self.description_offsets[index:index + 2]
+    return self.description_buffer[start:end].decode('utf-8')
+
+  @property
+  def descriptions(self) -> List[str]:
+    return [self.description(i) for i in range(len(self))]
+
+  @classmethod
+  def from_stockholm(cls,
+                     stockholm_string: str,
+                     max_sequences: Optional[int] = None) -> 'EncodedMsa':
+    """Parses a Stockholm alignment. The first sequence must be the query."""
+    name_to_chunks = {}
+    reference_chunks = []
+    for line in stockholm_string.splitlines():
+      line = line.strip()
+      if line.startswith('#=GC RF'):
+        reference_chunks.append(line.split()[-1])
+        continue
+      if not line or line.startswith(('#', '//')):
+        continue
+      name, sequence = line.split()
+      if name not in name_to_chunks:
+        if max_sequences is not None and len(name_to_chunks) >= max_sequences:
+          continue
+        name_to_chunks[name] = []
+      name_to_chunks[name].append(sequence)
+    if not name_to_chunks:
+      raise ValueError('Stockholm alignment contains no sequences.')
+
+    rows = [''.join(chunks).encode('ascii')
+            for chunks in name_to_chunks.values()]
+    num_columns = len(rows[0])
+    if any(len(row) != num_columns for row in rows):
+      raise ValueError('Stockholm alignment rows have different lengths.')
+    alignment = np.frombuffer(b''.join(rows), dtype=np.uint8).reshape(
+        len(rows), num_columns)
+    query_mask = alignment[0] != _GAP
+    reference = None
+    if reference_chunks:
+      reference = np.frombuffer(''.join(reference_chunks).encode('ascii'),
+                                dtype=np.uint8)
+      if len(reference) != num_columns:
+        raise ValueError('Stockholm reference annotation and alignment rows '
+                         'have different lengths.')
+
+    # Residues in the columns where the query has a gap are deletions. The
+    # deletion count of a query residue is the number of such residues seen
+    # since the previous query residue.
+    inserted = (alignment != _GAP) & ~query_mask
+    inserted_so_far = np.cumsum(inserted, axis=1, dtype=np.int32)
+    at_query_residues = inserted_so_far[:, query_mask]
+    deletion_matrix = np.diff(at_query_residues, axis=1, prepend=0)
+    deletion_matrix = compact_deletions.saturate(deletion_matrix,
+                                                 _DELETION_DTYPE)
+
+    buffer, offsets = _pack_descriptions(list(name_to_chunks))
+    return cls(alignment=alignment,
+               query_mask=query_mask,
+               deletion_matrix=deletion_matrix,
+               description_buffer=buffer,
+               description_offsets=offsets,
+               reference=reference)
+
+  @classmethod
+  def from_a3m(cls, a3m_string: str) -> 'EncodedMsa':
+    """Parses an A3M alignment. The first sequence must be the query."""
+    sequences, descriptions = parsers.parse_fasta(a3m_string)
+    if not sequences:
+      raise ValueError('A3M alignment contains no sequences.')
+
+    flat = np.frombuffer(''.join(sequences).encode('ascii'), dtype=np.uint8)
+    lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+    row_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    inserted = (flat >= ord('a')) & (flat <= ord('z'))
+    match_positions = np.flatnonzero(~inserted)
+    matches_so_far = np.concatenate([[0], np.cumsum(~inserted)])
+    row_num_res = (matches_so_far[row_starts + lengths]
+                   - matches_so_far[row_starts])
+    num_res = int(row_num_res[0])
+    mismatched = np.flatnonzero(row_num_res != num_res)
+    if len(mismatched):
+      i = mismatched[0]
+      raise ValueError(
+          f'A3M sequence {i} ({descriptions[i]}) has {row_num_res[i]} '
+          f'aligned residues, the query has {num_res}.')
+
+    # Same as for Stockholm, but the count is reset at the start of each row.
+    inserted_so_far = np.cumsum(inserted, dtype=np.int32)
+    previous = np.empty_like(match_positions, dtype=np.int32)
+    previous[1:] = inserted_so_far[match_positions[:-1]]
+    inserted_before_row = np.where(
+        row_starts > 0, inserted_so_far[row_starts - 1], 0)
+    previous[::num_res] = inserted_before_row
+    deletion_matrix = compact_deletions.saturate(
+        inserted_so_far[match_positions] - previous, _DELETION_DTYPE)
+
+    buffer, offsets = _pack_descriptions(descriptions)
+    return cls(alignment=flat[match_positions].reshape(-1, num_res),
+               query_mask=np.ones(num_res, dtype=bool),
+               deletion_matrix=deletion_matrix.reshape(-1, num_res),
+               description_buffer=buffer,
+               description_offsets=offsets)
+
+  @classmethod
+  def from_msa(cls, msa: parsers.Msa) -> 'EncodedMsa':
+    """Converts a `parsers.Msa` into an `EncodedMsa`."""
+    alignment = np.frombuffer(
+        ''.join(msa.sequences).encode('ascii'), dtype=np.uint8).reshape(
+            len(msa), -1)
+    buffer, offsets = _pack_descriptions(msa.descriptions)
+    return cls(alignment=alignment,
+               query_mask=np.ones(alignment.shape[1], dtype=bool),
+               deletion_matrix=compact_deletions.saturate(
+                   np.array(msa.deletion_matrix), _DELETION_DTYPE),
+               description_buffer=buffer,
+               description_offsets=offsets)
+
+  def to_msa(self) -> parsers.Msa:
+    """Converts to a `parsers.Msa` for code that expects Python lists."""
+    return parsers.Msa(sequences=self.sequences,
+                       deletion_matrix=self.deletion_matrix.tolist(),
+                       descriptions=self.descriptions)
+
+  def select(self, indices: np.ndarray) -> 'EncodedMsa':
+    """Returns an MSA with the given rows, in the given order."""
+    indices = np.asarray(indices, dtype=np.int64)
+    starts = self.description_offsets[indices]
+    ends = self.description_offsets[indices + 1]
+    buffer = b''.join(
+        self.description_buffer[s:e] for s, e in zip(starts, ends))
+    offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(ends - starts, out=offsets[1:])
+    return EncodedMsa(alignment=self.alignment[indices],
+                      query_mask=self.query_mask,
+                      deletion_matrix=self.deletion_matrix[indices],
+                      description_buffer=buffer,
+                      description_offsets=offsets,
+                      reference=self.reference)
+
+  def truncate(self, max_seqs: int) -> 'EncodedMsa':
+    return self.select(np.arange(min(max_seqs, len(self))))
+
+  def unique_row_indices(self) -> np.ndarray:
+    """Indices of the first occurrence of each distinct aligned sequence.
+
+    As in `parsers.deduplicate_stockholm_msa`, insertions relative to the
+    query are ignored when comparing sequences.
+    """
+    return _first_unique_rows(self.residues)
+
+  def deduplicate(self) -> 'EncodedMsa':
+    """Removes duplicate sequences (ignoring insertions wrt query)."""
+    return self.select(self.unique_row_indices())
+
+  def remove_empty_columns(self) -> 'EncodedMsa':
+    """Removes columns that contain only gaps."""
+    keep = (self.alignment != _GAP).any(axis=0)
+    if keep.all():
+      return self
+    return dataclasses.replace(
+        self,
+        alignment=self.alignment[:, keep],
+        query_mask=self.query_mask[keep],
+        reference=None if self.reference is None else self.reference[keep])
+
+  def to_a3m(self) -> str:
+    """Serializes to A3M, with insertions as lowercase residues."""
+    in_query = np.broadcast_to(self.query_mask, self.alignment.shape)
+    keep = in_query | (self.alignment != _GAP)
+    symbols = np.where(in_query, self.alignment,
+                       _ASCII_TO_LOWER[self.alignment])
+    flat = symbols[keep].tobytes().decode('ascii')
+    ends = np.cumsum(keep.sum(axis=1))
+    starts = np.concatenate([[0], ends[:-1]])
+    fasta_chunks = (f'>{self.description(i)}\n{flat[s:e]}'
+                    for i, (s, e) in enumerate(zip(starts, ends)))
+    return '\n'.join(fasta_chunks) + '\n'  # Include terminating newline.
+
+  def to_stockholm(self) -> str:
+    """Serializes to Stockholm, with a reference annotation.
+
+    The parsed `#=GC RF` annotation is written back unchanged. MSAs without
+    one, such as those read from A3M, get one that marks the query columns.
+    """
+    names = self.descriptions
+    width = max(len(name) for name in names + ['#=GC RF'])
+    lines = ['# STOCKHOLM 1.0', '']
+    for name, row in zip(names, self.alignment):
+      lines.append(f'{name:<{width}} {row.tobytes().decode("ascii")}')
+    if self.reference is not None:
+      reference = self.reference.tobytes().decode('ascii')
+    else:
+      reference = ''.join('x' if q else '.' for q in self.query_mask)
+    lines.append(f'{"#=GC RF":<{width}} {reference}')
+    lines.append('//')
+    return '\n'.join(lines) + '\n'
+
+
+def _first_unique_rows(rows: np.ndarray) -> np.ndarray:
+  """Sorted indices of the first occurrence of each distinct row."""
+  rows = np.ascontiguousarray(rows)
+  as_void = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1])))
+  _, first_indices = np.unique(as_void.ravel(), return_index=True)
+  return np.sort(first_indices)
+
+
+def first_unique_rows_across(msas: Sequence[EncodedMsa]) -> List[np.ndarray]:
+  """Deduplicates sequences across MSAs, keeping the first occurrence.
+
+  Args:
+    msas: MSAs aligned to the same query.
+
+  Returns:
+    For every MSA, the sorted indices of the rows whose aligned sequence does
+    not occur earlier in this MSA or in any of the preceding MSAs.
+  """
+  keep = _first_unique_rows(np.concatenate([msa.residues for msa in msas]))
+  bounds = np.cumsum([0] + [len(msa) for msa in msas])
+  return [keep[(keep >= lo) & (keep < hi)] - lo
+          for lo, hi in zip(bounds[:-1], bounds[1:])]
@@ -0,0 +1,301 @@
+"""Seed index used to shrink the database searched by jackhmmer.
+
+An index is built offline for a FASTA database. It maps every spaced seed
+(a k-mer read through a pattern of care and don't-care positions) to the
+sorted ids of the database sequences that contain it, in compressed sparse
+row form, together with the byte offset of every FASTA record. All arrays
+are stored as .npy files and memory-mapped at query time.
+
+At query time the sequences sharing at least `min_shared_seeds` seeds with
+the query are written to a temporary FASTA file and jackhmmer searches that
+file instead of the full database. The database size is passed to jackhmmer
+with -Z so that E-values match those of the full search.
+"""
+
+import contextlib
+import dataclasses
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from typing import Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from absl import logging
+from alphafold.data import parsers
+from alphafold.data.tools import jackhmmer
+import numpy as np
+
+DEFAULT_SEED_PATTERN = '1101011'
+_ALPHABET = b'ACDEFGHIKLMNPQRSTVWY'
+_ALPHABET_SIZE = len(_ALPHABET)
+_INVALID = _ALPHABET_SIZE
+# Seed codes and in-batch sequence indices are packed into one int64.
+_MAX_SEED_WEIGHT = 7
+
+_METADATA_FILE = 'metadata.json'
+_SEED_OFFSETS_FILE = 'seed_offsets.npy'
+_POSTINGS_FILE = 'postings.npy'
+_RECORD_OFFSETS_FILE = 'record_offsets.npy'
+
+# Maps an ASCII code to its index in the alphabet. Other symbols, including
+# lowercase residues, never form seeds.
+_ASCII_TO_INDEX = np.full(256, _INVALID, dtype=np.uint8)
+_ASCII_TO_INDEX[np.frombuffer(_ALPHABET, dtype=np.uint8)] = np.arange(
+    _ALPHABET_SIZE)
+
+
+def _care_positions(seed_pattern: str) -> np.ndarray:
+  if not seed_pattern or set(seed_pattern) - {'0', '1'}:
+    raise ValueError(f'Invalid seed pattern: {seed_pattern}.')
+  if seed_pattern[0] != '1' or seed_pattern[-1] != '1':
+    raise ValueError('Seed patterns must start and end with a care position.')
+  if seed_pattern.count('1') > _MAX_SEED_WEIGHT:
+    raise ValueError(
+        f'Seed patterns can have at most {_MAX_SEED_WEIGHT} care positions.')
+  return np.array([i for i, c in enumerate(seed_pattern) if c == '1'])
+
+
+def seed_codes(sequences: Sequence[bytes],
+               seed_pattern: str) -> Tuple[np.ndarray, np.ndarray]:
+  """Computes the seeds of a batch of sequences.
+
+  Args:
+    sequences: Unaligned residue strings.
+    seed_pattern: String of '1' (care) and '0' (don't care) positions.
+
+  Returns:
+    A tuple of (codes, sequence_indices), one entry per distinct seed of
+    every sequence, sorted by code and then by sequence index.
+  """
+  care = _care_positions(seed_pattern)
+  span = len(seed_pattern)
+  lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+  flat = _ASCII_TO_INDEX[np.frombuffer(b''.join(sequences), dtype=np.uint8)]
+  sequence_index = np.repeat(np.arange(len(sequences)), lengths)
+  num_starts = len(flat) - span + 1
+  if num_starts <= 0:
+    return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+  codes = np.zeros(num_starts, dtype=np.int64)
+  valid = sequence_index[:num_starts] == sequence_index[span - 1:]
+  for position in care:
+    residues = flat[position:position + num_starts]
+    valid &= residues != _INVALID
+    codes = codes * _ALPHABET_SIZE + residues
+  keys = np.unique(codes[valid] << 32 | sequence_index[:num_starts][valid])
+  return keys >> 32, keys & 0xFFFFFFFF
+
+
+def _read_fasta_records(
+    fasta_path: str,
+    batch_size: int) -> Iterator[Tuple[List[int], List[bytes]]]:
+  """Yields batches of (record byte offsets, sequences) from a FASTA file."""
+  offsets, sequences, chunks = [], [], None
+  position = 0
+  with open(fasta_path, 'rb') as f:
+    for line in f:
+      if line.startswith(b'>'):
+        if chunks is not None:
+          sequences.append(b''.join(chunks))
+          if len(sequences) == batch_size:
+            yield offsets, sequences
+            offsets, sequences = [], []
+        offsets.append(position)
+        chunks = []
+      elif chunks is not None:
+        chunks.append(line.strip().upper())
+      position += len(line)
+  if chunks is not None:
+    sequences.append(b''.join(chunks))
+    yield offsets, sequences
+
+
+def build_index(fasta_path: str,
+                index_dir: str,
+                seed_pattern: str = DEFAULT_SEED_PATTERN,
+                batch_size: int = 100_000):
+  """Builds a seed index for a FASTA database.
+
+  Two passes are made over the database. The first counts the sequences per
+  seed, the second writes the sequence ids into a memory-mapped postings
+  array at the offsets derived from the counts.
+  """
+  os.makedirs(index_dir, exist_ok=True)
+  num_codes = _ALPHABET_SIZE ** len(_care_positions(seed_pattern))
+
+  counts = np.zeros(num_codes, dtype=np.int64)
+  record_offsets = []
+  for offsets, sequences in _read_fasta_records(fasta_path, batch_size):
+    codes, _ = seed_codes(sequences, seed_pattern)
+    counts += np.bincount(codes, minlength=num_codes)
+    record_offsets.extend(offsets)
+  record_offsets.append(os.path.getsize(fasta_path))
+  num_sequences = len(record_offsets) - 1
+  logging.info('Counted seeds of %d sequences in %s.', num_sequences,
+               fasta_path)
+
+  seed_offsets = np.zeros(num_codes + 1, dtype=np.int64)
+  np.cumsum(counts, out=seed_offsets[1:])
+  postings = np.lib.format.open_memmap(
+      os.path.join(index_dir, _POSTINGS_FILE), mode='w+', dtype=np.uint32,
+      shape=(int(seed_offsets[-1]),))
+  cursor = seed_offsets[:-1].copy()
+  first_sequence = 0
+  for _, sequences in _read_fasta_records(fasta_path, batch_size):
+    codes, sequence_indices = seed_codes(sequences, seed_pattern)
+    unique_codes, starts, group_sizes = np.unique(
+        codes, return_index=True, return_counts=True)
+    rank = np.arange(len(codes)) - np.repeat(starts, group_sizes)
+    postings[cursor[codes] + rank] = first_sequence + sequence_indices
+    cursor[unique_codes] += group_sizes
+    first_sequence += len(sequences)
+  postings.flush()
+  del postings
+
+  np.save(os.path.join(index_dir, _SEED_OFFSETS_FILE), seed_offsets)
+  np.save(os.path.join(index_dir, _RECORD_OFFSETS_FILE),
+          np.array(record_offsets, dtype=np.int64))
+  with open(os.path.join(index_dir, _METADATA_FILE), 'w') as f:
+    json.dump({
+        'fasta_path': os.path.abspath(fasta_path),
+        'fasta_size': os.path.getsize(fasta_path),
+        'seed_pattern': seed_pattern,
+        'num_sequences': num_sequences,
+    }, f, indent=2)
+  logging.info('Wrote seed index with %d postings to %s.',
+               int(seed_offsets[-1]), index_dir)
+
+
+@dataclasses.dataclass(frozen=True)
+class SeedIndex:
+  """A memory-mapped seed index."""
+  seed_pattern: str
+  num_sequences: int
+  fasta_path: str
+  seed_offsets: np.ndarray
+  postings: np.ndarray
+  record_offsets: np.ndarray
+
+  @classmethod
+  def load(cls, index_dir: str,
+           fasta_path: Optional[str] = None) -> 'SeedIndex':
+    """Loads an index, optionally for a copy of the database at another path."""
+    with open(os.path.join(index_dir, _METADATA_FILE)) as f:
+      metadata = json.load(f)
+    fasta_path = fasta_path or metadata['fasta_path']
+    if os.path.getsize(fasta_path) != metadata['fasta_size']:
+      raise ValueError(
+          f'{fasta_path} does not match the database the index in '
+          f'{index_dir} was built for.')
+    return cls(
+        seed_pattern=metadata['seed_pattern'],
+        num_sequences=metadata['num_sequences'],
+        fasta_path=fasta_path,
+        seed_offsets=np.load(
+            os.path.join(index_dir, _SEED_OFFSETS_FILE), mmap_mode='r'),
+        postings=np.load(
+            os.path.join(index_dir, _POSTINGS_FILE), mmap_mode='r'),
+        record_offsets=np.load(
+            os.path.join(index_dir, _RECORD_OFFSETS_FILE), mmap_mode='r'))
+
+  def candidates(self,
+                 query_sequence: str,
+                 min_shared_seeds: int = 2,
+                 max_candidates: Optional[int] = None) -> np.ndarray:
+    """Returns the sorted ids of sequences sharing seeds with the query."""
+    codes, _ = seed_codes([query_sequence.upper().encode('ascii')],
+                          self.seed_pattern)
+    if not len(codes):
+      return np.zeros(0, dtype=np.int64)
+    starts = self.seed_offsets[codes]
+    ends = self.seed_offsets[codes + 1]
+    hits = np.concatenate(
+        [self.postings[s:e] for s, e in zip(starts, ends)]).astype(np.int64)
+    sequence_ids, shared = np.unique(hits, return_counts=True)
+    selected = shared >= min_shared_seeds
+    sequence_ids, shared = sequence_ids[selected], shared[selected]
+    if max_candidates is not None and len(sequence_ids) > max_candidates:
+      top = np.argsort(-shared, kind='stable')[:max_candidates]
+      sequence_ids = sequence_ids[top]
+    return np.sort(sequence_ids)
+
+  def write_subset(self, sequence_ids: np.ndarray, output_path: str):
+    """Copies the FASTA records of the given sequences to a new file."""
+    with open(self.fasta_path, 'rb') as f, open(output_path, 'wb') as out:
+      if not len(sequence_ids):
+        return
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as database:
+        for sequence_id in sequence_ids:
+          out.write(database[self.record_offsets[sequence_id]:
+                             self.record_offsets[sequence_id + 1]])
+
+
+class PrefilteredJackhmmer:
+  """Runs jackhmmer over the database sequences shortlisted by a seed index.
+
+  Has the same `query` interface as `jackhmmer.Jackhmmer` so that it can be
+  used wherever the full-database runner is.
+  """
+
+  def __init__(self,
+               *,
+               binary_path: str,
+               database_path: str,
+               index_dir: str,
+               min_shared_seeds: int = 2,
+               max_candidates: Optional[int] = None,
+               **jackhmmer_kwargs):
+    self.binary_path = binary_path
+    self.database_path = database_path
+    self.index = SeedIndex.load(index_dir, fasta_path=database_path)
+    self.min_shared_seeds = min_shared_seeds
+    self.max_candidates = max_candidates
+    self.jackhmmer_kwargs = jackhmmer_kwargs
+
+  @contextlib.contextmanager
+  def _mini_database(self, input_fasta_path: str) -> Iterator[str]:
+    with open(input_fasta_path) as f:
+      query_sequences, _ = parsers.parse_fasta(f.read())
+    if len(query_sequences) != 1:
+      raise ValueError(
+          f'More than one input sequence found in {input_fasta_path}.')
+    sequence_ids = self.index.candidates(
+        query_sequences[0], self.min_shared_seeds, self.max_candidates)
+    logging.info('Seed index shortlisted %d of %d sequences in %s.',
+                 len(sequence_ids), self.index.num_sequences,
+                 self.database_path)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      database_path = os.path.join(tmp_dir, 'shortlist.fasta')
+      self.index.write_subset(sequence_ids, database_path)
+      yield database_path
+    finally:
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+
+  def query(self, input_fasta_path: str,
+            max_sequences: Optional[int] = None) -> Sequence[Mapping[str, str]]:
+    with self._mini_database(input_fasta_path) as database_path:
+      runner = jackhmmer.Jackhmmer(
+          binary_path=self.binary_path,
+          database_path=database_path,
+          z_value=self.index.num_sequences,
+          **self.jackhmmer_kwargs)
+      if max_sequences is None:
+        return runner.query(input_fasta_path)
+      return runner.query(input_fasta_path, max_sequences)
+
+
+def target_names(stockholm_string: str) -> List[str]:
+  """Names of the sequences in a Stockholm alignment, without the query."""
+  names = parsers.parse_stockholm(stockholm_string).descriptions
+  return list(names[1:])
+
+
+def recall(full_search_sto: str, prefiltered_sto: str) -> float:
+  """Fraction of the full search hits also found by the prefiltered search."""
+  full_hits = set(target_names(full_search_sto))
+  if not full_hits:
+    return 1.0
+  prefiltered_hits = set(target_names(prefiltered_sto))
+  return len(full_hits & prefiltered_hits) / len(full_hits)
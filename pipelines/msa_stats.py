@@ -0,0 +1,132 @@
+"""Summary statistics of the MSAs used for featurization.
+
+All statistics are computed with numpy over the encoded residue arrays of
+`encoded_msa.EncodedMsa`, in chunks of rows so that deep MSAs are never
+expanded to one-hot form at once. The result is a small JSON-serializable
+dict that is written next to the MSAs for every target.
+"""
+
+import json
+from typing import Any, Dict, Iterator, Mapping
+
+import numpy as np
+
+import encoded_msa
+import msa_subsampling
+
+_GAP_ID = 21
+_IDENTITY_BINS = np.round(np.linspace(0.0, 1.0, 11), 1)
+
+
+def _chunks(encoded: np.ndarray, chunk_size: int) -> Iterator[np.ndarray]:
+  for start in range(0, len(encoded), chunk_size):
+    yield encoded[start:start + chunk_size]
+
+
+def coverage(encoded: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+  """Number of sequences with a residue at each query position."""
+  counts = np.zeros(encoded.shape[1], dtype=np.int64)
+  for chunk in _chunks(encoded, chunk_size):
+    counts += np.count_nonzero(chunk != _GAP_ID, axis=0)
+  return counts
+
+
+def identity_to_query(encoded: np.ndarray,
+                      chunk_size: int = 4096) -> np.ndarray:
+  """Sequence identity of every row to the first row (the query)."""
+  query = encoded[0]
+  identities = np.empty(len(encoded), dtype=np.float32)
+  for start in range(0, len(encoded), chunk_size):
+    chunk = encoded[start:start + chunk_size]
+    aligned = (chunk != _GAP_ID) & (query != _GAP_ID)
+    matches = np.count_nonzero((chunk == query) & aligned, axis=1)
+    identities[start:start + len(chunk)] = matches / np.maximum(
+        np.count_nonzero(aligned, axis=1), 1)
+  return identities
+
+
+def neff(encoded: np.ndarray,
+         identity_threshold: float = 0.8,
+         chunk_size: int = 1024,
+         sample_size: int = 1000,
+         seed: int = 0) -> float:
+  """Number of effective sequences at the given identity threshold.
+
+  Neff is the sum over rows of 1 / (number of rows at least
+  `identity_threshold` identical to it, itself included). A row without
+  residues in the query columns has no identity to any row, and counts as
+  its own only neighbour. For MSAs deeper
+  than `sample_size` the sum is estimated from the neighbour counts of a
+  random sample of rows, each counted exactly against the whole MSA.
+  """
+  num_rows = len(encoded)
+  if num_rows <= sample_size:
+    rows = np.arange(num_rows)
+  else:
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(num_rows, size=sample_size, replace=False))
+
+  # The sampled rows are encoded once, not once per chunk.
+  identity_to_rows = msa_subsampling.identity_to(encoded[rows])
+  neighbours = np.zeros(len(rows), dtype=np.int64)
+  for chunk in _chunks(encoded, chunk_size):
+    neighbours += np.count_nonzero(
+        identity_to_rows(chunk) >= identity_threshold, axis=1)
+  return float(num_rows / len(rows) * np.sum(1.0 / np.maximum(neighbours, 1)))
+
+
+def compute_msa_stats(msas: Mapping[str, encoded_msa.EncodedMsa],
+                      identity_threshold: float = 0.8,
+                      chunk_size: int = 4096,
+                      neff_sample_size: int = 1000) -> Dict[str, Any]:
+  """Computes the statistics of the MSAs after cross-database deduplication.
+
+  Args:
+    msas: MSAs aligned to the same query, keyed by database name, in the
+      order in which they are featurized.
+    identity_threshold: Identity threshold of the Neff computation.
+    chunk_size: Number of rows processed at once.
+    neff_sample_size: Maximum number of rows whose neighbours are counted
+      exactly when computing Neff.
+
+  Returns:
+    A JSON-serializable dict.
+  """
+  keep_per_msa = encoded_msa.first_unique_rows_across(list(msas.values()))
+  encoded = np.concatenate([msa.encoded[keep] for msa, keep in
+                            zip(msas.values(), keep_per_msa)])
+
+  per_database = {}
+  for (name, msa), keep in zip(msas.items(), keep_per_msa):
+    per_database[name] = {
+        'num_sequences': len(msa),
+        'num_unique_sequences': len(keep),
+    }
+
+  identities = identity_to_query(encoded, chunk_size)
+  histogram, _ = np.histogram(identities, bins=_IDENTITY_BINS)
+  per_position_coverage = coverage(encoded, chunk_size)
+
+  return {
+      'num_res': int(encoded.shape[1]),
+      'num_alignments': int(encoded.shape[0]),
+      'per_database': per_database,
+      'coverage': per_position_coverage.tolist(),
+      'min_coverage': int(per_position_coverage.min()),
+      'mean_coverage': float(per_position_coverage.mean()),
+      'identity_to_query': {
+          'bin_edges': _IDENTITY_BINS.tolist(),
+          'counts': histogram.tolist(),
+          'mean': float(identities.mean()),
+      },
+      'neff': {
+          'identity_threshold': identity_threshold,
+          'value': neff(encoded, identity_threshold,
+                        sample_size=neff_sample_size),
+      },
+  }
+
+
+def write_msa_stats(stats: Mapping[str, Any], output_path: str):
+  with open(output_path, 'w') as f:
+    json.dump(stats, f, indent=2)
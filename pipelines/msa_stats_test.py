@@ -0,0 +1,66 @@
+"""Tests for msa_stats."""
+
+import json
+import os
+
+from absl.testing import absltest
+from alphafold.data import parsers
+import numpy as np
+
+import encoded_msa
+import msa_stats
+
+_GAP_ID = 21
+
+
+def _brute_force_neff(encoded: np.ndarray, identity_threshold: float) -> float:
+  total = 0.0
+  for a in encoded:
+    neighbours = 0
+    for b in encoded:
+      aligned = (a != _GAP_ID) & (b != _GAP_ID)
+      identity = np.count_nonzero((a == b) & aligned) / max(
+          np.count_nonzero(aligned), 1)
+      neighbours += identity >= identity_threshold
+    total += 1.0 / max(neighbours, 1)
+  return total
+
+
+class NeffTest(absltest.TestCase):
+
+  def test_matches_brute_force(self):
+    rng = np.random.default_rng(0)
+    encoded = rng.integers(0, 22, size=(30, 12)).astype(np.int8)
+    encoded[5:10] = encoded[0]
+    self.assertAlmostEqual(msa_stats.neff(encoded, 0.8, chunk_size=7),
+                           _brute_force_neff(encoded, 0.8), places=4)
+
+  def test_empty_rows_count_once(self):
+    encoded = np.array([[0, 1, 2, 3],
+                        [0, 1, 2, 3],
+                        [_GAP_ID] * 4,
+                        [_GAP_ID] * 4], dtype=np.int8)
+    self.assertEqual(msa_stats.neff(encoded, 0.8), 3.0)
+    self.assertTrue(np.isfinite(msa_stats.neff(encoded, 0.8, sample_size=2)))
+
+  def test_stats_with_an_empty_row_are_valid_json(self):
+    msa = encoded_msa.EncodedMsa.from_msa(parsers.Msa(
+        sequences=['ACDE', 'ACDF', '----'],
+        deletion_matrix=[[0] * 4] * 3,
+        descriptions=['query', 'hit', 'empty']))
+    stats = msa_stats.compute_msa_stats({'uniref90': msa})
+    self.assertTrue(np.isfinite(stats['neff']['value']))
+
+    path = os.path.join(absltest.get_default_test_tmpdir(), 'msa_stats.json')
+    msa_stats.write_msa_stats(stats, path)
+
+    def reject(constant):
+      raise ValueError(f'Invalid JSON constant {constant}.')
+
+    with open(path) as f:
+      loaded = json.load(f, parse_constant=reject)
+    self.assertEqual(loaded['neff']['value'], stats['neff']['value'])
+
+
+if __name__ == '__main__':
+  absltest.main()
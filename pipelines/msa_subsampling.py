@@ -0,0 +1,306 @@
+"""Diversity-aware subsampling of MSAs.
+
+Instead of keeping the first N rows of a tool output, sequences are greedily
+clustered in their original (e-value) order: a row becomes a cluster
+representative unless it is at least `identity_threshold` identical to an
+earlier representative, and otherwise joins the cluster of the most similar
+one. Representatives are kept first. The remaining slots, if any, are filled
+evenly across clusters: the second row of every cluster, then the third, and
+so on, each round in the original order. With a target Neff the selection
+stops at the representatives once the target is reached.
+
+Identity between two aligned rows is the fraction of identical residues over
+the query columns where both rows have a residue. In the exact mode it is
+computed for every row against all representatives with a one-hot matrix
+product. In the approximate mode MinHash signatures over positional k-mers
+are bucketed with LSH and identity is only computed against representatives
+that share a bucket, which scales to very deep MSAs.
+"""
+
+import dataclasses
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import encoded_msa
+
+EXACT = 'exact'
+MINHASH = 'minhash'
+
+_GAP_ID = 21
+_NUM_SYMBOLS = 21  # 20 amino acids + X; gaps are not one-hot encoded.
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+@dataclasses.dataclass(frozen=True)
+class SubsamplingConfig:
+  """Settings of the subsampling stage.
+
+  Attributes:
+    max_sequences: Maximum number of rows kept, including the query.
+    identity_threshold: Rows at least this identical to a representative are
+      considered redundant.
+    target_neff: If set, stop selecting representatives once there are this
+      many, and keep only them. With greedy clustering the number of
+      representatives is the Neff of the selection at `identity_threshold`.
+    mode: Either `exact` or `minhash`. LSH only finds pairs with many shared
+      k-mers, so the minhash mode keeps some redundant rows at low identity
+      thresholds.
+    block_size: Number of rows compared at once in the exact mode.
+    kmer_size: Length of the positional k-mers hashed in the minhash mode.
+    num_bands: Number of LSH bands in the minhash mode.
+    rows_per_band: Number of MinHash values per LSH band.
+    seed: Seed of the MinHash permutations.
+  """
+  max_sequences: int
+  identity_threshold: float = 0.8
+  target_neff: Optional[float] = None
+  mode: str = EXACT
+  block_size: int = 1024
+  kmer_size: int = 3
+  num_bands: int = 16
+  rows_per_band: int = 4
+  seed: int = 0
+
+  def __post_init__(self):
+    if self.mode not in (EXACT, MINHASH):
+      raise ValueError(f'Unsupported subsampling mode: {self.mode}.')
+    if self.max_sequences < 1:
+      raise ValueError('max_sequences must be at least 1.')
+
+
+def _one_hot(encoded: np.ndarray) -> np.ndarray:
+  """Flattened one-hot encoding of HHblits ids, with all-zero gaps."""
+  num_rows, num_res = encoded.shape
+  one_hot = np.zeros((num_rows, num_res, _NUM_SYMBOLS), dtype=np.float32)
+  rows, columns = np.nonzero(encoded != _GAP_ID)
+  one_hot[rows, columns, encoded[rows, columns]] = 1
+  return one_hot.reshape(num_rows, -1)
+
+
+def identity(encoded_a: np.ndarray, encoded_b: np.ndarray) -> np.ndarray:
+  """Pairwise sequence identity between two sets of aligned rows.
+
+  Args:
+    encoded_a: HHblits ids of shape (num_a, num_res).
+    encoded_b: HHblits ids of shape (num_b, num_res).
+
+  Returns:
+    float32 array of shape (num_a, num_b).
+  """
+  return identity_to(encoded_a)(encoded_b)
+
+
+def identity_to(
+    encoded_a: np.ndarray) -> Callable[[np.ndarray], np.ndarray]:
+  """Returns a function computing `identity(encoded_a, encoded_b)`.
+
+  The one-hot encoding of `encoded_a` is built once, so the same rows can be
+  compared to many chunks of an MSA.
+  """
+  one_hot_a = _one_hot(encoded_a)
+  residues_a = (encoded_a != _GAP_ID).astype(np.float32)
+
+  def identity_to_a(encoded_b: np.ndarray) -> np.ndarray:
+    matches = one_hot_a @ _one_hot(encoded_b).T
+    residues_b = (encoded_b != _GAP_ID).astype(np.float32)
+    aligned = residues_a @ residues_b.T
+    return matches / np.maximum(aligned, 1)
+
+  return identity_to_a
+
+
+def _max_representatives(config: SubsamplingConfig) -> int:
+  if config.target_neff is None:
+    return config.max_sequences
+  return min(config.max_sequences, int(np.ceil(config.target_neff)))
+
+
+def _exact_representatives(
+    encoded: np.ndarray,
+    config: SubsamplingConfig) -> Tuple[List[int], np.ndarray]:
+  """Greedy clustering comparing each block against all representatives.
+
+  Returns:
+    The indices of the representatives, and the index in the representatives
+    of the cluster of every row, -1 for the rows after the last
+    representative that were not compared.
+  """
+  max_representatives = _max_representatives(config)
+  representatives = [0]
+  clusters = np.full(len(encoded), -1, dtype=np.int64)
+  clusters[0] = 0
+  representative_one_hot = _one_hot(encoded[:1])
+  representative_residues = (encoded[:1] != _GAP_ID).astype(np.float32)
+
+  for start in range(1, len(encoded), config.block_size):
+    if len(representatives) >= max_representatives:
+      break
+    block = encoded[start:start + config.block_size]
+    block_one_hot = _one_hot(block)
+    block_residues = (block != _GAP_ID).astype(np.float32)
+
+    # Identity with the representatives selected in previous blocks.
+    matches = block_one_hot @ representative_one_hot.T
+    aligned = block_residues @ representative_residues.T
+    identities = matches / np.maximum(aligned, 1)
+    redundant = (identities >= config.identity_threshold).any(axis=1)
+    clusters[start + np.flatnonzero(redundant)] = identities[redundant].argmax(
+        axis=1)
+
+    # Rows of this block can also be redundant with each other.
+    within = ((block_one_hot @ block_one_hot.T) >=
+              config.identity_threshold *
+              np.maximum(block_residues @ block_residues.T, 1))
+    new_in_block = []
+    for i in np.flatnonzero(~redundant):
+      if new_in_block and within[i, new_in_block].any():
+        j = np.flatnonzero(within[i, new_in_block])[0]
+        clusters[start + i] = len(representatives) + j
+        continue
+      if len(representatives) + len(new_in_block) >= max_representatives:
+        break
+      clusters[start + i] = len(representatives) + len(new_in_block)
+      new_in_block.append(i)
+
+    representatives.extend(start + i for i in new_in_block)
+    representative_one_hot = np.concatenate(
+        [representative_one_hot, block_one_hot[new_in_block]])
+    representative_residues = np.concatenate(
+        [representative_residues, block_residues[new_in_block]])
+  # Rows after the last representative were not compared.
+  if len(representatives) >= max_representatives:
+    clusters[representatives[-1] + 1:] = -1
+  return representatives, clusters
+
+
+def minhash_signatures(encoded: np.ndarray, num_hashes: int, kmer_size: int,
+                       seed: int = 0) -> np.ndarray:
+  """MinHash signatures over the positional k-mers of aligned rows.
+
+  A k-mer is a window of `kmer_size` query columns without gaps, keyed by
+  its start column, so that two rows share a k-mer only if they have the
+  same residues at the same positions.
+
+  Returns:
+    uint64 array of shape (num_rows, num_hashes).
+  """
+  num_rows, num_res = encoded.shape
+  num_windows = max(num_res - kmer_size + 1, 1)
+  rng = np.random.default_rng(seed)
+  a = rng.integers(1, _MERSENNE_PRIME, size=num_hashes, dtype=np.uint64)
+  b = rng.integers(0, _MERSENNE_PRIME, size=num_hashes, dtype=np.uint64)
+
+  tokens = np.arange(num_windows, dtype=np.uint64)[None, :]
+  tokens = np.broadcast_to(tokens, (num_rows, num_windows)).copy()
+  has_gap = np.zeros((num_rows, num_windows), dtype=bool)
+  for offset in range(min(kmer_size, num_res)):
+    column = encoded[:, offset:offset + num_windows].astype(np.uint64)
+    tokens = tokens * np.uint64(_GAP_ID + 1) + column
+    has_gap |= encoded[:, offset:offset + num_windows] == _GAP_ID
+
+  signatures = np.full((num_rows, num_hashes), np.iinfo(np.uint64).max,
+                       dtype=np.uint64)
+  for h in range(num_hashes):
+    hashed = (a[h] * tokens + b[h]) % np.uint64(_MERSENNE_PRIME)
+    hashed[has_gap] = np.iinfo(np.uint64).max
+    signatures[:, h] = hashed.min(axis=1)
+  return signatures
+
+
+def _minhash_representatives(
+    encoded: np.ndarray,
+    config: SubsamplingConfig) -> Tuple[List[int], np.ndarray]:
+  """Greedy clustering comparing each row only against LSH candidates.
+
+  Returns:
+    Same as `_exact_representatives`.
+  """
+  max_representatives = _max_representatives(config)
+  signatures = minhash_signatures(
+      encoded, config.num_bands * config.rows_per_band, config.kmer_size,
+      config.seed)
+  band_keys = [
+      [row.tobytes() for row in signatures[:, band * config.rows_per_band:
+                                           (band + 1) * config.rows_per_band]]
+      for band in range(config.num_bands)]
+  buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(config.num_bands)]
+
+  representatives = []
+  clusters = np.full(len(encoded), -1, dtype=np.int64)
+  cluster_of_representative = {}
+  for i in range(len(encoded)):
+    if len(representatives) >= max_representatives:
+      break
+    candidates = set()
+    for band in range(config.num_bands):
+      candidates.update(buckets[band].get(band_keys[band][i], ()))
+    if candidates:
+      candidates = sorted(candidates)
+      identities = identity(encoded[i:i + 1], encoded[candidates])[0]
+      if (identities >= config.identity_threshold).any():
+        clusters[i] = cluster_of_representative[
+            candidates[identities.argmax()]]
+        continue
+    cluster_of_representative[i] = len(representatives)
+    clusters[i] = len(representatives)
+    representatives.append(i)
+    for band in range(config.num_bands):
+      buckets[band].setdefault(band_keys[band][i], []).append(i)
+  return representatives, clusters
+
+
+def _fill_evenly(clusters: np.ndarray, num_rows: int) -> np.ndarray:
+  """Picks rows round-robin across clusters, each round in original order.
+
+  Args:
+    clusters: Cluster of every row, -1 for rows that are not candidates.
+    num_rows: Number of rows to pick.
+
+  Returns:
+    The indices of the picked rows.
+  """
+  candidates = np.flatnonzero(clusters >= 0)
+  # Rank of every candidate within its cluster, in original order.
+  order = np.argsort(clusters[candidates], kind='stable')
+  sorted_clusters = clusters[candidates][order]
+  cluster_starts = np.flatnonzero(
+      np.diff(sorted_clusters, prepend=-1) != 0)
+  ranks = np.empty(len(candidates), dtype=np.int64)
+  ranks[order] = np.arange(len(candidates)) - np.repeat(
+      cluster_starts, np.diff(np.append(cluster_starts, len(candidates))))
+  picked = np.lexsort((candidates, ranks))[:num_rows]
+  return candidates[picked]
+
+
+def select_rows(encoded: np.ndarray, config: SubsamplingConfig) -> np.ndarray:
+  """Selects the rows to keep from an encoded MSA.
+
+  Args:
+    encoded: HHblits ids of shape (num_rows, num_res). Row 0 is the query and
+      is always kept.
+    config: Subsampling settings.
+
+  Returns:
+    Sorted indices of the kept rows.
+  """
+  if len(encoded) <= config.max_sequences:
+    return np.arange(len(encoded))
+  if config.mode == EXACT:
+    representatives, clusters = _exact_representatives(encoded, config)
+  else:
+    representatives, clusters = _minhash_representatives(encoded, config)
+
+  if len(representatives) >= _max_representatives(config):
+    return np.sort(representatives)
+  # Every row was clustered. The representatives come first in their
+  # clusters, so they are picked in the first round.
+  return np.sort(_fill_evenly(clusters, config.max_sequences))
+
+
+def subsample(msa: encoded_msa.EncodedMsa,
+              config: SubsamplingConfig) -> encoded_msa.EncodedMsa:
+  """Returns a diverse subset of at most `config.max_sequences` rows."""
+  if len(msa) <= config.max_sequences:
+    return msa
+  return msa.select(select_rows(msa.encoded, config))
@@ -0,0 +1,91 @@
+"""Tests for msa_subsampling."""
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from alphafold.data import parsers
+import numpy as np
+
+import encoded_msa
+import msa_subsampling
+
+_NUM_RES = 40
+# Rows [start, end) of every cluster, in file order. The first cluster,
+# which holds the query, is the largest.
+_CLUSTERS = ((0, 21), (21, 31), (31, 41))
+
+
+def _make_encoded() -> np.ndarray:
+  """Three families of rows, each a few mutations away from its founder."""
+  rng = np.random.default_rng(0)
+  rows = []
+  for start, end in _CLUSTERS:
+    founder = rng.integers(0, 20, size=_NUM_RES)
+    for i in range(end - start):
+      row = founder.copy()
+      if i:
+        row[rng.choice(_NUM_RES, size=2, replace=False)] = rng.integers(
+            0, 20, size=2)
+      rows.append(row)
+  return np.array(rows, dtype=np.int8)
+
+
+class SelectRowsTest(parameterized.TestCase):
+
+  @parameterized.parameters(msa_subsampling.EXACT, msa_subsampling.MINHASH)
+  def test_fills_evenly_across_clusters(self, mode):
+    config = msa_subsampling.SubsamplingConfig(max_sequences=9, mode=mode)
+    rows = msa_subsampling.select_rows(_make_encoded(), config)
+    np.testing.assert_array_equal(rows, [0, 1, 2, 21, 22, 23, 31, 32, 33])
+
+  @parameterized.parameters(msa_subsampling.EXACT, msa_subsampling.MINHASH)
+  def test_stops_at_target_neff(self, mode):
+    config = msa_subsampling.SubsamplingConfig(
+        max_sequences=30, target_neff=2, mode=mode)
+    rows = msa_subsampling.select_rows(_make_encoded(), config)
+    np.testing.assert_array_equal(rows, [0, 21])
+
+  def test_target_neff_above_the_number_of_clusters(self):
+    config = msa_subsampling.SubsamplingConfig(max_sequences=6, target_neff=5)
+    rows = msa_subsampling.select_rows(_make_encoded(), config)
+    np.testing.assert_array_equal(rows, [0, 1, 21, 22, 31, 32])
+
+  def test_more_clusters_than_sequences(self):
+    config = msa_subsampling.SubsamplingConfig(max_sequences=3,
+                                               identity_threshold=0.99)
+    rows = msa_subsampling.select_rows(_make_encoded(), config)
+    np.testing.assert_array_equal(rows, [0, 1, 2])
+
+  def test_small_block_size(self):
+    config = msa_subsampling.SubsamplingConfig(max_sequences=9, block_size=4)
+    rows = msa_subsampling.select_rows(_make_encoded(), config)
+    np.testing.assert_array_equal(rows, [0, 1, 2, 21, 22, 23, 31, 32, 33])
+
+  def test_shallow_msa_is_kept(self):
+    encoded = _make_encoded()
+    config = msa_subsampling.SubsamplingConfig(max_sequences=len(encoded))
+    np.testing.assert_array_equal(
+        msa_subsampling.select_rows(encoded, config), np.arange(len(encoded)))
+
+
+class SubsampleTest(absltest.TestCase):
+
+  def test_subsample(self):
+    letters = np.array(list('ARNDCQEGHILKMFPSTWYV'))
+    sequences = [''.join(letters[row]) for row in _make_encoded()]
+    descriptions = [f'seq{i}' for i in range(len(sequences))]
+    msa = encoded_msa.EncodedMsa.from_msa(parsers.Msa(
+        sequences=sequences,
+        deletion_matrix=[[0] * _NUM_RES for _ in sequences],
+        descriptions=descriptions))
+
+    subsampled = msa_subsampling.subsample(
+        msa, msa_subsampling.SubsamplingConfig(max_sequences=6))
+    self.assertEqual(subsampled.descriptions,
+                     ['seq0', 'seq1', 'seq21', 'seq22', 'seq31', 'seq32'])
+    self.assertEqual(subsampled.sequences[0], sequences[0])
+    self.assertIs(msa_subsampling.subsample(
+        msa, msa_subsampling.SubsamplingConfig(max_sequences=100)), msa)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,271 @@
+"""Warms the page cache with database files and reports their residency.
+
+HHblits and hhsearch do mostly random reads of the ffindex/ffdata files, so
+the first search on a fresh VM pays the latency of the persistent disk for
+every record it touches. The warmer prefetches the index files, which every
+search reads entirely, and configurable byte ranges of the data files with
+parallel readahead hints (or plain reads), in the background while the input
+is validated and the earlier searches run.
+
+Residency, the fraction of the pages of a file that are in the page cache,
+is measured with mincore(2) and logged before and after the warm-up of each
+database so the effect of the warm-up can be checked.
+"""
+
+import concurrent.futures
+import ctypes
+import ctypes.util
+import dataclasses
+import mmap
+import os
+import time
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from absl import logging
+import numpy as np
+
+import db_staging
+
+FADVISE = 'fadvise'
+MADVISE = 'madvise'
+READ = 'read'
+
+# Size of the windows mapped to query residency, so the vector returned by
+# mincore stays small for very large files.
+_MINCORE_WINDOW = 1 << 30
+_READ_SIZE = 1 << 20
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.mincore.argtypes = [
+    ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+_libc.mincore.restype = ctypes.c_int
+
+
+@dataclasses.dataclass(frozen=True)
+class WarmupConfig:
+  """Settings of the warm-up.
+
+  Attributes:
+    method: `fadvise` or `madvise` to issue asynchronous readahead hints, or
+      `read` to read the ranges, which blocks until they are cached.
+    index_suffixes: Files with these suffixes are prefetched entirely.
+    data_bytes: Number of leading bytes prefetched from the other files. None
+      prefetches them entirely.
+    ranges: Maps file names to the (start, end) byte ranges to prefetch
+      instead of the leading `data_bytes`.
+    chunk_size: Size of the ranges prefetched by each task.
+    num_workers: Number of threads issuing the prefetches.
+  """
+  method: str = FADVISE
+  index_suffixes: Tuple[str, ...] = ('.ffindex',)
+  data_bytes: Optional[int] = 0
+  ranges: Mapping[str, Sequence[Tuple[int, int]]] = dataclasses.field(
+      default_factory=dict)
+  chunk_size: int = 64 << 20
+  num_workers: int = 16
+
+
+def database_files(database_paths: Sequence[str]) -> List[str]:
+  """Paths of the files of some databases, which can be path prefixes."""
+  files = []
+  for database_path in database_paths:
+    root, name = os.path.split(database_path)
+    files.extend(os.path.join(root, f)
+                 for f in db_staging.database_files(root, name))
+  return files
+
+
+def resident_fraction(path: str) -> float:
+  """Returns the fraction of the pages of a file in the page cache."""
+  size = os.path.getsize(path)
+  if not size:
+    return 1.0
+  resident_pages = 0
+  with open(path, 'rb') as f:
+    for offset in range(0, size, _MINCORE_WINDOW):
+      length = min(_MINCORE_WINDOW, size - offset)
+      # A private mapping gives a writable buffer to take the address of.
+      # Pages that are not written to are those of the page cache.
+      mm = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_COPY,
+                     offset=offset)
+      try:
+        address = ctypes.addressof(ctypes.c_char.from_buffer(mm))
+        vec = (ctypes.c_ubyte * (-(-length // mmap.PAGESIZE)))()
+        if _libc.mincore(address, length, vec):
+          errno = ctypes.get_errno()
+          raise OSError(errno, os.strerror(errno), path)
+        resident_pages += int(np.count_nonzero(
+            np.frombuffer(vec, dtype=np.uint8) & 1))
+      finally:
+        mm.close()
+  return resident_pages / -(-size // mmap.PAGESIZE)
+
+
+def residency_report(paths: Sequence[str]) -> Dict[str, float]:
+  return {path: resident_fraction(path) for path in paths}
+
+
+def log_residency(report: Mapping[str, float], label: str):
+  for path, fraction in report.items():
+    logging.info('Page cache residency %s: %6.2f%% of %s (%.1f MB).', label,
+                 100 * fraction, path, os.path.getsize(path) / 1e6)
+
+
+def _split_range(start: int, end: int,
+                 chunk_size: int) -> List[Tuple[int, int]]:
+  return [(offset, min(offset + chunk_size, end))
+          for offset in range(start, end, chunk_size)]
+
+
+class PageCacheWarmer:
+  """Prefetches database files into the page cache in the background.
+
+  Each database is warmed by its own task, which measures the residency of
+  the files before prefetching them, so neither the measurement nor the
+  prefetches hold up the caller. Searches wait only for the databases they
+  read, just before they start.
+  """
+
+  def __init__(self, database_paths: Sequence[str], config: WarmupConfig):
+    if config.method not in (FADVISE, MADVISE, READ):
+      raise ValueError(f'Unknown warm-up method {config.method}.')
+    self.config = config
+    self.database_paths = list(database_paths)
+    self._executor = None
+    self._database_executor = None
+    self._database_futures = {}
+    self._t_0 = None
+    self.before = {}
+
+  @property
+  def files(self) -> List[str]:
+    return database_files(self.database_paths)
+
+  def _file_ranges(self, path: str) -> List[Tuple[int, int]]:
+    size = os.path.getsize(path)
+    name = os.path.basename(path)
+    if path.endswith(self.config.index_suffixes):
+      ranges = [(0, size)]
+    elif name in self.config.ranges:
+      ranges = [(start, min(end, size))
+                for start, end in self.config.ranges[name]]
+    elif self.config.data_bytes is None:
+      ranges = [(0, size)]
+    else:
+      ranges = [(0, min(self.config.data_bytes, size))]
+    chunks = []
+    for start, end in ranges:
+      # madvise needs page aligned offsets.
+      start -= start % mmap.PAGESIZE
+      chunks.extend(_split_range(start, end, self.config.chunk_size))
+    return chunks
+
+  def _prefetch(self, f, mm: Optional[mmap.mmap], start: int, end: int):
+    if self.config.method == FADVISE:
+      os.posix_fadvise(f.fileno(), start, end - start,
+                       os.POSIX_FADV_WILLNEED)
+    elif self.config.method == MADVISE:
+      mm.madvise(mmap.MADV_WILLNEED, start, end - start)
+    else:
+      for offset in range(start, end, _READ_SIZE):
+        os.pread(f.fileno(), min(_READ_SIZE, end - offset), offset)
+
+  def _warm_database(self, database_path: str) -> float:
+    """Prefetches the files of a database and returns the time it took."""
+    t_0 = time.time()
+    files = database_files([database_path])
+    before = residency_report(files)
+    log_residency(before, 'before warm-up')
+    self.before.update(before)
+    open_files = []
+    futures = []
+    try:
+      for path in files:
+        chunks = self._file_ranges(path)
+        if not chunks:
+          continue
+        f = open(path, 'rb')
+        mm = None
+        if self.config.method == MADVISE:
+          mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        open_files.append((f, mm))
+        futures.extend(
+            self._executor.submit(self._prefetch, f, mm, start, end)
+            for start, end in chunks)
+      for future in futures:
+        future.result()
+    finally:
+      for future in futures:
+        future.cancel()
+      concurrent.futures.wait(futures)
+      for f, mm in open_files:
+        if mm is not None:
+          mm.close()
+        f.close()
+    return time.time() - t_0
+
+  def start(self) -> 'PageCacheWarmer':
+    """Starts warming the databases and returns immediately."""
+    self._t_0 = time.time()
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        self.config.num_workers)
+    # The database tasks wait for the prefetches they submit, so they run
+    # in their own pool.
+    self._database_executor = concurrent.futures.ThreadPoolExecutor()
+    return self.add(self.database_paths)
+
+  def add(self, database_paths: Sequence[str]) -> 'PageCacheWarmer':
+    """Starts warming more databases, e.g. once it is known they are used."""
+    for database_path in database_paths:
+      if database_path in self._database_futures:
+        continue
+      if database_path not in self.database_paths:
+        self.database_paths.append(database_path)
+      self._database_futures[database_path] = self._database_executor.submit(
+          self._warm_database, database_path)
+    return self
+
+  def wait(self, database_paths: Optional[Sequence[str]] = None
+           ) -> Dict[str, float]:
+    """Waits for the prefetches of some databases.
+
+    Args:
+      database_paths: The databases to wait for. Databases that are not
+        being warmed are ignored. None waits for all of them and shuts the
+        warmer down.
+
+    Returns:
+      The residency of every file of the databases after their warm-up.
+    """
+    if database_paths is None:
+      try:
+        return self.wait(list(self._database_futures))
+      finally:
+        self.close()
+    files = []
+    for database_path in database_paths:
+      future = self._database_futures.get(database_path)
+      if future is None:
+        continue
+      t_0 = time.time()
+      seconds = future.result()
+      logging.info('Warmed up %s in %.1f s with %s, waited %.1f s.',
+                   database_path, seconds, self.config.method,
+                   time.time() - t_0)
+      files.extend(database_files([database_path]))
+    after = residency_report(files)
+    log_residency(after, 'after warm-up')
+    return after
+
+  def close(self):
+    """Stops the warm-up of the databases that were not waited for."""
+    for future in self._database_futures.values():
+      future.cancel()
+    for executor in (self._database_executor, self._executor):
+      if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+    if self._t_0 is not None:
+      logging.info('Warmed up %d database files in %.1f s with %s.',
+                   len(self.files), time.time() - self._t_0,
+                   self.config.method)
+      self._t_0 = None
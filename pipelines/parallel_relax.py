@@ -0,0 +1,119 @@
+"""Relaxes predicted structures with Amber in a pool of processes.
+
+Amber relaxation of a prediction takes minutes of CPU time and runs the same
+way for every model, so the ranked predictions of a target are relaxed
+concurrently in separate processes, each limited to a few OpenMM threads.
+Relaxations can be submitted as soon as their model finishes, so they run
+while the next models are on the accelerator.
+
+Every relaxation runs `relax.AmberRelaxation.process` unchanged, so the
+relaxed structures and violations are those of the serial path.
+"""
+
+import concurrent.futures
+import dataclasses
+import multiprocessing
+import os
+from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
+
+from absl import logging
+from alphafold.common import protein
+import numpy as np
+
+# (relaxed PDB, debug data, per-residue violations), as returned by
+# `relax.AmberRelaxation.process`.
+RelaxResult = Tuple[str, Dict[str, Any], np.ndarray]
+
+
+@dataclasses.dataclass(frozen=True)
+class RelaxConfig:
+  """Settings of `relax.AmberRelaxation`, defaulting to those of AlphaFold."""
+  max_iterations: int = 0
+  tolerance: float = 2.39
+  stiffness: float = 10.0
+  exclude_residues: Tuple[int, ...] = ()
+  max_outer_iterations: int = 20
+  use_gpu: bool = False
+
+
+def _init_worker(num_threads: int):
+  # Read by OpenMM when its CPU platform is first used.
+  os.environ['OPENMM_CPU_THREADS'] = str(num_threads)
+  os.environ['OMP_NUM_THREADS'] = str(num_threads)
+
+
+def relax_protein(prot: protein.Protein, config: RelaxConfig) -> RelaxResult:
+  """Relaxes a structure, in the calling process."""
+  from alphafold.relax import relax
+
+  amber_relaxer = relax.AmberRelaxation(
+      max_iterations=config.max_iterations,
+      tolerance=config.tolerance,
+      stiffness=config.stiffness,
+      exclude_residues=list(config.exclude_residues),
+      max_outer_iterations=config.max_outer_iterations,
+      use_gpu=config.use_gpu)
+  return amber_relaxer.process(prot=prot)
+
+
+def top_k(ranking_confidences: Mapping[str, float],
+          k: Optional[int]) -> Sequence[str]:
+  """Names of the `k` best predictions, all of them if `k` is None."""
+  ranked = sorted(ranking_confidences, key=ranking_confidences.get,
+                  reverse=True)
+  return ranked if k is None else ranked[:k]
+
+
+class ParallelRelaxer:
+  """Relaxes predictions concurrently in worker processes."""
+
+  def __init__(self,
+               config: RelaxConfig = RelaxConfig(),
+               num_workers: int = 4,
+               threads_per_worker: int = 1):
+    self.config = config
+    # Spawned workers do not inherit the accelerator state of the parent.
+    self._executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(threads_per_worker,))
+    self._futures = {}
+
+  def submit(self, name: str, prot: protein.Protein):
+    """Starts relaxing a prediction in the background."""
+    logging.info('Submitting %s for relaxation.', name)
+    self._futures[name] = self._executor.submit(
+        relax_protein, prot, self.config)
+
+  def results(self,
+              names: Optional[Sequence[str]] = None) -> Dict[str, RelaxResult]:
+    """Waits for the given relaxations and cancels the others.
+
+    Args:
+      names: Predictions whose relaxation is needed. Defaults to all
+        submitted ones. Relaxations of other predictions are cancelled if
+        they have not started yet.
+
+    Returns:
+      The relaxation result of every requested prediction.
+    """
+    if names is None:
+      names = list(self._futures)
+    for name, future in self._futures.items():
+      if name not in names and future.cancel():
+        logging.info('Cancelled the relaxation of %s.', name)
+    results = {name: self._futures[name].result() for name in names}
+    self._futures = {}
+    return results
+
+  def relax_all(self,
+                proteins: Mapping[str, protein.Protein]
+                ) -> Dict[str, RelaxResult]:
+    """Relaxes predictions concurrently and waits for the results."""
+    for name, prot in proteins.items():
+      self.submit(name, prot)
+    return self.results(list(proteins))
+
+  def shutdown(self):
+    self._executor.shutdown(cancel_futures=True)
@@ -1,5 +1,7 @@
+import glob
 import os
 import json
+import pickle
 import sys
 import time
 import shutil
@@ -21,6 +23,17 @@ from alphafold.data.tools import hmmsearch
 from alphafold.data.tools import jackhmmer
 import numpy as np
 
+import artifact_io
+import compact_deletions
+import db_staging
+import encoded_msa
+import kmer_prefilter
+import msa_stats
+import msa_subsampling
+import page_cache
+import search_planner
+import sharded_hmmsearch
+
 MAX_TEMPLATE_HITS = 20
 FLAGS = flags.FLAGS
 
@@ -62,8 +75,91 @@ flags.DEFINE_boolean('use_precomputed_msas', False, 'Whether to read MSAs that '
 flags.DEFINE_string('max_template_date', '2020-05-14', 'Maximum template release date '
                     'to consider. Important if folding historical test sets.')
 
+flags.DEFINE_enum('template_search_tool', 'hhsearch',
+                  ['hhsearch', 'hmmsearch'],
+                  'Search pdb70 with HHsearch or pdb_seqres with hmmsearch '
+                  'for templates.')
+flags.DEFINE_integer('hmmsearch_num_shards', 8, 'Number of pdb_seqres shards '
+                     'searched in parallel by hmmsearch.')
+flags.DEFINE_string('hmmsearch_shard_dir', None, 'Directory where the '
+                    'pdb_seqres shards are written and reused. Defaults to a '
+                    'directory under the system temporary directory.')
+
+flags.DEFINE_boolean('sparse_deletion_matrix', False, 'Whether to store the '
+                     'deletion matrix in features.pkl in the sparse encoding. '
+                     'Consumers must call compact_deletions.unpack_features '
+                     'before passing the features to the model.')
+flags.DEFINE_boolean('saturate_deletion_matrix', False, 'Whether to store the '
+                     'deletion counts in features.pkl as uint8, saturated at '
+                     '255, instead of exact int32 counts.')
+
+flags.DEFINE_boolean('plan_bfd_search', False, 'Whether to decide after the '
+                     'UniRef90 and MGnify searches if the BFD search should '
+                     'be run, downgraded to small BFD or skipped, based on '
+                     'the depth and Neff of the MSA found so far.')
+flags.DEFINE_integer('bfd_skip_min_sequences', 5000, 'Minimum number of '
+                     'unique sequences for the planner to skip BFD.')
+flags.DEFINE_float('bfd_skip_min_neff', 1000.0, 'Minimum Neff for the planner '
+                   'to skip BFD.')
+flags.DEFINE_integer('bfd_downgrade_min_sequences', 1000, 'Minimum number of '
+                     'unique sequences for the planner to use small BFD.')
+flags.DEFINE_float('bfd_downgrade_min_neff', 200.0, 'Minimum Neff for the '
+                   'planner to use small BFD.')
+
+flags.DEFINE_string('seed_index_dir', None, 'If set, jackhmmer searches '
+                    'only the database sequences shortlisted by the seed '
+                    'index in <seed_index_dir>/<database>, for each of '
+                    'uniref90, mgnify and small_bfd whose index exists. '
+                    'Indexes are built with build_kmer_index.py.')
+flags.DEFINE_integer('seed_index_min_shared_seeds', 2, 'Minimum number of '
+                     'seeds a database sequence must share with the query '
+                     'to be searched by jackhmmer.')
+
+flags.DEFINE_string('staging_dir', None, 'If set, the database files searched '
+                    'by this run are copied from data_dir to this local '
+                    'directory and searched there. Staged files are kept '
+                    'for later runs on the same host.')
+flags.DEFINE_float('staging_max_gb', 500.0, 'Maximum total size of the staged '
+                   'database files. Least recently used files are evicted '
+                   'first and databases that do not fit are read from '
+                   'data_dir.')
+flags.DEFINE_integer('staging_num_workers', 16, 'Number of threads copying '
+                     'database files to the staging directory.')
+
+flags.DEFINE_enum('warmup_method', None,
+                  [page_cache.FADVISE, page_cache.MADVISE, page_cache.READ],
+                  'If set, the database files are prefetched into the page '
+                  'cache with this method in the background, each database '
+                  'until its search starts, and their page cache residency '
+                  'is logged. With plan_bfd_search, only the planned BFD '
+                  'database is prefetched.')
+flags.DEFINE_float('warmup_data_gb', 0.0, 'Number of leading GB of every '
+                   'database data file to prefetch. The ffindex files are '
+                   'always prefetched entirely.')
+
+flags.DEFINE_enum('msa_compression', artifact_io.NONE,
+                  list(artifact_io.COMPRESSIONS), 'Compression of the MSA '
+                  'files written to the output directory. MSA files are '
+                  'read whatever their compression.')
+
+flags.DEFINE_integer('msa_subsampling_max_sequences', None, 'If set, each MSA '
+                     'is reduced to a diverse subset of at most this many '
+                     'sequences before featurization.')
+flags.DEFINE_float('msa_subsampling_identity', 0.8, 'Sequences at least this '
+                   'identical to an already selected sequence are considered '
+                   'redundant by MSA subsampling.')
+flags.DEFINE_float('msa_subsampling_target_neff', None, 'If set, MSA '
+                   'subsampling stops once the selection reaches this Neff '
+                   'and keeps only the diverse sequences selected so far, '
+                   'which can be fewer than the maximum number.')
+flags.DEFINE_enum('msa_subsampling_mode', msa_subsampling.EXACT,
+                  [msa_subsampling.EXACT, msa_subsampling.MINHASH],
+                  'Exact pairwise identity or MinHash/LSH candidate search '
+                  'for very deep MSAs.')
+
 FeatureDict = MutableMapping[str, np.ndarray]
-TemplateSearcher = Union[hhsearch.HHSearch, hmmsearch.Hmmsearch]
+TemplateSearcher = Union[hhsearch.HHSearch, hmmsearch.Hmmsearch,
+                         sharded_hmmsearch.ShardedHmmsearch]
 
 
 def make_sequence_features(
@@ -83,37 +179,46 @@ def make_sequence_features(
   return features
 
 
-def make_msa_features(msas: Sequence[parsers.Msa]) -> FeatureDict:
-  """Constructs a feature dict of MSA features."""
+def make_msa_features(msas: Sequence[encoded_msa.EncodedMsa],
+                      deletion_dtype: Optional[np.dtype] = None
+                      ) -> FeatureDict:
+  """Constructs a feature dict of MSA features.
+
+  The deletion matrix is int32, as expected by the model. If `deletion_dtype`
+  is given, it is saturated to that narrow unsigned dtype instead, and
+  `compact_deletions.unpack_features` restores the int32 form.
+  """
   if not msas:
     raise ValueError('At least one MSA must be provided.')
-
-  int_msa = []
-  deletion_matrix = []
-  uniprot_accession_ids = []
-  species_ids = []
-  seen_sequences = set()
   for msa_index, msa in enumerate(msas):
     if not msa:
       raise ValueError(f'MSA {msa_index} must contain at least one sequence.')
-    for sequence_index, sequence in enumerate(msa.sequences):
-      if sequence in seen_sequences:
-        continue
-      seen_sequences.add(sequence)
-      int_msa.append(
-          [residue_constants.HHBLITS_AA_TO_ID[res] for res in sequence])
-      deletion_matrix.append(msa.deletion_matrix[sequence_index])
+
+  keep_per_msa = encoded_msa.first_unique_rows_across(msas)
+
+  uniprot_accession_ids = []
+  species_ids = []
+  for msa, keep in zip(msas, keep_per_msa):
+    for sequence_index in keep:
       identifiers = msa_identifiers.get_identifiers(
-          msa.descriptions[sequence_index])
+          msa.description(sequence_index))
       uniprot_accession_ids.append(
           identifiers.uniprot_accession_id.encode('utf-8'))
       species_ids.append(identifiers.species_id.encode('utf-8'))
 
-  num_res = len(msas[0].sequences[0])
-  num_alignments = len(int_msa)
+  num_res = msas[0].num_res
+  num_alignments = len(uniprot_accession_ids)
   features = {}
-  features['deletion_matrix_int'] = np.array(deletion_matrix, dtype=np.int32)
-  features['msa'] = np.array(int_msa, dtype=np.int32)
+  deletion_matrix = np.concatenate(
+      [msa.deletion_matrix[keep] for msa, keep in zip(msas, keep_per_msa)])
+  if deletion_dtype is None:
+    features['deletion_matrix_int'] = deletion_matrix.astype(np.int32)
+  else:
+    features['deletion_matrix_int'] = compact_deletions.saturate(
+        deletion_matrix, deletion_dtype)
+  features['msa'] = np.concatenate(
+      [msa.encoded[keep] for msa, keep in zip(msas, keep_per_msa)]
+  ).astype(np.int32)
   features['num_alignments'] = np.array(
       [num_alignments] * num_res, dtype=np.int32)
   features['msa_uniprot_accession_identifiers'] = np.array(
@@ -124,28 +229,50 @@ def make_msa_features(msas: Sequence[parsers.Msa]) -> FeatureDict:
 
 def run_msa_tool(msa_runner, input_fasta_path: str, msa_out_path: str,
                  msa_format: str, use_precomputed_msas: bool,
-                 max_sto_sequences: Optional[int] = None
+                 max_sto_sequences: Optional[int] = None,
+                 compression: str = artifact_io.NONE
                  ) -> Mapping[str, Any]:
-  """Runs an MSA tool, checking if output already exists first."""
+  """Runs an MSA tool, checking if output already exists first.
+
+  The output is written with the given compression. Precomputed outputs are
+  read whatever their compression.
+  """
   if not use_precomputed_msas or not os.path.exists(msa_out_path):
     if msa_format == 'sto' and max_sto_sequences is not None:
       result = msa_runner.query(input_fasta_path, max_sto_sequences)[0]  # pytype: disable=wrong-arg-count
     else:
       result = msa_runner.query(input_fasta_path)[0]
-    with open(msa_out_path, 'w') as f:
-      f.write(result[msa_format])
+    artifact_io.write_text(msa_out_path, result[msa_format], compression)
   else:
     logging.warning('Reading MSA from file %s', msa_out_path)
     if msa_format == 'sto' and max_sto_sequences is not None:
-      precomputed_msa = parsers.truncate_stockholm_msa(
+      precomputed_msa = artifact_io.truncate_stockholm_msa(
           msa_out_path, max_sto_sequences)
       result = {'sto': precomputed_msa}
     else:
-      with open(msa_out_path, 'r') as f:
-        result = {msa_format: f.read()}
+      result = {msa_format: artifact_io.read_text(msa_out_path)}
   return result
 
 
+def make_jackhmmer_runner(
+    binary_path: str,
+    database_path: str,
+    seed_index_dir: Optional[str] = None,
+    min_shared_seeds: int = 2
+) -> Union[jackhmmer.Jackhmmer, kmer_prefilter.PrefilteredJackhmmer]:
+  """Creates a jackhmmer runner, prefiltered if a seed index exists."""
+  if seed_index_dir and os.path.isdir(seed_index_dir):
+    logging.info('Using seed index %s for %s.', seed_index_dir, database_path)
+    return kmer_prefilter.PrefilteredJackhmmer(
+        binary_path=binary_path,
+        database_path=database_path,
+        index_dir=seed_index_dir,
+        min_shared_seeds=min_shared_seeds)
+  return jackhmmer.Jackhmmer(
+      binary_path=binary_path,
+      database_path=database_path)
+
+
 class DataPipeline:
   """Runs the alignment tools and assembles the input features."""
 
@@ -162,31 +289,125 @@ class DataPipeline:
                use_small_bfd: bool,
                mgnify_max_hits: int = 501,
                uniref_max_hits: int = 10000,
-               use_precomputed_msas: bool = False):
+               use_precomputed_msas: bool = False,
+               msa_subsampling_config: Optional[
+                   msa_subsampling.SubsamplingConfig] = None,
+               search_planner_config: Optional[
+                   search_planner.PlannerConfig] = None,
+               seed_index_dir: Optional[str] = None,
+               seed_index_min_shared_seeds: int = 2,
+               warmup_config: Optional[page_cache.WarmupConfig] = None,
+               msa_compression: str = artifact_io.NONE,
+               deletion_dtype: Optional[np.dtype] = None):
     """Initializes the data pipeline."""
     self._use_small_bfd = use_small_bfd
-    self.jackhmmer_uniref90_runner = jackhmmer.Jackhmmer(
+
+    def seed_index(database_name):
+      if seed_index_dir is None:
+        return None
+      return os.path.join(seed_index_dir, database_name)
+
+    self.jackhmmer_uniref90_runner = make_jackhmmer_runner(
         binary_path=jackhmmer_binary_path,
-        database_path=uniref90_database_path)
-    if use_small_bfd:
-      self.jackhmmer_small_bfd_runner = jackhmmer.Jackhmmer(
+        database_path=uniref90_database_path,
+        seed_index_dir=seed_index('uniref90'),
+        min_shared_seeds=seed_index_min_shared_seeds)
+    # The planner can downgrade the full BFD search to small BFD if the
+    # database is available.
+    self.jackhmmer_small_bfd_runner = None
+    if use_small_bfd or (search_planner_config and small_bfd_database_path and
+                         glob.glob(small_bfd_database_path + '*')):
+      self.jackhmmer_small_bfd_runner = make_jackhmmer_runner(
           binary_path=jackhmmer_binary_path,
-          database_path=small_bfd_database_path)
-    else:
+          database_path=small_bfd_database_path,
+          seed_index_dir=seed_index('small_bfd'),
+          min_shared_seeds=seed_index_min_shared_seeds)
+    if not use_small_bfd:
       self.hhblits_bfd_uniclust_runner = hhblits.HHBlits(
           binary_path=hhblits_binary_path,
           databases=[bfd_database_path, uniclust30_database_path])
-    self.jackhmmer_mgnify_runner = jackhmmer.Jackhmmer(
+    self.jackhmmer_mgnify_runner = make_jackhmmer_runner(
         binary_path=jackhmmer_binary_path,
-        database_path=mgnify_database_path)
+        database_path=mgnify_database_path,
+        seed_index_dir=seed_index('mgnify'),
+        min_shared_seeds=seed_index_min_shared_seeds)
     self.template_searcher = template_searcher
     self.template_featurizer = template_featurizer
     self.mgnify_max_hits = mgnify_max_hits
     self.uniref_max_hits = uniref_max_hits
     self.use_precomputed_msas = use_precomputed_msas
+    self.msa_subsampling_config = msa_subsampling_config
+    self.search_planner_config = search_planner_config
+    self.warmup_config = warmup_config
+    self.msa_compression = msa_compression
+    self.deletion_dtype = deletion_dtype
+
+    # Databases prefetched into the page cache before each search.
+    self.warmup_database_paths = {
+        'uniref90': [uniref90_database_path],
+        'mgnify': [mgnify_database_path],
+        'small_bfd': [small_bfd_database_path],
+        'bfd_uniclust': [bfd_database_path, uniclust30_database_path],
+        'templates': [],
+    }
+    if hasattr(template_searcher, 'databases'):
+      self.warmup_database_paths['templates'] = list(
+          template_searcher.databases)
+    elif hasattr(template_searcher, 'database_path'):
+      self.warmup_database_paths['templates'] = [
+          template_searcher.database_path]
+
+  def _search_bfd(self, input_fasta_path: str, msa_output_dir: str,
+                  use_small_bfd: bool) -> encoded_msa.EncodedMsa:
+    """Searches small BFD with jackhmmer or BFD+Uniclust30 with HHblits."""
+    if use_small_bfd:
+      bfd_out_path = os.path.join(msa_output_dir, 'small_bfd_hits.sto')
+      jackhmmer_small_bfd_result = run_msa_tool(
+          msa_runner=self.jackhmmer_small_bfd_runner,
+          input_fasta_path=input_fasta_path,
+          msa_out_path=bfd_out_path,
+          msa_format='sto',
+          use_precomputed_msas=self.use_precomputed_msas,
+          compression=self.msa_compression)
+      return encoded_msa.EncodedMsa.from_stockholm(
+          jackhmmer_small_bfd_result['sto'])
+    bfd_out_path = os.path.join(msa_output_dir, 'bfd_uniclust_hits.a3m')
+    hhblits_bfd_uniclust_result = run_msa_tool(
+        msa_runner=self.hhblits_bfd_uniclust_runner,
+        input_fasta_path=input_fasta_path,
+        msa_out_path=bfd_out_path,
+        msa_format='a3m',
+        use_precomputed_msas=self.use_precomputed_msas,
+        compression=self.msa_compression)
+    return encoded_msa.EncodedMsa.from_a3m(hhblits_bfd_uniclust_result['a3m'])
 
   def process(self, input_fasta_path: str, msa_output_dir: str) -> FeatureDict:
     """Runs alignment tools on the input sequence and creates features."""
+    # The warm-up runs in the background while the input is checked and the
+    # earlier searches run. Which BFD database is searched is only known
+    # once the planner has seen the first MSAs.
+    warmer = None
+    if self.warmup_config is not None:
+      searches = ['uniref90', 'mgnify', 'templates']
+      if not self.search_planner_config:
+        searches.append('small_bfd' if self._use_small_bfd else 'bfd_uniclust')
+      warmer = page_cache.PageCacheWarmer(
+          [path for search in searches
+           for path in self.warmup_database_paths[search]],
+          self.warmup_config).start()
+    try:
+      return self._process(input_fasta_path, msa_output_dir, warmer)
+    finally:
+      if warmer is not None:
+        warmer.close()
+
+  def _wait_for_warmup(self, warmer: Optional[page_cache.PageCacheWarmer],
+                       search: str):
+    if warmer is not None:
+      warmer.wait(self.warmup_database_paths[search])
+
+  def _process(self, input_fasta_path: str, msa_output_dir: str,
+               warmer: Optional[page_cache.PageCacheWarmer]) -> FeatureDict:
     with open(input_fasta_path) as f:
       input_fasta_str = f.read()
     input_seqs, input_descs = parsers.parse_fasta(input_fasta_str)
@@ -197,6 +418,7 @@ class DataPipeline:
     input_description = input_descs[0]
     num_res = len(input_sequence)
 
+    self._wait_for_warmup(warmer, 'uniref90')
     uniref90_out_path = os.path.join(msa_output_dir, 'uniref90_hits.sto')
     jackhmmer_uniref90_result = run_msa_tool(
         msa_runner=self.jackhmmer_uniref90_runner,
@@ -204,7 +426,9 @@ class DataPipeline:
         msa_out_path=uniref90_out_path,
         msa_format='sto',
         use_precomputed_msas=self.use_precomputed_msas,
-        max_sto_sequences=self.uniref_max_hits)
+        max_sto_sequences=self.uniref_max_hits,
+        compression=self.msa_compression)
+    self._wait_for_warmup(warmer, 'mgnify')
     mgnify_out_path = os.path.join(msa_output_dir, 'mgnify_hits.sto')
     jackhmmer_mgnify_result = run_msa_tool(
         msa_runner=self.jackhmmer_mgnify_runner,
@@ -212,51 +436,71 @@ class DataPipeline:
         msa_out_path=mgnify_out_path,
         msa_format='sto',
         use_precomputed_msas=self.use_precomputed_msas,
-        max_sto_sequences=self.mgnify_max_hits)
+        max_sto_sequences=self.mgnify_max_hits,
+        compression=self.msa_compression)
+
+    # Each tool output is parsed once and shared between template search and
+    # featurization.
+    uniref90_msa = encoded_msa.EncodedMsa.from_stockholm(
+        jackhmmer_uniref90_result['sto'])
+    mgnify_msa = encoded_msa.EncodedMsa.from_stockholm(
+        jackhmmer_mgnify_result['sto'])
+
+    decision = search_planner.RUN
+    if self.search_planner_config:
+      plan = search_planner.plan_bfd_search(
+          (uniref90_msa, mgnify_msa), self.search_planner_config)
+      search_planner.write_search_plan(
+          plan, os.path.join(msa_output_dir, 'search_plan.json'))
+      logging.info('BFD search plan: %s. %s', plan.decision, plan.reason)
+      decision = plan.decision
+      if (decision == search_planner.DOWNGRADE and
+          self.jackhmmer_small_bfd_runner is None):
+        logging.warning('Small BFD is not available, running the full '
+                        'BFD search instead.')
+        decision = search_planner.RUN
+
+    if decision == search_planner.SKIP:
+      bfd_name = 'bfd_skipped'
+    elif self._use_small_bfd or decision == search_planner.DOWNGRADE:
+      bfd_name = 'small_bfd'
+    else:
+      bfd_name = 'bfd_uniclust'
+    # The planned BFD database is warmed while the templates are searched.
+    if warmer is not None and decision != search_planner.SKIP:
+      warmer.add(self.warmup_database_paths[bfd_name])
 
-    msa_for_templates = jackhmmer_uniref90_result['sto']
-    msa_for_templates = parsers.deduplicate_stockholm_msa(msa_for_templates)
-    msa_for_templates = parsers.remove_empty_columns_from_stockholm_msa(
-        msa_for_templates)
+    msa_for_templates = uniref90_msa.deduplicate().remove_empty_columns()
 
+    self._wait_for_warmup(warmer, 'templates')
     if self.template_searcher.input_format == 'sto':
-      pdb_templates_result = self.template_searcher.query(msa_for_templates)
+      pdb_templates_result = self.template_searcher.query(
+          msa_for_templates.to_stockholm())
     elif self.template_searcher.input_format == 'a3m':
-      uniref90_msa_as_a3m = parsers.convert_stockholm_to_a3m(msa_for_templates)
-      pdb_templates_result = self.template_searcher.query(uniref90_msa_as_a3m)
+      pdb_templates_result = self.template_searcher.query(
+          msa_for_templates.to_a3m())
     else:
       raise ValueError('Unrecognized template input format: '
                        f'{self.template_searcher.input_format}')
 
     pdb_hits_out_path = os.path.join(
         msa_output_dir, f'pdb_hits.{self.template_searcher.output_format}')
-    with open(pdb_hits_out_path, 'w') as f:
-      f.write(pdb_templates_result)
-
-    uniref90_msa = parsers.parse_stockholm(jackhmmer_uniref90_result['sto'])
-    mgnify_msa = parsers.parse_stockholm(jackhmmer_mgnify_result['sto'])
+    artifact_io.write_text(pdb_hits_out_path, pdb_templates_result,
+                           self.msa_compression)
 
     pdb_template_hits = self.template_searcher.get_template_hits(
         output_string=pdb_templates_result, input_sequence=input_sequence)
 
-    if self._use_small_bfd:
-      bfd_out_path = os.path.join(msa_output_dir, 'small_bfd_hits.sto')
-      jackhmmer_small_bfd_result = run_msa_tool(
-          msa_runner=self.jackhmmer_small_bfd_runner,
-          input_fasta_path=input_fasta_path,
-          msa_out_path=bfd_out_path,
-          msa_format='sto',
-          use_precomputed_msas=self.use_precomputed_msas)
-      bfd_msa = parsers.parse_stockholm(jackhmmer_small_bfd_result['sto'])
+    if decision == search_planner.SKIP:
+      # A query-only MSA, removed by deduplication during featurization.
+      bfd_msa = encoded_msa.EncodedMsa.from_msa(parsers.Msa(
+          sequences=[input_sequence],
+          deletion_matrix=[[0] * num_res],
+          descriptions=[input_description]))
     else:
-      bfd_out_path = os.path.join(msa_output_dir, 'bfd_uniclust_hits.a3m')
-      hhblits_bfd_uniclust_result = run_msa_tool(
-          msa_runner=self.hhblits_bfd_uniclust_runner,
-          input_fasta_path=input_fasta_path,
-          msa_out_path=bfd_out_path,
-          msa_format='a3m',
-          use_precomputed_msas=self.use_precomputed_msas)
-      bfd_msa = parsers.parse_a3m(hhblits_bfd_uniclust_result['a3m'])
+      self._wait_for_warmup(warmer, bfd_name)
+      bfd_msa = self._search_bfd(input_fasta_path, msa_output_dir,
+                                 use_small_bfd=bfd_name == 'small_bfd')
 
     templates_result = self.template_featurizer.get_templates(
         query_sequence=input_sequence,
@@ -267,7 +511,13 @@ class DataPipeline:
         description=input_description,
         num_res=num_res)
 
-    msa_features = make_msa_features((uniref90_msa, bfd_msa, mgnify_msa))
+    if self.msa_subsampling_config:
+      uniref90_msa, bfd_msa, mgnify_msa = (
+          msa_subsampling.subsample(msa, self.msa_subsampling_config)
+          for msa in (uniref90_msa, bfd_msa, mgnify_msa))
+
+    msa_features = make_msa_features((uniref90_msa, bfd_msa, mgnify_msa),
+                                     deletion_dtype=self.deletion_dtype)
 
     logging.info('Uniref90 MSA size: %d sequences.', len(uniref90_msa))
     logging.info('BFD MSA size: %d sequences.', len(bfd_msa))
@@ -278,10 +528,34 @@ class DataPipeline:
                  'templates and is later filtered to top 4): %d.',
                  templates_result.features['template_domain_names'].shape[0])
 
+    stats = msa_stats.compute_msa_stats({
+        'uniref90': uniref90_msa,
+        bfd_name: bfd_msa,
+        'mgnify': mgnify_msa,
+    })
+    msa_stats.write_msa_stats(
+        stats, os.path.join(msa_output_dir, 'msa_stats.json'))
+    logging.info('MSA Neff at %.0f%% identity: %.1f.',
+                 stats['neff']['identity_threshold'] * 100,
+                 stats['neff']['value'])
+
     return {**sequence_features, **msa_features, **templates_result.features}
 
 
-def main(argv):
+def create_monomer_data_pipeline(
+    db_preset: Optional[str] = None,
+    max_template_date: Optional[str] = None) -> DataPipeline:
+  """Creates the monomer data pipeline configured by the flags.
+
+  Args:
+    db_preset: Overrides `--db_preset`.
+    max_template_date: Overrides `--max_template_date`.
+
+  Returns:
+    The data pipeline.
+  """
+  db_preset = db_preset or FLAGS.db_preset
+  max_template_date = max_template_date or FLAGS.max_template_date
 
     # Path to the Uniref90 database for use by JackHMMER.
   uniref90_database_path = os.path.join(
@@ -321,20 +595,75 @@ def main(argv):
   # Path to a file mapping obsolete PDB IDs to their replacements.
   obsolete_pdbs_path = os.path.join(FLAGS.data_dir, 'pdb_mmcif', 'obsolete.dat')
 
-  use_small_bfd = FLAGS.db_preset == 'reduced_dbs'
-
-  template_searcher = hhsearch.HHSearch(
+  use_small_bfd = db_preset == 'reduced_dbs'
+
+  if FLAGS.staging_dir:
+    staging_cache = db_staging.StagingCache(
+        remote_root=FLAGS.data_dir,
+        staging_dir=FLAGS.staging_dir,
+        max_bytes=int(FLAGS.staging_max_gb * 1e9),
+        num_workers=FLAGS.staging_num_workers)
+    uniref90_database_path = staging_cache.stage(uniref90_database_path)
+    mgnify_database_path = staging_cache.stage(mgnify_database_path)
+    if use_small_bfd or FLAGS.plan_bfd_search:
+      small_bfd_database_path = staging_cache.stage(small_bfd_database_path)
+    if not use_small_bfd:
+      bfd_database_path = staging_cache.stage(bfd_database_path)
+      uniclust30_database_path = staging_cache.stage(uniclust30_database_path)
+    if FLAGS.template_search_tool == 'hmmsearch':
+      pdb_seqres_database_path = staging_cache.stage(pdb_seqres_database_path)
+    else:
+      pdb70_database_path = staging_cache.stage(pdb70_database_path)
+
+  search_planner_config = None
+  if FLAGS.plan_bfd_search:
+    search_planner_config = search_planner.PlannerConfig(
+        skip_min_sequences=FLAGS.bfd_skip_min_sequences,
+        skip_min_neff=FLAGS.bfd_skip_min_neff,
+        downgrade_min_sequences=FLAGS.bfd_downgrade_min_sequences,
+        downgrade_min_neff=FLAGS.bfd_downgrade_min_neff)
+
+  msa_subsampling_config = None
+  if FLAGS.msa_subsampling_max_sequences:
+    msa_subsampling_config = msa_subsampling.SubsamplingConfig(
+        max_sequences=FLAGS.msa_subsampling_max_sequences,
+        identity_threshold=FLAGS.msa_subsampling_identity,
+        target_neff=FLAGS.msa_subsampling_target_neff,
+        mode=FLAGS.msa_subsampling_mode)
+
+  warmup_config = None
+  if FLAGS.warmup_method:
+    warmup_config = page_cache.WarmupConfig(
+        method=FLAGS.warmup_method,
+        data_bytes=int(FLAGS.warmup_data_gb * 1e9))
+
+  if FLAGS.template_search_tool == 'hmmsearch':
+    template_searcher = sharded_hmmsearch.ShardedHmmsearch(
+        binary_path=FLAGS.hmmsearch_binary_path,
+        hmmbuild_binary_path=FLAGS.hmmbuild_binary_path,
+        database_path=pdb_seqres_database_path,
+        num_shards=FLAGS.hmmsearch_num_shards,
+        shard_dir=FLAGS.hmmsearch_shard_dir)
+    template_featurizer = templates.HmmsearchHitFeaturizer(
+        mmcif_dir=template_mmcif_dir,
+        max_template_date=max_template_date,
+        max_hits=MAX_TEMPLATE_HITS,
+        kalign_binary_path=FLAGS.kalign_binary_path,
+        release_dates_path=None,
+        obsolete_pdbs_path=obsolete_pdbs_path)
+  else:
+    template_searcher = hhsearch.HHSearch(
         binary_path=FLAGS.hhsearch_binary_path,
         databases=[pdb70_database_path])
-  template_featurizer = templates.HhsearchHitFeaturizer(
+    template_featurizer = templates.HhsearchHitFeaturizer(
         mmcif_dir=template_mmcif_dir,
-        max_template_date=FLAGS.max_template_date,
+        max_template_date=max_template_date,
         max_hits=MAX_TEMPLATE_HITS,
         kalign_binary_path=FLAGS.kalign_binary_path,
         release_dates_path=None,
         obsolete_pdbs_path=obsolete_pdbs_path)
     
-  monomer_data_pipeline = DataPipeline(
+  return DataPipeline(
       jackhmmer_binary_path=FLAGS.jackhmmer_binary_path,
       hhblits_binary_path=FLAGS.hhblits_binary_path,
       uniref90_database_path=uniref90_database_path,
@@ -345,9 +674,39 @@ def main(argv):
       template_searcher=template_searcher,
       template_featurizer=template_featurizer,
       use_small_bfd=use_small_bfd,
-      use_precomputed_msas=FLAGS.use_precomputed_msas)
+      use_precomputed_msas=FLAGS.use_precomputed_msas,
+      msa_subsampling_config=msa_subsampling_config,
+      search_planner_config=search_planner_config,
+      seed_index_dir=FLAGS.seed_index_dir,
+      seed_index_min_shared_seeds=FLAGS.seed_index_min_shared_seeds,
+      warmup_config=warmup_config,
+      msa_compression=FLAGS.msa_compression,
+      deletion_dtype=np.uint8 if FLAGS.saturate_deletion_matrix else None)
+
+
+def write_features(feature_dict: FeatureDict, output_dir: str):
+  """Writes features.pkl, packing the deletion matrix if requested."""
+  if FLAGS.sparse_deletion_matrix:
+    if compact_deletions.DELETION_MATRIX_KEY in feature_dict:
+      feature_dict = compact_deletions.pack_features(feature_dict)
+    else:
+      logging.warning('No %s feature to pack, writing dense features.',
+                      compact_deletions.DELETION_MATRIX_KEY)
+
+  features_output_path = os.path.join(output_dir, 'features.pkl')
+  with open(features_output_path, 'wb') as f:
+    pickle.dump(feature_dict, f, protocol=4)
+
 
-  data_pipeline = monomer_data_pipeline
+def load_features(features_path: str) -> FeatureDict:
+  """Reads features.pkl, restoring the int32 deletion matrix of the model."""
+  with open(features_path, 'rb') as f:
+    feature_dict = pickle.load(f)
+  return compact_deletions.unpack_features(feature_dict)
+
+
+def main(argv):
+  data_pipeline = create_monomer_data_pipeline()
 
   input_fasta_path = FLAGS.fasta_paths[0]
   msa_output_dir = os.path.join(FLAGS.output_dir, 'msas')
@@ -355,6 +714,7 @@ def main(argv):
       input_fasta_path = input_fasta_path,
       msa_output_dir=msa_output_dir
   )
+  write_features(feature_dict, FLAGS.output_dir)
 
 if __name__=='__main__':
     flags.mark_flags_as_required([
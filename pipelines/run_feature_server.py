@@ -0,0 +1,376 @@
+"""Serves the data pipeline from a long-running process.
+
+Every `run_data_pipeline` run is a cold process: it parses flags, imports the
+alphafold modules, builds the tool runners, stages the databases and starts
+with a cold page cache. This server pays those costs once and then runs
+feature requests through shared `DataPipeline` instances, one per
+(db_preset, max_template_date) pair, built on first use and kept for the
+lifetime of the server.
+
+Requests are JSON objects POSTed to `/features`:
+
+  {"fasta": ">query\\nMKV...", "name": "query", "db_preset": "reduced_dbs",
+   "max_template_date": "2021-10-01"}
+
+Only `fasta` is required; the options default to the flags. The response is
+sent when the features are written and gives the path of `features.pkl`
+under `--output_dir`. At most `--server_max_concurrency` requests run at the
+same time, up to `--server_max_queue_size` more wait for a slot, and further
+requests are rejected with 503 until the queue drains. `GET /stats` returns
+the queue depth and latency percentiles of recent requests.
+
+The server listens on `--server_host:--server_port`, or on the Unix socket
+`--server_socket` if it is set, e.g.
+
+  curl --unix-socket /tmp/features.sock -d @request.json \\
+      http://localhost/features
+
+All flags of `run_data_pipeline` apply. The tool wrappers and the template
+featurizer check that their databases exist when the pipeline is built, so
+running without the genetic databases needs a `pipeline_factory` that
+returns a stub pipeline, as in run_feature_server_test.py.
+"""
+
+import collections
+import concurrent.futures
+import dataclasses
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+
+from absl import app
+from absl import flags
+from absl import logging
+
+import numpy as np
+
+import run_data_pipeline
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('server_host', '127.0.0.1', 'Address the server listens '
+                    'on.')
+flags.DEFINE_integer('server_port', 8080, 'Port the server listens on.')
+flags.DEFINE_string('server_socket', None, 'Path of a Unix socket to listen '
+                    'on instead of a TCP port.')
+flags.DEFINE_integer('server_max_concurrency', 1, 'Number of requests whose '
+                     'data pipeline runs at the same time.')
+flags.DEFINE_integer('server_max_queue_size', 16, 'Number of requests waiting '
+                     'for a free slot before new ones are rejected.')
+flags.DEFINE_integer('server_latency_window', 1000, 'Number of recent '
+                     'requests the latency statistics are computed over.')
+
+# (db_preset, max_template_date) -> data pipeline.
+PipelineFactory = Callable[[str, str], run_data_pipeline.DataPipeline]
+
+_DB_PRESETS = ('full_dbs', 'reduced_dbs')
+_PERCENTILES = (50, 90, 99)
+
+
+class QueueFullError(Exception):
+  """Raised when a request arrives while the request queue is full."""
+
+
+@dataclasses.dataclass(frozen=True)
+class FeatureRequest:
+  """A request for the features of one sequence."""
+  fasta: str
+  name: str = 'query'
+  db_preset: Optional[str] = None
+  max_template_date: Optional[str] = None
+
+  @classmethod
+  def from_json(cls, body: Mapping[str, Any]) -> 'FeatureRequest':
+    """Parses and validates the JSON body of a request."""
+    unknown = set(body) - {f.name for f in dataclasses.fields(cls)}
+    if unknown:
+      raise ValueError(f'Unknown request fields: {sorted(unknown)}.')
+    if not isinstance(body.get('fasta'), str) or not body['fasta'].strip():
+      raise ValueError('The request needs a non-empty "fasta" string.')
+    request = cls(**body)
+    if os.path.basename(request.name) != request.name or not request.name:
+      raise ValueError(f'Invalid name {request.name!r}.')
+    if request.db_preset is not None and request.db_preset not in _DB_PRESETS:
+      raise ValueError(f'Unknown db_preset {request.db_preset!r}.')
+    if request.max_template_date is not None:
+      time.strptime(request.max_template_date, '%Y-%m-%d')
+    return request
+
+
+class _LatencyStats:
+  """Counts of requests and latencies over a window of recent requests."""
+
+  def __init__(self, window: int):
+    self._lock = threading.Lock()
+    self._latencies = collections.deque(maxlen=window)
+    self.counts = collections.Counter()
+
+  def count(self, key: str):
+    with self._lock:
+      self.counts[key] += 1
+
+  def add(self, queue_seconds: float, run_seconds: float, failed: bool):
+    with self._lock:
+      self.counts['failed' if failed else 'completed'] += 1
+      self._latencies.append((queue_seconds, run_seconds))
+
+  def to_dict(self) -> Dict[str, Any]:
+    with self._lock:
+      counts = dict(self.counts)
+      latencies = np.array(self._latencies, dtype=np.float64).reshape(-1, 2)
+    stats = {'counts': counts, 'window_size': len(latencies)}
+    for name, values in (('queue_seconds', latencies[:, 0]),
+                         ('run_seconds', latencies[:, 1]),
+                         ('total_seconds', latencies.sum(axis=1))):
+      if not len(values):
+        stats[name] = None
+        continue
+      stats[name] = {
+          'mean': float(values.mean()),
+          'max': float(values.max()),
+          **{f'p{p}': float(np.percentile(values, p)) for p in _PERCENTILES},
+      }
+    return stats
+
+
+class FeatureServer:
+  """Runs feature requests through shared data pipelines."""
+
+  def __init__(self,
+               pipeline_factory: PipelineFactory,
+               output_dir: str,
+               default_db_preset: str,
+               default_max_template_date: str,
+               max_concurrency: int = 1,
+               max_queue_size: int = 16,
+               latency_window: int = 1000):
+    """Initializes the server.
+
+    Args:
+      pipeline_factory: Builds the data pipeline of a (db_preset,
+        max_template_date) pair.
+      output_dir: Directory under which every request gets its own directory.
+      default_db_preset: db_preset of requests that do not set one.
+      default_max_template_date: max_template_date of requests that do not
+        set one.
+      max_concurrency: Number of requests running at the same time.
+      max_queue_size: Number of requests waiting for a free slot.
+      latency_window: Number of recent requests of the latency statistics.
+    """
+    self.output_dir = output_dir
+    self.default_db_preset = default_db_preset
+    self.default_max_template_date = default_max_template_date
+    self.max_concurrency = max_concurrency
+    self.max_queue_size = max_queue_size
+    self._pipeline_factory = pipeline_factory
+    self._pipelines = {}
+    self._pipelines_lock = threading.Lock()
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        max_concurrency, thread_name_prefix='feature_server')
+    self._lock = threading.Lock()
+    self._num_queued = 0
+    self._num_running = 0
+    self._stats = _LatencyStats(latency_window)
+    self._t_0 = time.time()
+
+  def _options(self, request: FeatureRequest) -> Tuple[str, str]:
+    return (request.db_preset or self.default_db_preset,
+            request.max_template_date or self.default_max_template_date)
+
+  def pipeline(self, db_preset: str,
+               max_template_date: str) -> run_data_pipeline.DataPipeline:
+    """Returns the shared pipeline of some options, building it if needed."""
+    key = (db_preset, max_template_date)
+    with self._pipelines_lock:
+      if key not in self._pipelines:
+        t_0 = time.time()
+        self._pipelines[key] = self._pipeline_factory(*key)
+        logging.info('Built the data pipeline for %s in %.1f s.', key,
+                     time.time() - t_0)
+      return self._pipelines[key]
+
+  def _run(self, request: FeatureRequest, request_id: str,
+           submit_time: float) -> Dict[str, Any]:
+    start_time = time.time()
+    with self._lock:
+      self._num_queued -= 1
+      self._num_running += 1
+    failed = True
+    try:
+      db_preset, max_template_date = self._options(request)
+      data_pipeline = self.pipeline(db_preset, max_template_date)
+      output_dir = os.path.join(self.output_dir, request_id)
+      msa_output_dir = os.path.join(output_dir, 'msas')
+      os.makedirs(msa_output_dir, exist_ok=True)
+      fasta_path = os.path.join(output_dir, f'{request.name}.fasta')
+      with open(fasta_path, 'w') as f:
+        f.write(request.fasta)
+      logging.info('Running request %s (%s, %s).', request_id, db_preset,
+                   max_template_date)
+      feature_dict = data_pipeline.process(
+          input_fasta_path=fasta_path, msa_output_dir=msa_output_dir)
+      run_data_pipeline.write_features(feature_dict, output_dir)
+      failed = False
+    finally:
+      end_time = time.time()
+      with self._lock:
+        self._num_running -= 1
+      self._stats.add(start_time - submit_time, end_time - start_time, failed)
+    logging.info('Finished request %s in %.1f s (%.1f s queued).', request_id,
+                 end_time - submit_time, start_time - submit_time)
+    return {
+        'request_id': request_id,
+        'name': request.name,
+        'db_preset': db_preset,
+        'max_template_date': max_template_date,
+        'output_dir': output_dir,
+        'features_path': os.path.join(output_dir, 'features.pkl'),
+        'queue_seconds': start_time - submit_time,
+        'run_seconds': end_time - start_time,
+    }
+
+  def submit(self, request: FeatureRequest) -> concurrent.futures.Future:
+    """Queues a request and returns a future of its result.
+
+    Raises:
+      QueueFullError: If `max_queue_size` requests are already waiting.
+    """
+    with self._lock:
+      if self._num_queued >= self.max_queue_size + max(
+          0, self.max_concurrency - self._num_running):
+        self._stats.count('rejected')
+        raise QueueFullError(
+            f'{self._num_queued} requests are already waiting.')
+      self._num_queued += 1
+    self._stats.count('submitted')
+    request_id = f'{request.name}_{uuid.uuid4().hex[:8]}'
+    return self._executor.submit(self._run, request, request_id, time.time())
+
+  def stats(self) -> Dict[str, Any]:
+    with self._lock:
+      num_queued, num_running = self._num_queued, self._num_running
+    return {
+        'uptime_seconds': time.time() - self._t_0,
+        'queue_depth': num_queued,
+        'running': num_running,
+        'max_concurrency': self.max_concurrency,
+        'max_queue_size': self.max_queue_size,
+        'pipelines': [list(key) for key in self._pipelines],
+        **self._stats.to_dict(),
+    }
+
+  def shutdown(self):
+    self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+  """Handles the HTTP API of a `FeatureServer`."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def _send_json(self, status: int, body: Mapping[str, Any],
+                 headers: Optional[Mapping[str, str]] = None):
+    data = json.dumps(body, indent=2).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    for key, value in (headers or {}).items():
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    if self.path == '/stats':
+      self._send_json(200, self.server.feature_server.stats())
+    elif self.path == '/healthz':
+      self._send_json(200, {'status': 'ok'})
+    else:
+      self._send_json(404, {'error': f'Unknown path {self.path}.'})
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    if self.path != '/features':
+      self._send_json(404, {'error': f'Unknown path {self.path}.'})
+      return
+    try:
+      length = int(self.headers.get('Content-Length', 0))
+      request = FeatureRequest.from_json(json.loads(self.rfile.read(length)))
+    except (ValueError, TypeError) as e:
+      self._send_json(400, {'error': str(e)})
+      return
+    try:
+      future = self.server.feature_server.submit(request)
+    except QueueFullError as e:
+      self._send_json(503, {'error': str(e)}, {'Retry-After': '60'})
+      return
+    try:
+      result = future.result()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception('Request %s failed.', request.name)
+      self._send_json(500, {'error': f'{type(e).__name__}: {e}'})
+      return
+    self._send_json(200, result)
+
+  def address_string(self) -> str:
+    # Unix socket clients have no address.
+    return str(self.client_address[0]) if self.client_address else 'unix'
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    logging.info('%s %s', self.address_string(), format % args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+def make_http_server(feature_server: FeatureServer,
+                     host: str = '127.0.0.1',
+                     port: int = 8080,
+                     socket_path: Optional[str] = None
+                     ) -> socketserver.BaseServer:
+  """Creates an HTTP server for a feature server, on TCP or a Unix socket."""
+  if socket_path:
+    if os.path.exists(socket_path):
+      os.remove(socket_path)
+    server = _UnixHTTPServer(socket_path, _RequestHandler)
+  else:
+    server = http.server.ThreadingHTTPServer((host, port), _RequestHandler)
+    server.daemon_threads = True
+  server.feature_server = feature_server
+  return server
+
+
+def main(argv):
+  feature_server = FeatureServer(
+      pipeline_factory=run_data_pipeline.create_monomer_data_pipeline,
+      output_dir=FLAGS.output_dir,
+      default_db_preset=FLAGS.db_preset,
+      default_max_template_date=FLAGS.max_template_date,
+      max_concurrency=FLAGS.server_max_concurrency,
+      max_queue_size=FLAGS.server_max_queue_size,
+      latency_window=FLAGS.server_latency_window)
+  # Builds the default pipeline, which stages its databases, before serving.
+  feature_server.pipeline(FLAGS.db_preset, FLAGS.max_template_date)
+
+  server = make_http_server(feature_server, FLAGS.server_host,
+                            FLAGS.server_port, FLAGS.server_socket)
+  logging.info('Serving features on %s.',
+               FLAGS.server_socket or f'{FLAGS.server_host}:{FLAGS.server_port}')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    logging.info('Shutting down.')
+  finally:
+    server.server_close()
+    feature_server.shutdown()
+    if FLAGS.server_socket and os.path.exists(FLAGS.server_socket):
+      os.remove(FLAGS.server_socket)
+
+
+if __name__=='__main__':
+  app.run(main)
@@ -0,0 +1,188 @@
+"""Tests for run_feature_server, with a stub data pipeline."""
+
+import http.client
+import json
+import os
+import threading
+import time
+
+from absl.testing import absltest
+import numpy as np
+
+import run_data_pipeline
+import run_feature_server
+
+_FASTA = '>query\nMKV\n'
+
+
+class _StubPipeline:
+  """Records its requests and blocks them until it is released."""
+
+  def __init__(self, options):
+    self.options = options
+    self.release = threading.Event()
+    self.release.set()
+    self.fail = False
+
+  def process(self, input_fasta_path, msa_output_dir):
+    self.release.wait()
+    if self.fail:
+      raise RuntimeError('Tool failed.')
+    with open(input_fasta_path) as f:
+      sequence = f.read().splitlines()[1]
+    return {'seq_length': np.array([len(sequence)], dtype=np.int32),
+            'msa_output_dir': msa_output_dir}
+
+
+class FeatureServerTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.pipelines = {}
+    self.output_dir = self.create_tempdir().full_path
+
+  def _factory(self, db_preset, max_template_date):
+    key = (db_preset, max_template_date)
+    self.assertNotIn(key, self.pipelines)
+    self.pipelines[key] = _StubPipeline(key)
+    return self.pipelines[key]
+
+  def _make_server(self, **kwargs):
+    feature_server = run_feature_server.FeatureServer(
+        pipeline_factory=self._factory,
+        output_dir=self.output_dir,
+        default_db_preset='reduced_dbs',
+        default_max_template_date='2021-10-01',
+        **kwargs)
+    self.addCleanup(feature_server.shutdown)
+    return feature_server
+
+  def test_runs_requests_through_shared_pipelines(self):
+    feature_server = self._make_server()
+    first = feature_server.submit(
+        run_feature_server.FeatureRequest(fasta=_FASTA, name='a')).result()
+    second = feature_server.submit(run_feature_server.FeatureRequest(
+        fasta=_FASTA, name='b', db_preset='full_dbs')).result()
+    feature_server.submit(
+        run_feature_server.FeatureRequest(fasta=_FASTA, name='c')).result()
+
+    self.assertCountEqual(self.pipelines, [('reduced_dbs', '2021-10-01'),
+                                           ('full_dbs', '2021-10-01')])
+    self.assertEqual(first['db_preset'], 'reduced_dbs')
+    self.assertEqual(second['db_preset'], 'full_dbs')
+    features = run_data_pipeline.load_features(first['features_path'])
+    np.testing.assert_array_equal(features['seq_length'], [3])
+    self.assertEqual(features['msa_output_dir'],
+                     os.path.join(first['output_dir'], 'msas'))
+    self.assertEqual(feature_server.stats()['counts'],
+                     {'submitted': 3, 'completed': 3})
+
+  def test_invalid_requests(self):
+    for body in ({}, {'fasta': ''}, {'fasta': _FASTA, 'name': '../x'},
+                 {'fasta': _FASTA, 'db_preset': 'all'},
+                 {'fasta': _FASTA, 'max_template_date': '2021'},
+                 {'fasta': _FASTA, 'other': 1}):
+      with self.assertRaises(ValueError, msg=body):
+        run_feature_server.FeatureRequest.from_json(body)
+
+
+class HttpServerTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.pipeline = _StubPipeline(None)
+    self.feature_server = run_feature_server.FeatureServer(
+        pipeline_factory=lambda *options: self.pipeline,
+        output_dir=self.create_tempdir().full_path,
+        default_db_preset='reduced_dbs',
+        default_max_template_date='2021-10-01',
+        max_concurrency=1,
+        max_queue_size=1)
+    self.server = run_feature_server.make_http_server(
+        self.feature_server, port=0)
+    thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    thread.start()
+    self.addCleanup(self.feature_server.shutdown)
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    # Unblocks the requests left waiting by a failed test.
+    self.addCleanup(self.pipeline.release.set)
+
+  def _request(self, method, path, body=None):
+    host, port = self.server.server_address[:2]
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    try:
+      connection.request(method, path,
+                         body=None if body is None else json.dumps(body))
+      response = connection.getresponse()
+      return response.status, dict(response.getheaders()), json.loads(
+          response.read())
+    finally:
+      connection.close()
+
+  def _wait_for_stats(self, **expected):
+    deadline = time.time() + 10
+    while True:
+      _, _, stats = self._request('GET', '/stats')
+      if all(stats[key] == value for key, value in expected.items()):
+        return stats
+      if time.time() > deadline:
+        self.fail(f'Stats {stats} never reached {expected}.')
+      time.sleep(0.01)
+
+  def test_features(self):
+    status, _, result = self._request('POST', '/features',
+                                      {'fasta': _FASTA, 'name': 'q'})
+    self.assertEqual(status, 200)
+    self.assertEqual(result['name'], 'q')
+    self.assertTrue(os.path.exists(result['features_path']))
+
+    status, _, result = self._request('POST', '/features', {'name': 'q'})
+    self.assertEqual(status, 400)
+    status, _, _ = self._request('GET', '/unknown')
+    self.assertEqual(status, 404)
+
+    self.pipeline.fail = True
+    status, _, result = self._request('POST', '/features', {'fasta': _FASTA})
+    self.assertEqual(status, 500)
+    self.assertIn('Tool failed.', result['error'])
+
+    stats = self._wait_for_stats(running=0)
+    self.assertEqual(stats['counts'],
+                     {'submitted': 2, 'completed': 1, 'failed': 1})
+    self.assertEqual(stats['window_size'], 2)
+    self.assertEqual(stats['pipelines'], [['reduced_dbs', '2021-10-01']])
+
+  def test_rejects_requests_when_the_queue_is_full(self):
+    self.pipeline.release.clear()
+    responses = []
+
+    def post(name):
+      responses.append(self._request('POST', '/features',
+                                     {'fasta': _FASTA, 'name': name}))
+
+    threads = [threading.Thread(target=post, args=(name,))
+               for name in ('running', 'queued')]
+    threads[0].start()
+    self._wait_for_stats(running=1)
+    threads[1].start()
+    self._wait_for_stats(running=1, queue_depth=1)
+
+    status, headers, result = self._request('POST', '/features',
+                                            {'fasta': _FASTA})
+    self.assertEqual(status, 503)
+    self.assertEqual(headers['Retry-After'], '60')
+    self.assertIn('already waiting', result['error'])
+
+    self.pipeline.release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual([status for status, _, _ in responses], [200, 200])
+    stats = self._wait_for_stats(running=0, queue_depth=0)
+    self.assertEqual(stats['counts'],
+                     {'submitted': 2, 'rejected': 1, 'completed': 2})
+    self.assertGreater(stats['queue_seconds']['max'], 0)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -22,6 +22,8 @@ from alphafold.data.tools import hmmsearch
 from alphafold.data.tools import jackhmmer
 import numpy as np
 
+import artifact_io
+
 MAX_TEMPLATE_HITS = 20
 FLAGS = flags.FLAGS
 
@@ -71,12 +73,11 @@ flags.DEFINE_string('max_template_date', '2020-05-14', 'Maximum template release
 def load_msa(msa_path, msa_format, max_sto_sequences):
     logging.info('Reading MSA from file %s', msa_path)
     if msa_format == 'sto' and max_sto_sequences is not None:
-      precomputed_msa = parsers.truncate_stockholm_msa(
+      precomputed_msa = artifact_io.truncate_stockholm_msa(
           msa_path, max_sto_sequences)
       result = {'sto': precomputed_msa}
     else:
-      with open(msa_path, 'r') as f:
-        result = {msa_format: f.read()} 
+      result = {msa_format: artifact_io.read_text(msa_path)}
     
     return result
 
@@ -0,0 +1,225 @@
+"""Builds multimer input features from a multi-chain FASTA file.
+
+Chains are grouped by sequence and the monomer data pipeline of
+`run_data_pipeline` runs once per unique sequence, with the unique sequences
+processed in parallel. Identical chains share the MSAs and templates of
+their sequence, so a homo-oligomer costs a single set of searches. The
+unpaired uniprot MSA used for cross-chain pairing is only searched if the
+complex has more than one unique sequence.
+
+All flags of `run_data_pipeline` apply to the per-chain searches.
+"""
+
+import concurrent.futures
+import copy
+import dataclasses
+import json
+import os
+import tempfile
+from typing import Dict, Mapping, Optional, Sequence
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from alphafold.common import protein
+from alphafold.data import msa_pairing
+from alphafold.data import parsers
+from alphafold.data import pipeline_multimer
+
+import encoded_msa
+import run_data_pipeline
+import species_pairing
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('max_uniprot_hits', 50000, 'Maximum number of uniprot '
+                     'hits used for MSA pairing.')
+flags.DEFINE_integer('num_chain_workers', 4, 'Number of unique chains whose '
+                     'searches run at the same time.')
+flags.DEFINE_integer('max_rows_per_species', 600, 'Species with more uniprot '
+                     'hits than this in any chain are not paired.')
+flags.DEFINE_integer('max_pairs_per_species', None, 'If set, at most this '
+                     'many rows are paired per species.')
+
+FeatureDict = run_data_pipeline.FeatureDict
+
+
+@dataclasses.dataclass(frozen=True)
+class FastaChain:
+  sequence: str
+  description: str
+
+
+def make_chain_id_map(sequences: Sequence[str],
+                      descriptions: Sequence[str]) -> Dict[str, FastaChain]:
+  """Maps PDB-format chain IDs to the chains of the input FASTA."""
+  if len(sequences) > protein.PDB_MAX_CHAINS:
+    raise ValueError('Cannot process more chains than the PDB format supports. '
+                     f'Got {len(sequences)} chains.')
+  return {chain_id: FastaChain(sequence=sequence, description=description)
+          for chain_id, sequence, description in zip(
+              protein.PDB_CHAIN_IDS, sequences, descriptions)}
+
+
+def group_chains_by_sequence(
+    chain_id_map: Mapping[str, FastaChain]) -> Dict[str, Sequence[str]]:
+  """Maps each unique sequence to its chain IDs, in input order."""
+  chains_per_sequence = {}
+  for chain_id, fasta_chain in chain_id_map.items():
+    chains_per_sequence.setdefault(fasta_chain.sequence, []).append(chain_id)
+  return chains_per_sequence
+
+
+class MultimerDataPipeline:
+  """Runs the monomer pipeline once per unique chain and assembles features."""
+
+  def __init__(self,
+               monomer_data_pipeline: run_data_pipeline.DataPipeline,
+               jackhmmer_binary_path: str,
+               uniprot_database_path: str,
+               max_uniprot_hits: int = 50000,
+               num_workers: int = 4,
+               use_precomputed_msas: bool = False,
+               seed_index_dir: Optional[str] = None,
+               seed_index_min_shared_seeds: int = 2,
+               pairing_config: species_pairing.PairingConfig = (
+                   species_pairing.PairingConfig())):
+    """Initializes the data pipeline.
+
+    Args:
+      monomer_data_pipeline: Pipeline run on every unique chain.
+      jackhmmer_binary_path: Location of the jackhmmer binary.
+      uniprot_database_path: Location of the unclustered uniprot sequences
+        searched for MSA pairing.
+      max_uniprot_hits: Maximum number of uniprot hits kept for pairing.
+      num_workers: Number of unique chains processed at the same time.
+      use_precomputed_msas: Whether to read MSAs already written to disk.
+      seed_index_dir: Directory with a `uniprot` seed index, if any.
+      seed_index_min_shared_seeds: Minimum number of seeds shared with the
+        query for a uniprot sequence to be searched.
+      pairing_config: Settings of cross-chain MSA pairing.
+    """
+    self._monomer_data_pipeline = monomer_data_pipeline
+    self._uniprot_msa_runner = run_data_pipeline.make_jackhmmer_runner(
+        binary_path=jackhmmer_binary_path,
+        database_path=uniprot_database_path,
+        seed_index_dir=(os.path.join(seed_index_dir, 'uniprot')
+                        if seed_index_dir else None),
+        min_shared_seeds=seed_index_min_shared_seeds)
+    self._max_uniprot_hits = max_uniprot_hits
+    self._num_workers = num_workers
+    self.use_precomputed_msas = use_precomputed_msas
+    self.pairing_config = pairing_config
+
+  def _all_seq_msa_features(self, input_fasta_path: str,
+                            msa_output_dir: str) -> FeatureDict:
+    """Gets MSA features of the unclustered uniprot search, for pairing."""
+    out_path = os.path.join(msa_output_dir, 'uniprot_hits.sto')
+    result = run_data_pipeline.run_msa_tool(
+        self._uniprot_msa_runner, input_fasta_path, out_path, 'sto',
+        self.use_precomputed_msas,
+        compression=self._monomer_data_pipeline.msa_compression)
+    msa = encoded_msa.EncodedMsa.from_stockholm(
+        result['sto'], max_sequences=self._max_uniprot_hits)
+    all_seq_features = run_data_pipeline.make_msa_features(
+        [msa], deletion_dtype=self._monomer_data_pipeline.deletion_dtype)
+    valid_feats = msa_pairing.MSA_FEATURES + ('msa_species_identifiers',)
+    return {f'{k}_all_seq': v for k, v in all_seq_features.items()
+            if k in valid_feats}
+
+  def _process_unique_chain(self, chain_id: str, fasta_chain: FastaChain,
+                            msa_output_dir: str,
+                            is_homomer_or_monomer: bool) -> FeatureDict:
+    """Runs the monomer pipeline on one unique sequence."""
+    chain_msa_output_dir = os.path.join(msa_output_dir, chain_id)
+    os.makedirs(chain_msa_output_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', suffix='.fasta') as chain_fasta:
+      chain_fasta.write(f'>chain_{chain_id}\n{fasta_chain.sequence}\n')
+      chain_fasta.flush()
+      logging.info('Running monomer pipeline on chain %s: %s', chain_id,
+                   fasta_chain.description)
+      chain_features = self._monomer_data_pipeline.process(
+          input_fasta_path=chain_fasta.name,
+          msa_output_dir=chain_msa_output_dir)
+      # Pairing features are only needed with 2 or more unique sequences.
+      if not is_homomer_or_monomer:
+        chain_features.update(
+            self._all_seq_msa_features(chain_fasta.name, chain_msa_output_dir))
+    return chain_features
+
+  def process_chains(self, chain_id_map: Mapping[str, FastaChain],
+                     msa_output_dir: str) -> Dict[str, FeatureDict]:
+    """Computes the converted per-chain features of every chain."""
+    chains_per_sequence = group_chains_by_sequence(chain_id_map)
+    is_homomer_or_monomer = len(chains_per_sequence) == 1
+    logging.info('Processing %d unique sequences for %d chains.',
+                 len(chains_per_sequence), len(chain_id_map))
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=self._num_workers) as executor:
+      futures = {
+          sequence: executor.submit(
+              self._process_unique_chain, chain_ids[0],
+              chain_id_map[chain_ids[0]], msa_output_dir,
+              is_homomer_or_monomer)
+          for sequence, chain_ids in chains_per_sequence.items()}
+      sequence_features = {sequence: future.result()
+                           for sequence, future in futures.items()}
+
+    all_chain_features = {}
+    for chain_id, fasta_chain in chain_id_map.items():
+      all_chain_features[chain_id] = pipeline_multimer.convert_monomer_features(
+          copy.deepcopy(sequence_features[fasta_chain.sequence]),
+          chain_id=chain_id)
+    return all_chain_features
+
+  def process(self, input_fasta_path: str,
+              msa_output_dir: str) -> FeatureDict:
+    """Runs alignment tools on the input sequences and creates features."""
+    with open(input_fasta_path) as f:
+      input_seqs, input_descs = parsers.parse_fasta(f.read())
+    chain_id_map = make_chain_id_map(input_seqs, input_descs)
+    os.makedirs(msa_output_dir, exist_ok=True)
+    with open(os.path.join(msa_output_dir, 'chain_id_map.json'), 'w') as f:
+      json.dump({chain_id: dataclasses.asdict(fasta_chain)
+                 for chain_id, fasta_chain in chain_id_map.items()},
+                f, indent=4, sort_keys=True)
+
+    all_chain_features = self.process_chains(chain_id_map, msa_output_dir)
+    all_chain_features = pipeline_multimer.add_assembly_features(
+        all_chain_features)
+    np_example = species_pairing.pair_and_merge(
+        all_chain_features, self.pairing_config)
+    # Pad MSA to avoid zero-sized extra_msa.
+    return pipeline_multimer.pad_msa(np_example, 512)
+
+
+def main(argv):
+  # Path to the Uniprot database for use by JackHMMER.
+  uniprot_database_path = os.path.join(
+      FLAGS.data_dir, 'uniprot', 'uniprot.fasta')
+
+  data_pipeline = MultimerDataPipeline(
+      monomer_data_pipeline=run_data_pipeline.create_monomer_data_pipeline(),
+      jackhmmer_binary_path=FLAGS.jackhmmer_binary_path,
+      uniprot_database_path=uniprot_database_path,
+      max_uniprot_hits=FLAGS.max_uniprot_hits,
+      num_workers=FLAGS.num_chain_workers,
+      use_precomputed_msas=FLAGS.use_precomputed_msas,
+      seed_index_dir=FLAGS.seed_index_dir,
+      seed_index_min_shared_seeds=FLAGS.seed_index_min_shared_seeds,
+      pairing_config=species_pairing.PairingConfig(
+          max_rows_per_species=FLAGS.max_rows_per_species,
+          max_pairs_per_species=FLAGS.max_pairs_per_species))
+
+  input_fasta_path = FLAGS.fasta_paths[0]
+  msa_output_dir = os.path.join(FLAGS.output_dir, 'msas')
+  feature_dict = data_pipeline.process(
+      input_fasta_path=input_fasta_path,
+      msa_output_dir=msa_output_dir)
+  run_data_pipeline.write_features(feature_dict, FLAGS.output_dir)
+
+
+if __name__=='__main__':
+  app.run(main)
@@ -0,0 +1,378 @@
+"""Overlaps the data stage of the next targets with inference of the current.
+
+The data stage of a target (hours of MSA search on CPUs) and its inference
+(minutes to hours on a GPU) run one after the other when every target is a
+separate job, so the GPU is idle most of the time. This driver runs the data
+stage of several targets in a pool of CPU workers and hands their feature
+files to a single inference worker through a bounded queue. A worker that
+finishes a target while the queue is full waits before starting the next
+one, so features are never produced much faster than they are consumed.
+
+The busy and waiting time of both stages is reported at the end, which shows
+which stage limits the throughput.
+
+All flags of `run_data_pipeline` apply to the data stage. With
+`--inference=stub` inference is replaced with a sleep, so the driver can be
+run end to end on a machine without accelerators.
+"""
+
+import concurrent.futures
+import dataclasses
+import json
+import os
+import pickle
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+from absl import app
+from absl import flags
+from absl import logging
+
+import numpy as np
+
+import parallel_relax
+import run_data_pipeline
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('num_feature_workers', 2, 'Number of targets whose data '
+                     'stage runs at the same time.')
+flags.DEFINE_integer('feature_queue_size', 1, 'Maximum number of feature '
+                     'files waiting for inference.')
+flags.DEFINE_enum('inference', 'alphafold', ['alphafold', 'stub'],
+                  'Runs the AlphaFold models, or a stub that sleeps for '
+                  '--stub_inference_seconds and writes a placeholder result.')
+flags.DEFINE_list('model_names', ['model_1', 'model_2', 'model_3', 'model_4',
+                                  'model_5'], 'Names of the models to run.')
+flags.DEFINE_string('params_dir', None, 'Directory with the model parameters. '
+                    'Defaults to data_dir.')
+flags.DEFINE_integer('random_seed', 0, 'Random seed of the models.')
+flags.DEFINE_list('length_buckets', ['64', '128', '256', '384', '512', '768',
+                                     '1024', '1280', '1536', '2048', '2560',
+                                     '3072', '4096'],
+                  'Lengths the targets are padded to, so the models are '
+                  'compiled once per bucket rather than once per target.')
+flags.DEFINE_integer('relax_top_k', 1, 'Number of predictions with the '
+                     'highest confidence that are relaxed with Amber. 0 '
+                     'disables relaxation and -1 relaxes all predictions.')
+flags.DEFINE_integer('relax_num_workers', 4, 'Number of relaxations running '
+                     'at the same time, each in its own process.')
+flags.DEFINE_integer('relax_threads_per_worker', 1, 'Number of OpenMM CPU '
+                     'threads of each relaxation process.')
+flags.DEFINE_boolean('relax_while_predicting', False, 'Whether to start '
+                     'relaxing each prediction as soon as its model finishes, '
+                     'overlapping relaxation with the remaining models. '
+                     'Relaxations of predictions outside the top k are '
+                     'cancelled if they have not started by the end.')
+flags.DEFINE_integer('relax_max_iterations', 0, 'Maximum number of L-BFGS '
+                     'iterations of relaxation. 0 means no maximum.')
+flags.DEFINE_float('relax_energy_tolerance', 2.39, 'Energy tolerance of '
+                   'relaxation, in kcal/mol.')
+flags.DEFINE_float('relax_stiffness', 10.0, 'Spring constant of the heavy '
+                   'atom restraints of relaxation, in kcal/mol A**2.')
+flags.DEFINE_integer('relax_max_outer_iterations', 20, 'Maximum number of '
+                     'violation-informed relaxation iterations.')
+flags.DEFINE_float('stub_inference_seconds', 5.0, 'Duration of the stub '
+                   'inference of a target.')
+
+# (target name, path of its features file) -> result to report.
+InferenceFn = Callable[[str, str], Any]
+# (target name, FASTA path) -> path of the features file.
+FeatureFn = Callable[[str, str], str]
+
+
+@dataclasses.dataclass
+class StageStats:
+  """Time spent by the workers of a stage.
+
+  `busy_seconds` is the time spent processing targets. `wait_seconds` is the
+  time spent blocked on the queue: waiting for space for the data stage
+  (backpressure) and waiting for features for inference (starvation).
+  """
+  name: str
+  num_workers: int
+  num_targets: int = 0
+  num_failures: int = 0
+  busy_seconds: float = 0.0
+  wait_seconds: float = 0.0
+
+  def __post_init__(self):
+    self._lock = threading.Lock()
+
+  def add(self, busy_seconds: float = 0.0, wait_seconds: float = 0.0,
+          failed: bool = False):
+    with self._lock:
+      self.num_targets += 1
+      self.num_failures += int(failed)
+      self.busy_seconds += busy_seconds
+      self.wait_seconds += wait_seconds
+
+  def add_wait(self, wait_seconds: float):
+    with self._lock:
+      self.wait_seconds += wait_seconds
+
+  def to_dict(self, wall_seconds: float) -> Dict[str, Any]:
+    return {
+        'num_workers': self.num_workers,
+        'num_targets': self.num_targets,
+        'num_failures': self.num_failures,
+        'busy_seconds': self.busy_seconds,
+        'wait_seconds': self.wait_seconds,
+        'utilization': self.busy_seconds / max(
+            wall_seconds * self.num_workers, 1e-9),
+    }
+
+
+class PipelinedDriver:
+  """Runs the data stage and inference of several targets concurrently."""
+
+  def __init__(self,
+               feature_fn: FeatureFn,
+               inference_fn: InferenceFn,
+               num_feature_workers: int = 2,
+               queue_size: int = 1):
+    """Initializes the driver.
+
+    Args:
+      feature_fn: Runs the data stage of a target and returns the path of its
+        features file.
+      inference_fn: Runs inference on the features file of a target.
+      num_feature_workers: Number of targets in the data stage at a time.
+      queue_size: Maximum number of feature files waiting for inference.
+    """
+    self._feature_fn = feature_fn
+    self._inference_fn = inference_fn
+    self._num_feature_workers = num_feature_workers
+    self._queue_size = queue_size
+
+  def _feature_worker(self, targets: 'queue.Queue[Tuple[str, str]]',
+                      features: 'queue.Queue[Optional[Tuple[str, str]]]',
+                      stats: StageStats, errors: Dict[str, str]):
+    while True:
+      try:
+        name, fasta_path = targets.get_nowait()
+      except queue.Empty:
+        return
+      t_0 = time.time()
+      try:
+        features_path = self._feature_fn(name, fasta_path)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception('Data stage of %s failed.', name)
+        errors[name] = f'data stage: {e}'
+        stats.add(busy_seconds=time.time() - t_0, failed=True)
+        continue
+      t_1 = time.time()
+      # Blocks while the queue is full, before starting another target.
+      features.put((name, features_path))
+      stats.add(busy_seconds=t_1 - t_0, wait_seconds=time.time() - t_1)
+      logging.info('Data stage of %s done in %.1f s.', name, t_1 - t_0)
+
+  def run(self, targets: Sequence[Tuple[str, str]]) -> Dict[str, Any]:
+    """Processes (name, FASTA path) targets and returns a report."""
+    t_start = time.time()
+    target_queue = queue.Queue()
+    for target in targets:
+      target_queue.put(target)
+    feature_queue = queue.Queue(maxsize=self._queue_size)
+    feature_stats = StageStats('features', self._num_feature_workers)
+    inference_stats = StageStats('inference', 1)
+    errors = {}
+    results = {}
+
+    executor = concurrent.futures.ThreadPoolExecutor(self._num_feature_workers)
+    workers = [
+        executor.submit(self._feature_worker, target_queue, feature_queue,
+                        feature_stats, errors)
+        for _ in range(self._num_feature_workers)]
+    # Signals the end of the data stage once all workers return.
+    threading.Thread(
+        target=lambda: (concurrent.futures.wait(workers),
+                        feature_queue.put(None)),
+        daemon=True).start()
+
+    while True:
+      t_0 = time.time()
+      item = feature_queue.get()
+      inference_stats.add_wait(time.time() - t_0)
+      if item is None:
+        break
+      name, features_path = item
+      t_0 = time.time()
+      try:
+        results[name] = self._inference_fn(name, features_path)
+        inference_stats.add(busy_seconds=time.time() - t_0)
+        logging.info('Inference of %s done in %.1f s.', name,
+                     time.time() - t_0)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception('Inference of %s failed.', name)
+        errors[name] = f'inference: {e}'
+        inference_stats.add(busy_seconds=time.time() - t_0, failed=True)
+    executor.shutdown()
+
+    wall_seconds = time.time() - t_start
+    report = {
+        'wall_seconds': wall_seconds,
+        'stages': {
+            stats.name: stats.to_dict(wall_seconds)
+            for stats in (feature_stats, inference_stats)},
+        'results': results,
+        'errors': errors,
+    }
+    for name, stage in report['stages'].items():
+      logging.info('Stage %s: %d targets, %.0f%% utilization, %.1f s busy, '
+                   '%.1f s waiting on the queue.', name, stage['num_targets'],
+                   100 * stage['utilization'], stage['busy_seconds'],
+                   stage['wait_seconds'])
+    return report
+
+
+def target_name(fasta_path: str) -> str:
+  return os.path.splitext(os.path.basename(fasta_path))[0]
+
+
+def make_feature_fn(data_pipeline: run_data_pipeline.DataPipeline,
+                    output_dir: str) -> FeatureFn:
+  """Returns a data stage writing `<output_dir>/<target>/features.pkl`."""
+
+  def feature_fn(name: str, fasta_path: str) -> str:
+    target_output_dir = os.path.join(output_dir, name)
+    msa_output_dir = os.path.join(target_output_dir, 'msas')
+    os.makedirs(msa_output_dir, exist_ok=True)
+    feature_dict = data_pipeline.process(
+        input_fasta_path=fasta_path, msa_output_dir=msa_output_dir)
+    run_data_pipeline.write_features(feature_dict, target_output_dir)
+    return os.path.join(target_output_dir, 'features.pkl')
+
+  return feature_fn
+
+
+def make_stub_inference_fn(seconds: float) -> InferenceFn:
+  """Returns an inference stand-in that sleeps and writes a placeholder."""
+
+  def inference_fn(name: str, features_path: str) -> Dict[str, Any]:
+    feature_dict = run_data_pipeline.load_features(features_path)
+    time.sleep(seconds)
+    result = {'num_res': int(np.asarray(feature_dict['seq_length'])[0])}
+    with open(os.path.join(os.path.dirname(features_path),
+                           'result_stub.json'), 'w') as f:
+      json.dump(result, f)
+    return result
+
+  return inference_fn
+
+
+def make_alphafold_inference_fn(
+    model_names: Sequence[str],
+    params_dir: str,
+    random_seed: int,
+    length_buckets: Sequence[int],
+    relaxer: Optional[parallel_relax.ParallelRelaxer] = None,
+    relax_top_k: Optional[int] = None,
+    relax_while_predicting: bool = False) -> InferenceFn:
+  """Returns inference writing `unrelaxed_<model>.pdb` next to the features.
+
+  Features are padded to length buckets, so the models are compiled once per
+  bucket rather than once per target. If a relaxer is given, the `relax_top_k`
+  best predictions (all if None) are relaxed concurrently and written to
+  `relaxed_<model>.pdb`, with their energies and violations in
+  `relax_metrics.json`.
+  """
+  # JAX is only needed for real inference.
+  from alphafold.common import protein
+  import bucketed_inference
+
+  model_runner = bucketed_inference.BucketedModelRunner(
+      model_names=model_names,
+      params_dir=params_dir,
+      buckets=length_buckets,
+      random_seed=random_seed)
+
+  def inference_fn(name: str, features_path: str) -> Dict[str, Any]:
+    feature_dict = run_data_pipeline.load_features(features_path)
+    output_dir = os.path.dirname(features_path)
+    unrelaxed_proteins = {}
+
+    def on_prediction(model_name, prediction_result, processed_features):
+      unrelaxed_proteins[model_name] = protein.from_prediction(
+          processed_features, prediction_result)
+      if relaxer is not None and relax_while_predicting:
+        relaxer.submit(model_name, unrelaxed_proteins[model_name])
+
+    predictions, _ = model_runner.predict(feature_dict, on_prediction)
+    plddts = {}
+    for model_name, prediction_result in predictions.items():
+      plddts[model_name] = float(np.mean(prediction_result['plddt']))
+      with open(os.path.join(output_dir, f'unrelaxed_{model_name}.pdb'),
+                'w') as f:
+        f.write(protein.to_pdb(unrelaxed_proteins[model_name]))
+      with open(os.path.join(output_dir, f'result_{model_name}.pkl'),
+                'wb') as f:
+        pickle.dump(prediction_result, f, protocol=4)
+    logging.info('Mean pLDDT of %s: %s', name, plddts)
+
+    if relaxer is not None:
+      to_relax = parallel_relax.top_k(plddts, relax_top_k)
+      if relax_while_predicting:
+        relax_results = relaxer.results(to_relax)
+      else:
+        relax_results = relaxer.relax_all(
+            {model_name: unrelaxed_proteins[model_name]
+             for model_name in to_relax})
+      relax_metrics = {}
+      for model_name, (relaxed_pdb, debug_data, violations) in (
+          relax_results.items()):
+        with open(os.path.join(output_dir, f'relaxed_{model_name}.pdb'),
+                  'w') as f:
+          f.write(relaxed_pdb)
+        relax_metrics[model_name] = {
+            **{k: float(v) for k, v in debug_data.items()},
+            'num_violations': int(np.sum(violations)),
+        }
+      with open(os.path.join(output_dir, 'relax_metrics.json'), 'w') as f:
+        json.dump(relax_metrics, f, indent=2)
+
+    return {'plddts': plddts, 'timings': model_runner.timings.to_dict()}
+
+  return inference_fn
+
+
+def main(argv):
+  if FLAGS.inference == 'stub':
+    inference_fn = make_stub_inference_fn(FLAGS.stub_inference_seconds)
+  else:
+    relaxer = None
+    if FLAGS.relax_top_k:
+      relaxer = parallel_relax.ParallelRelaxer(
+          config=parallel_relax.RelaxConfig(
+              max_iterations=FLAGS.relax_max_iterations,
+              tolerance=FLAGS.relax_energy_tolerance,
+              stiffness=FLAGS.relax_stiffness,
+              max_outer_iterations=FLAGS.relax_max_outer_iterations),
+          num_workers=FLAGS.relax_num_workers,
+          threads_per_worker=FLAGS.relax_threads_per_worker)
+    inference_fn = make_alphafold_inference_fn(
+        FLAGS.model_names, FLAGS.params_dir or FLAGS.data_dir,
+        FLAGS.random_seed, [int(b) for b in FLAGS.length_buckets],
+        relaxer=relaxer,
+        relax_top_k=FLAGS.relax_top_k if FLAGS.relax_top_k > 0 else None,
+        relax_while_predicting=FLAGS.relax_while_predicting)
+
+  driver = PipelinedDriver(
+      feature_fn=make_feature_fn(
+          run_data_pipeline.create_monomer_data_pipeline(), FLAGS.output_dir),
+      inference_fn=inference_fn,
+      num_feature_workers=FLAGS.num_feature_workers,
+      queue_size=FLAGS.feature_queue_size)
+  report = driver.run(
+      [(target_name(path), path) for path in FLAGS.fasta_paths])
+
+  with open(os.path.join(FLAGS.output_dir, 'pipeline_report.json'), 'w') as f:
+    json.dump(report, f, indent=2)
+  if report['errors']:
+    raise RuntimeError(f'Failed targets: {report["errors"]}')
+
+
+if __name__=='__main__':
+  app.run(main)
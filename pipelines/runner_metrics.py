@@ -0,0 +1,96 @@
+"""Collects the metrics of a search runner as JSON.
+
+A runner records when its VM booted and when it started, how long the tool
+and the other steps took, the CPU time and peak memory of the runner and of
+the tools it ran, and the number of sequences and bytes of its output. The
+component that submitted the job reads the JSON file to compute the queue
+time and to report the metrics, so runs and machine types can be compared.
+"""
+
+import contextlib
+import json
+import os
+import re
+import resource
+import time
+from typing import Any, Dict
+
+import artifact_io
+
+_HHR_HIT_RE = re.compile(r'^No \d+')
+
+
+def seconds_since_boot() -> float:
+  with open('/proc/uptime') as f:
+    return float(f.read().split()[0])
+
+
+def total_memory_bytes() -> int:
+  return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def count_sequences(path: str, data_format: str) -> int:
+  """Counts the sequences of an MSA, or the hits of an HHR file."""
+  count = 0
+  names = set()
+  with artifact_io.open_text(path) as f:
+    for line in f:
+      if data_format == 'sto':
+        if line.strip() and not line.startswith(('#', '//')):
+          names.add(line.partition(' ')[0])
+      elif data_format == 'hhr':
+        count += bool(_HHR_HIT_RE.match(line))
+      else:
+        count += line.startswith('>')
+  return len(names) if data_format == 'sto' else count
+
+
+class RunnerMetrics:
+  """Metrics of a runner, starting when it is created."""
+
+  def __init__(self):
+    uptime = seconds_since_boot()
+    self.start_time = time.time()
+    self.metrics: Dict[str, Any] = {
+        'boot_time': self.start_time - uptime,
+        'start_time': self.start_time,
+        'boot_to_start_seconds': uptime,
+        'num_cpus': os.cpu_count(),
+        'memory_bytes': total_memory_bytes(),
+    }
+
+  @contextlib.contextmanager
+  def timed(self, name: str):
+    """Adds the duration of the body of the context to metric `name`."""
+    t_0 = time.time()
+    try:
+      yield
+    finally:
+      self.metrics[name] = self.metrics.get(name, 0.0) + time.time() - t_0
+
+  def record_output(self, path: str, data_format: str,
+                    prefix: str = 'output'):
+    self.metrics[f'{prefix}_bytes'] = os.path.getsize(path)
+    self.metrics[f'{prefix}_num_sequences'] = count_sequences(
+        path, data_format)
+
+  def finish(self) -> Dict[str, Any]:
+    """Records the end time, CPU time and peak memory and returns all."""
+    end_time = time.time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self.metrics.update({
+        'end_time': end_time,
+        'wall_seconds': end_time - self.start_time,
+        'cpu_seconds': (usage.ru_utime + usage.ru_stime +
+                        children.ru_utime + children.ru_stime),
+        'tool_cpu_seconds': children.ru_utime + children.ru_stime,
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_bytes': usage.ru_maxrss * 1024,
+        'tool_peak_rss_bytes': children.ru_maxrss * 1024,
+    })
+    return self.metrics
+
+  def write(self, path: str):
+    with open(path, 'w') as f:
+      json.dump(self.finish(), f, indent=2)
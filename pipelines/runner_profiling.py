@@ -0,0 +1,176 @@
+"""Profiles a runner and writes the profiles next to its output.
+
+Wraps the work of a runner in cProfile and tracemalloc and samples the
+resident memory of the runner and of the tools it runs in a background
+thread. The time of a tool shows up in the cProfile stats as the time spent
+waiting on its subprocess, so the stats tell apart time in the tool, in
+Python parsing and in writing the output.
+
+The profiles are written as files sharing the prefix of the output path:
+
+  <prefix>.prof             cProfile stats, for pstats, snakeviz or gprof2dot.
+  <prefix>.prof.txt         The functions with the highest cumulative time.
+  <prefix>.tracemalloc      tracemalloc snapshot, for tracemalloc.Snapshot.load.
+  <prefix>.tracemalloc.txt  The lines with the largest live allocations.
+  <prefix>.rss.tsv          Resident memory over time, in bytes.
+  <prefix>.profile.json     Wall and CPU time and peak memory.
+
+Runners import this module only when profiling is enabled, so it costs
+nothing otherwise.
+"""
+
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Tuple
+
+from absl import logging
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def _rss_bytes(pid: int) -> int:
+  with open(f'/proc/{pid}/statm') as f:
+    return int(f.read().split()[1]) * _PAGE_SIZE
+
+
+def _child_pids(pid: int) -> List[int]:
+  children = []
+  try:
+    for tid in os.listdir(f'/proc/{pid}/task'):
+      with open(f'/proc/{pid}/task/{tid}/children') as f:
+        children.extend(int(child) for child in f.read().split())
+  except OSError:
+    pass
+  return children
+
+
+def descendants_rss_bytes(pid: int) -> int:
+  """Resident memory of all descendant processes, e.g. the search tools."""
+  total = 0
+  pending = _child_pids(pid)
+  while pending:
+    child = pending.pop()
+    try:
+      total += _rss_bytes(child)
+    except OSError:
+      # The process exited.
+      continue
+    pending.extend(_child_pids(child))
+  return total
+
+
+class _RssSampler:
+  """Samples the resident memory of the process tree in a thread."""
+
+  def __init__(self, interval: float):
+    self.interval = interval
+    self.samples: List[Tuple[float, int, int]] = []
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._t_0 = None
+
+  def _sample(self):
+    pid = os.getpid()
+    self.samples.append((time.time() - self._t_0, _rss_bytes(pid),
+                         descendants_rss_bytes(pid)))
+
+  def _run(self):
+    while not self._stop.wait(self.interval):
+      self._sample()
+
+  def start(self) -> '_RssSampler':
+    self._t_0 = time.time()
+    self._sample()
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._stop.set()
+    self._thread.join()
+    self._sample()
+
+  def write(self, path: str):
+    with open(path, 'w') as f:
+      f.write('seconds\trss_bytes\tchildren_rss_bytes\n')
+      for seconds, rss, children_rss in self.samples:
+        f.write(f'{seconds:.3f}\t{rss}\t{children_rss}\n')
+
+
+def _peak_rss_bytes(who: int) -> int:
+  # ru_maxrss is in kilobytes on Linux.
+  return resource.getrusage(who).ru_maxrss * 1024
+
+
+def _cpu_seconds(who: int) -> Dict[str, float]:
+  usage = resource.getrusage(who)
+  return {'user': usage.ru_utime, 'system': usage.ru_stime}
+
+
+@contextlib.contextmanager
+def profiled(output_path: str,
+             top_n: int = 30,
+             rss_interval: float = 1.0,
+             traceback_frames: int = 1):
+  """Profiles the body of the context and writes the profiles.
+
+  Args:
+    output_path: Output of the runner. Profiles are written next to it.
+    top_n: Number of entries of the text reports.
+    rss_interval: Seconds between resident memory samples.
+    traceback_frames: Number of frames stored by tracemalloc per allocation.
+      More frames show the callers of allocations but slow allocations down.
+
+  Yields:
+    Nothing.
+  """
+  sampler = _RssSampler(rss_interval).start()
+  tracemalloc.start(traceback_frames)
+  profiler = cProfile.Profile()
+  t_0 = time.time()
+  profiler.enable()
+  try:
+    yield
+  finally:
+    profiler.disable()
+    wall_seconds = time.time() - t_0
+    snapshot = tracemalloc.take_snapshot()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sampler.stop()
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    profiler.dump_stats(f'{output_path}.prof')
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats(
+        'cumulative').print_stats(top_n)
+    with open(f'{output_path}.prof.txt', 'w') as f:
+      f.write(stream.getvalue())
+
+    snapshot.dump(f'{output_path}.tracemalloc')
+    with open(f'{output_path}.tracemalloc.txt', 'w') as f:
+      for stat in snapshot.statistics('lineno')[:top_n]:
+        f.write(f'{stat}\n')
+    sampler.write(f'{output_path}.rss.tsv')
+
+    summary = {
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': _cpu_seconds(resource.RUSAGE_SELF),
+        'children_cpu_seconds': _cpu_seconds(resource.RUSAGE_CHILDREN),
+        'peak_rss_bytes': _peak_rss_bytes(resource.RUSAGE_SELF),
+        'children_peak_rss_bytes': _peak_rss_bytes(resource.RUSAGE_CHILDREN),
+        'peak_sampled_children_rss_bytes': max(
+            children_rss for _, _, children_rss in sampler.samples),
+        'tracemalloc_peak_bytes': traced_peak,
+    }
+    with open(f'{output_path}.profile.json', 'w') as f:
+      json.dump(summary, f, indent=2)
+    logging.info('Wrote profiles to %s.*: %.1f s wall, %.1f MB peak RSS.',
+                 output_path, wall_seconds, summary['peak_rss_bytes'] / 1e6)
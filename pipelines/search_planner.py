@@ -0,0 +1,83 @@
+"""Decides whether the BFD search is worth running for a target.
+
+The HHblits search over BFD and Uniclust30 is by far the most expensive step
+of the data pipeline. For well studied families the cheap UniRef90 and MGnify
+searches already return a deep and diverse MSA, and the BFD search adds
+little. The planner looks at the depth and Neff of the MSAs found so far and
+either runs the full search, downgrades it to a jackhmmer search over small
+BFD, or skips it.
+"""
+
+import dataclasses
+import json
+from typing import Any, Dict, Sequence
+
+import numpy as np
+
+import encoded_msa
+import msa_stats
+
+RUN = 'run'
+DOWNGRADE = 'downgrade'
+SKIP = 'skip'
+
+
+@dataclasses.dataclass(frozen=True)
+class PlannerConfig:
+  """Thresholds of the planner.
+
+  The BFD search is skipped if both skip thresholds are reached, downgraded
+  if both downgrade thresholds are reached, and run otherwise.
+  """
+  skip_min_sequences: int = 5000
+  skip_min_neff: float = 1000.0
+  downgrade_min_sequences: int = 1000
+  downgrade_min_neff: float = 200.0
+  identity_threshold: float = 0.8
+
+
+@dataclasses.dataclass(frozen=True)
+class SearchPlan:
+  decision: str
+  num_sequences: int
+  neff: float
+  reason: str
+
+  def to_dict(self) -> Dict[str, Any]:
+    return dataclasses.asdict(self)
+
+
+def plan_bfd_search(msas: Sequence[encoded_msa.EncodedMsa],
+                    config: PlannerConfig) -> SearchPlan:
+  """Plans the BFD search from the MSAs of the cheap searches."""
+  keep_per_msa = encoded_msa.first_unique_rows_across(msas)
+  encoded = np.concatenate(
+      [msa.encoded[keep] for msa, keep in zip(msas, keep_per_msa)])
+  num_sequences = len(encoded)
+  neff = msa_stats.neff(encoded, config.identity_threshold)
+  summary = (f'{num_sequences} unique sequences, Neff {neff:.1f} at '
+             f'{config.identity_threshold:.0%} identity')
+
+  if (num_sequences >= config.skip_min_sequences and
+      neff >= config.skip_min_neff):
+    decision = SKIP
+    reason = (f'{summary} reach the skip thresholds '
+              f'({config.skip_min_sequences}, {config.skip_min_neff}).')
+  elif (num_sequences >= config.downgrade_min_sequences and
+        neff >= config.downgrade_min_neff):
+    decision = DOWNGRADE
+    reason = (f'{summary} reach the downgrade thresholds '
+              f'({config.downgrade_min_sequences}, '
+              f'{config.downgrade_min_neff}).')
+  else:
+    decision = RUN
+    reason = f'{summary} are below the downgrade thresholds.'
+  return SearchPlan(decision=decision,
+                    num_sequences=num_sequences,
+                    neff=neff,
+                    reason=reason)
+
+
+def write_search_plan(plan: SearchPlan, output_path: str):
+  with open(output_path, 'w') as f:
+    json.dump(plan.to_dict(), f, indent=2)
@@ -0,0 +1,246 @@
+"""Template search with hmmsearch over a sharded sequence database.
+
+The profile is built once from the template search MSA and every shard of
+the database (pdb_seqres by default) is searched by its own hmmsearch
+process. All shards are searched with -Z set to the size of the whole
+database, so E-values and reporting thresholds are the same as for a single
+search over the unsharded file, and the hits of all shards are merged in
+E-value order.
+
+The merged output is an A3M string whose rows are the hmmsearch alignments
+of the hits, in the form consumed by `parsers.parse_hmmsearch_a3m` and
+`templates.HmmsearchHitFeaturizer`.
+"""
+
+import concurrent.futures
+import json
+import os
+import subprocess
+import tempfile
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from absl import logging
+from alphafold.data import parsers
+from alphafold.data.tools import hmmbuild
+from alphafold.data.tools import utils
+
+_MANIFEST_FILE = 'shards.json'
+
+# Default hmmsearch settings of `alphafold.data.tools.hmmsearch`.
+DEFAULT_FLAGS = ('--F1', '0.1',
+                 '--F2', '0.1',
+                 '--F3', '0.1',
+                 '--incE', '100',
+                 '-E', '100',
+                 '--domE', '100',
+                 '--incdomE', '100')
+
+
+def _shard_path(shard_dir: str, shard_index: int) -> str:
+  return os.path.join(shard_dir, f'shard_{shard_index:05d}.fasta')
+
+
+def shard_database(database_path: str,
+                   shard_dir: str,
+                   num_shards: int) -> Tuple[List[str], int]:
+  """Splits a FASTA database into shards, reusing existing shards.
+
+  Records are assigned to shards round-robin so that all shards have about
+  the same number and length distribution of sequences.
+
+  Returns:
+    A tuple of (shard paths, number of sequences in the database).
+  """
+  source = {
+      'database_path': os.path.abspath(database_path),
+      'database_size': os.path.getsize(database_path),
+      'num_shards': num_shards,
+  }
+  shard_paths = [_shard_path(shard_dir, i) for i in range(num_shards)]
+  manifest_path = os.path.join(shard_dir, _MANIFEST_FILE)
+  if os.path.exists(manifest_path):
+    with open(manifest_path) as f:
+      manifest = json.load(f)
+    if all(manifest[key] == value for key, value in source.items()):
+      return shard_paths, manifest['num_sequences']
+
+  logging.info('Splitting %s into %d shards in %s.', database_path,
+               num_shards, shard_dir)
+  os.makedirs(shard_dir, exist_ok=True)
+  tmp_paths = [path + '.tmp' for path in shard_paths]
+  shards = [open(path, 'w') for path in tmp_paths]
+  num_sequences = 0
+  try:
+    shard = None
+    with open(database_path) as f:
+      for line in f:
+        if line.startswith('>'):
+          shard = shards[num_sequences % num_shards]
+          num_sequences += 1
+        if shard is not None:
+          shard.write(line)
+  finally:
+    for shard in shards:
+      shard.close()
+  for tmp_path, shard_path in zip(tmp_paths, shard_paths):
+    os.replace(tmp_path, shard_path)
+
+  with open(manifest_path, 'w') as f:
+    json.dump({**source, 'num_sequences': num_sequences}, f, indent=2)
+  return shard_paths, num_sequences
+
+
+def _parse_tblout(tblout: str) -> Dict[str, float]:
+  """Maps target names to full sequence E-values."""
+  evalues = {}
+  for line in tblout.splitlines():
+    if line.startswith('#') or not line.strip():
+      continue
+    columns = line.split()
+    evalues[columns[0]] = float(columns[4])
+  return evalues
+
+
+def merge_shard_results(results: Sequence[Tuple[str, str]]) -> str:
+  """Merges the hits of several shards into one A3M string.
+
+  Args:
+    results: (Stockholm alignment, tblout) of every shard.
+
+  Returns:
+    The hits of all shards as A3M, ordered by full sequence E-value. Ties
+    keep the order of the shards and of hmmsearch.
+  """
+  hits = []
+  for shard_index, (sto, tblout) in enumerate(results):
+    evalues = _parse_tblout(tblout)
+    a3m = parsers.convert_stockholm_to_a3m(sto, remove_first_row_gaps=False)
+    sequences, descriptions = parsers.parse_fasta(a3m)
+    for position, (sequence, description) in enumerate(
+        zip(sequences, descriptions)):
+      target_name = description.split('/', 1)[0]
+      evalue = evalues.get(target_name, float('inf'))
+      hits.append(((evalue, shard_index, position), description, sequence))
+  hits.sort(key=lambda hit: hit[0])
+  return ''.join(f'>{description}\n{sequence}\n'
+                 for _, description, sequence in hits)
+
+
+class ShardedHmmsearch:
+  """Template searcher running hmmsearch over database shards in parallel.
+
+  Has the `query`/`get_template_hits` interface of `hmmsearch.Hmmsearch`.
+  Every shard is searched by a separate hmmsearch process; the worker pool
+  only waits on them.
+  """
+
+  def __init__(self,
+               *,
+               binary_path: str,
+               hmmbuild_binary_path: str,
+               database_path: str,
+               num_shards: int = 8,
+               n_cpu: int = 8,
+               shard_dir: Optional[str] = None,
+               flags: Optional[Sequence[str]] = None):
+    """Initializes the sharded hmmsearch wrapper.
+
+    Args:
+      binary_path: The path to the hmmsearch executable.
+      hmmbuild_binary_path: The path to the hmmbuild executable.
+      database_path: The path to the FASTA database.
+      num_shards: Number of shards searched in parallel.
+      n_cpu: Total number of CPUs, split between the shard searches.
+      shard_dir: Directory where the shards are written. Defaults to a
+        directory under the system temporary directory.
+      flags: List of flags to be used by hmmsearch.
+
+    Raises:
+      ValueError: If the database is not found.
+    """
+    if not os.path.exists(database_path):
+      logging.error('Could not find hmmsearch database %s', database_path)
+      raise ValueError(f'Could not find hmmsearch database {database_path}')
+    if shard_dir is None:
+      shard_dir = os.path.join(
+          tempfile.gettempdir(),
+          f'{os.path.basename(database_path)}_{num_shards}_shards')
+
+    self.binary_path = binary_path
+    self.hmmbuild_runner = hmmbuild.Hmmbuild(binary_path=hmmbuild_binary_path)
+    self.database_path = database_path
+    self.flags = list(DEFAULT_FLAGS if flags is None else flags)
+    self.cpu_per_shard = max(n_cpu // num_shards, 1)
+    self.shard_paths, self.num_sequences = shard_database(
+        database_path, shard_dir, num_shards)
+
+  @property
+  def output_format(self) -> str:
+    return 'a3m'
+
+  @property
+  def input_format(self) -> str:
+    return 'sto'
+
+  def query(self, msa_sto: str) -> str:
+    """Queries the database shards with a profile built from the MSA."""
+    hmm = self.hmmbuild_runner.build_profile_from_sto(msa_sto,
+                                                      model_construction='hand')
+    return self.query_with_hmm(hmm)
+
+  def _search_shard(self, hmm_path: str, shard_path: str,
+                    tmp_dir: str) -> Tuple[str, str]:
+    name = os.path.splitext(os.path.basename(shard_path))[0]
+    out_path = os.path.join(tmp_dir, f'{name}.sto')
+    tblout_path = os.path.join(tmp_dir, f'{name}.tbl')
+    cmd = [
+        self.binary_path,
+        '--noali',
+        '--cpu', str(self.cpu_per_shard),
+        '-Z', str(self.num_sequences),
+        *self.flags,
+        '--tblout', tblout_path,
+        '-A', out_path,
+        hmm_path,
+        shard_path,
+    ]
+    logging.info('Launching sub-process %s', cmd)
+    process = subprocess.run(cmd, capture_output=True)
+    if process.returncode:
+      raise RuntimeError(
+          'hmmsearch failed:\nstdout:\n%s\n\nstderr:\n%s\n' % (
+              process.stdout.decode('utf-8'), process.stderr.decode('utf-8')))
+
+    # hmmsearch does not write an alignment if there are no hits.
+    sto = ''
+    if os.path.exists(out_path):
+      with open(out_path) as f:
+        sto = f.read()
+    with open(tblout_path) as f:
+      tblout = f.read()
+    return sto, tblout
+
+  def query_with_hmm(self, hmm: str) -> str:
+    """Queries the database shards with the given profile."""
+    with utils.tmpdir_manager() as query_tmp_dir:
+      hmm_path = os.path.join(query_tmp_dir, 'query.hmm')
+      with open(hmm_path, 'w') as f:
+        f.write(hmm)
+      with utils.timing(f'hmmsearch ({len(self.shard_paths)} shards of '
+                        f'{os.path.basename(self.database_path)}) query'):
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(self.shard_paths)) as executor:
+          results = list(executor.map(
+              lambda shard_path: self._search_shard(
+                  hmm_path, shard_path, query_tmp_dir),
+              self.shard_paths))
+    return merge_shard_results(results)
+
+  def get_template_hits(self,
+                        output_string: str,
+                        input_sequence: str) -> Sequence[parsers.TemplateHit]:
+    """Gets parsed template hits from the merged A3M output."""
+    return parsers.parse_hmmsearch_a3m(
+        query_sequence=input_sequence,
+        a3m_string=output_string,
+        skip_first=False)
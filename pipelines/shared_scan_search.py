@@ -0,0 +1,291 @@
+"""Searches many queries against a sequence database in one pass over it.
+
+Searching a batch of targets one after the other reads the whole database
+(UniRef90 is tens of GB) once per target. Here the FASTA database is read
+once, in chunks of whole records, and every chunk is searched by all queries
+while it is in memory: it is piped to one phmmer or hmmsearch process per
+query, running in parallel, while the next chunk is read. The hits of every
+query are merged over the chunks in E-value order.
+
+All chunks are searched with -Z set to the number of sequences of the whole
+database, counted once and cached, so E-values and reporting thresholds are
+those of a search over the whole file, as in `sharded_hmmsearch`. The tools
+are single-pass: phmmer for sequence queries and hmmsearch for profiles
+built from MSAs. Iterative jackhmmer searches rebuild their profile from the
+hits of the whole database at every iteration and cannot be split this way.
+
+The hits of a phmmer query are returned as an MSA with the query sequence as
+its first row, like the jackhmmer MSAs of the data pipeline, so that they can
+be read with `EncodedMsa.from_a3m`. The hits of an hmmsearch profile are
+returned without a query row, as by `ShardedHmmsearch.query`: they are
+template-style hit lists, read with `parsers.parse_hmmsearch_a3m` and the
+sequence of the target the profile was built for.
+"""
+
+import concurrent.futures
+import json
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from absl import logging
+from alphafold.data import parsers
+from alphafold.data.tools import utils
+
+import sharded_hmmsearch
+
+PHMMER = 'phmmer'
+HMMSEARCH = 'hmmsearch'
+
+# Settings of the first jackhmmer iteration of AlphaFold.
+DEFAULT_PHMMER_FLAGS = ('--F1', '0.0005',
+                        '--F2', '0.00005',
+                        '--F3', '0.0000005',
+                        '--incE', '0.0001',
+                        '-E', '0.0001')
+DEFAULT_FLAGS = {
+    PHMMER: DEFAULT_PHMMER_FLAGS,
+    HMMSEARCH: sharded_hmmsearch.DEFAULT_FLAGS,
+}
+
+_END_OF_DATABASE = None
+
+
+def _count_records(data: bytes) -> int:
+  return data.count(b'\n>') + data.startswith(b'>')
+
+
+def iter_chunks(database_path: str,
+                chunk_bytes: int) -> Iterator[Tuple[bytes, int]]:
+  """Reads a FASTA database once, in chunks of whole records.
+
+  Yields:
+    Tuples of (chunk, number of records in the chunk).
+  """
+  rest = b''
+  with open(database_path, 'rb') as f:
+    while True:
+      block = f.read(chunk_bytes)
+      if not block:
+        break
+      data = rest + block
+      # The last record may continue in the next block.
+      cut = data.rfind(b'\n>') + 1
+      if not cut:
+        rest = data
+        continue
+      chunk, rest = data[:cut], data[cut:]
+      yield chunk, _count_records(chunk)
+  if rest:
+    yield rest, _count_records(rest)
+
+
+def count_sequences(database_path: str, cache_dir: Optional[str] = None
+                    ) -> int:
+  """Counts the records of a FASTA database, caching the count on disk."""
+  cache_dir = cache_dir or tempfile.gettempdir()
+  stat = os.stat(database_path)
+  source = {
+      'database_path': os.path.abspath(database_path),
+      'database_size': stat.st_size,
+      'database_mtime': stat.st_mtime,
+  }
+  cache_path = os.path.join(
+      cache_dir, f'{os.path.basename(database_path)}.num_sequences.json')
+  if os.path.exists(cache_path):
+    with open(cache_path) as f:
+      cached = json.load(f)
+    if all(cached.get(key) == value for key, value in source.items()):
+      return cached['num_sequences']
+
+  num_sequences = sum(
+      count for _, count in iter_chunks(database_path, 64 << 20))
+  os.makedirs(cache_dir, exist_ok=True)
+  with open(cache_path, 'w') as f:
+    json.dump({**source, 'num_sequences': num_sequences}, f, indent=2)
+  return num_sequences
+
+
+class SharedScanSearch:
+  """Searches a batch of queries against a database read once."""
+
+  def __init__(self,
+               *,
+               binary_path: str,
+               database_path: str,
+               tool: str = PHMMER,
+               num_workers: int = 8,
+               n_cpu: int = 8,
+               chunk_bytes: int = 256 << 20,
+               max_hits: Optional[int] = None,
+               count_cache_dir: Optional[str] = None,
+               flags: Optional[Sequence[str]] = None):
+    """Initializes the search.
+
+    Args:
+      binary_path: The path to the phmmer or hmmsearch executable.
+      database_path: The path to the FASTA database.
+      tool: `phmmer` for sequence queries or `hmmsearch` for profile queries.
+      num_workers: Number of query processes searching a chunk at a time.
+      n_cpu: Total number of CPUs, split between the query processes.
+      chunk_bytes: Size of the chunks the database is read in. Two chunks
+        are in memory at a time.
+      max_hits: Maximum number of hits kept per query, the ones with the
+        lowest E-values.
+      count_cache_dir: Directory of the cached number of sequences of the
+        database.
+      flags: List of flags of the tool. Defaults to `DEFAULT_FLAGS[tool]`.
+
+    Raises:
+      ValueError: If the database is not found or the tool is unknown.
+    """
+    if tool not in DEFAULT_FLAGS:
+      raise ValueError(f'Unsupported tool {tool}.')
+    if not os.path.exists(database_path):
+      logging.error('Could not find %s database %s', tool, database_path)
+      raise ValueError(f'Could not find {tool} database {database_path}')
+    self.binary_path = binary_path
+    self.database_path = database_path
+    self.tool = tool
+    self.num_workers = num_workers
+    self.cpu_per_worker = max(n_cpu // num_workers, 1)
+    self.chunk_bytes = chunk_bytes
+    self.max_hits = max_hits
+    self.flags = list(DEFAULT_FLAGS[tool] if flags is None else flags)
+    self.num_sequences = count_sequences(database_path, count_cache_dir)
+
+  def _search_chunk(self, query_path: str, chunk: bytes, out_prefix: str
+                    ) -> Tuple[str, str]:
+    out_path = f'{out_prefix}.sto'
+    tblout_path = f'{out_prefix}.tbl'
+    cmd = [
+        self.binary_path,
+        '--noali',
+        '--cpu', str(self.cpu_per_worker),
+        '-Z', str(self.num_sequences),
+        *self.flags,
+        '--tblout', tblout_path,
+        '-A', out_path,
+        query_path,
+        # The chunk is read from stdin rather than from the disk.
+        '-',
+    ]
+    process = subprocess.run(cmd, input=chunk, capture_output=True)
+    if process.returncode:
+      raise RuntimeError(
+          '%s failed:\nstdout:\n%s\n\nstderr:\n%s\n' % (
+              self.tool, process.stdout.decode('utf-8'),
+              process.stderr.decode('utf-8')))
+
+    # No alignment is written if there are no hits.
+    sto = ''
+    if os.path.exists(out_path):
+      with open(out_path) as f:
+        sto = f.read()
+      os.remove(out_path)
+    with open(tblout_path) as f:
+      tblout = f.read()
+    os.remove(tblout_path)
+    return sto, tblout
+
+  def _read_ahead(self, chunks: queue.Queue, stop: threading.Event):
+    try:
+      for chunk in iter_chunks(self.database_path, self.chunk_bytes):
+        if stop.is_set():
+          return
+        chunks.put(chunk)
+    finally:
+      chunks.put(_END_OF_DATABASE)
+
+  def _truncate(self, a3m: str) -> str:
+    if self.max_hits is None:
+      return a3m
+    sequences, descriptions = parsers.parse_fasta(a3m)
+    return ''.join(f'>{description}\n{sequence}\n' for sequence, description
+                   in list(zip(sequences, descriptions))[:self.max_hits])
+
+  def _query_rows(self, queries: Mapping[str, str]) -> Dict[str, str]:
+    """The A3M rows of the query sequences, for phmmer."""
+    if self.tool != PHMMER:
+      return {name: '' for name in queries}
+    rows = {}
+    for name, query in queries.items():
+      sequences, descriptions = parsers.parse_fasta(query)
+      if len(sequences) != 1:
+        raise ValueError(f'Query {name} has {len(sequences)} sequences, '
+                         'phmmer queries must have exactly one.')
+      rows[name] = f'>{descriptions[0]}\n{sequences[0]}\n'
+    return rows
+
+  def search(self, queries: Mapping[str, str]) -> Dict[str, str]:
+    """Searches all queries in one pass over the database.
+
+    Args:
+      queries: Maps query names to a FASTA sequence for phmmer, or to an HMM
+        profile for hmmsearch.
+
+    Returns:
+      Maps query names to their hits, as A3M in E-value order. For phmmer,
+      the query sequence is the first row and `max_hits` does not count it.
+      For hmmsearch there is no query row, as in the output of
+      `ShardedHmmsearch.query`.
+
+    Raises:
+      ValueError: If a phmmer query is not a single FASTA sequence.
+    """
+    query_rows = self._query_rows(queries)
+    results: Dict[str, List[Tuple[str, str]]] = {name: [] for name in queries}
+    # One chunk is read while the previous one is searched.
+    chunks = queue.Queue(maxsize=1)
+    stop = threading.Event()
+    reader = threading.Thread(target=self._read_ahead, args=(chunks, stop),
+                              daemon=True)
+    t_0 = time.time()
+    num_bytes = 0
+    num_chunks = 0
+    with utils.tmpdir_manager() as tmp_dir:
+      query_paths = {}
+      for i, (name, query) in enumerate(queries.items()):
+        query_paths[name] = os.path.join(tmp_dir, f'query_{i}')
+        with open(query_paths[name], 'w') as f:
+          f.write(query)
+
+      reader.start()
+      try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.num_workers) as executor:
+          while True:
+            item = chunks.get()
+            if item is _END_OF_DATABASE:
+              break
+            chunk, _ = item
+            futures = {
+                name: executor.submit(
+                    self._search_chunk, query_path, chunk,
+                    os.path.join(tmp_dir, f'query_{i}_chunk_{num_chunks}'))
+                for i, (name, query_path) in enumerate(query_paths.items())}
+            for name, future in futures.items():
+              results[name].append(future.result())
+            num_bytes += len(chunk)
+            num_chunks += 1
+      finally:
+        # If a search failed, the reader may be blocked on the full queue.
+        stop.set()
+        while reader.is_alive():
+          try:
+            chunks.get(timeout=0.1)
+          except queue.Empty:
+            pass
+
+    logging.info('Searched %d queries with %s in one pass over %s: %d chunks, '
+                 '%.1f MB, %.1f s.', len(queries), self.tool,
+                 self.database_path, num_chunks, num_bytes / 1e6,
+                 time.time() - t_0)
+    return {
+        name: query_rows[name] + self._truncate(
+            sharded_hmmsearch.merge_shard_results(hits))
+        for name, hits in results.items()}
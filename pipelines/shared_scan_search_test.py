@@ -0,0 +1,113 @@
+"""Tests for shared_scan_search, with the search tool stubbed out."""
+
+import os
+
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+
+import encoded_msa
+import shared_scan_search
+
+_RECORDS = (b'>seq0 first\nMKVLA\nAGT\n',
+            b'>seq1\nMK\n',
+            b'>seq2 last\nMKVL\n')
+_QUERY = '>query description\nMKVL\n'
+# Hits of every database record, with their E-values.
+_HITS = {'seq0': ('MKVL', '1e-9'), 'seq1': ('MRVL', '1e-3'),
+         'seq2': ('MKVI', '1e-5')}
+
+
+def _fake_search_chunk(query_path, chunk, out_prefix):
+  """The Stockholm alignment and tblout of the hits in a chunk."""
+  del query_path, out_prefix  # Unused.
+  names = [line[1:].split()[0] for line in chunk.decode().splitlines()
+           if line.startswith('>')]
+  sto = ['# STOCKHOLM 1.0\n']
+  sto += [f'#=GS {name}/1-4 DE hit\n' for name in names]
+  sto += [f'{name}/1-4 {_HITS[name][0]}\n' for name in names]
+  sto.append('//\n')
+  tblout = [f'{name} - query - {_HITS[name][1]} 100.0 0.0\n'
+            for name in names]
+  return ''.join(sto), ''.join(tblout)
+
+
+class IterChunksTest(parameterized.TestCase):
+
+  def _write(self, data: bytes) -> str:
+    return self.create_tempfile(content=data, mode='wb').full_path
+
+  @parameterized.parameters(1, 5, 10, 23, 31, 1000)
+  def test_chunks_hold_whole_records(self, chunk_bytes):
+    data = b''.join(_RECORDS)
+    chunks = list(shared_scan_search.iter_chunks(self._write(data),
+                                                 chunk_bytes))
+    self.assertEqual(b''.join(chunk for chunk, _ in chunks), data)
+    self.assertEqual(sum(count for _, count in chunks), len(_RECORDS))
+    for chunk, count in chunks:
+      self.assertTrue(chunk.startswith(b'>'))
+      self.assertTrue(chunk.endswith(b'\n'))
+      self.assertEqual(chunk.count(b'>'), count)
+
+  @parameterized.parameters(1, 7, 1000)
+  def test_last_record_without_newline(self, chunk_bytes):
+    data = b''.join(_RECORDS)[:-1]
+    chunks = list(shared_scan_search.iter_chunks(self._write(data),
+                                                 chunk_bytes))
+    self.assertEqual(b''.join(chunk for chunk, _ in chunks), data)
+    self.assertEqual(chunks[-1], (b'>seq2 last\nMKVL', 1))
+    self.assertEqual(sum(count for _, count in chunks), len(_RECORDS))
+
+  def test_count_sequences_is_cached(self):
+    path = self._write(b''.join(_RECORDS))
+    cache_dir = self.create_tempdir().full_path
+    self.assertEqual(shared_scan_search.count_sequences(path, cache_dir), 3)
+    self.assertLen(os.listdir(cache_dir), 1)
+    with mock.patch.object(shared_scan_search, 'iter_chunks') as iter_chunks:
+      self.assertEqual(shared_scan_search.count_sequences(path, cache_dir), 3)
+    iter_chunks.assert_not_called()
+
+
+class SharedScanSearchTest(absltest.TestCase):
+
+  def _search(self, tool, queries, **kwargs):
+    searcher = shared_scan_search.SharedScanSearch(
+        binary_path=tool,
+        database_path=self.create_tempfile(
+            content=b''.join(_RECORDS), mode='wb').full_path,
+        tool=tool,
+        chunk_bytes=16,
+        count_cache_dir=self.create_tempdir().full_path,
+        **kwargs)
+    with mock.patch.object(searcher, '_search_chunk',
+                           side_effect=_fake_search_chunk):
+      return searcher.search(queries)
+
+  def test_phmmer_hits_start_with_the_query(self):
+    a3m = self._search(shared_scan_search.PHMMER, {'q': _QUERY})['q']
+    self.assertEqual(a3m, '>query description\nMKVL\n'
+                          '>seq0/1-4 hit\nMKVL\n'
+                          '>seq2/1-4 hit\nMKVI\n'
+                          '>seq1/1-4 hit\nMRVL\n')
+    msa = encoded_msa.EncodedMsa.from_a3m(a3m)
+    self.assertEqual(msa.descriptions[0], 'query description')
+
+  def test_max_hits_does_not_count_the_query(self):
+    a3m = self._search(shared_scan_search.PHMMER, {'q': _QUERY},
+                       max_hits=1)['q']
+    self.assertEqual(a3m, '>query description\nMKVL\n>seq0/1-4 hit\nMKVL\n')
+
+  def test_hmmsearch_hits_have_no_query_row(self):
+    a3m = self._search(shared_scan_search.HMMSEARCH, {'q': 'HMMER3/f'})['q']
+    self.assertEqual(a3m, '>seq0/1-4 hit\nMKVL\n'
+                          '>seq2/1-4 hit\nMKVI\n'
+                          '>seq1/1-4 hit\nMRVL\n')
+
+  def test_phmmer_query_must_be_one_sequence(self):
+    with self.assertRaisesRegex(ValueError, 'exactly one'):
+      self._search(shared_scan_search.PHMMER, {'q': _QUERY + _QUERY})
+
+
+if __name__ == '__main__':
+  absltest.main()